@@ -0,0 +1,195 @@
+"""
+Index of video analysis results, so people/face detection runs once per video.
+
+Results are stored in a SQLite database shared by every process on the host, keyed by the
+SHA-256 of the video's content and the detector settings that produced them: a re-uploaded
+file with the same content reuses its result, and changing a detection setting or bumping
+``ANALYSIS_VERSION`` makes every stored result stale.
+
+Run as a script to analyze recent video uploads ahead of their first reel:
+
+    python src/analysis_index.py --since 2024-06-01
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from datetime import datetime
+from metrics import incr
+from config import ANALYSIS_CONFIG, DETECTION_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Part of every detector signature; bump it whenever detection changes in a way its settings do not show
+ANALYSIS_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS video_analysis (
+    content_hash TEXT NOT NULL,
+    detector TEXT NOT NULL,
+    fps REAL NOT NULL,
+    start_frame INTEGER NOT NULL,
+    start_time REAL NOT NULL,
+    reason TEXT,
+    analyzed_at REAL NOT NULL,
+    PRIMARY KEY (content_hash, detector)
+);
+CREATE TABLE IF NOT EXISTS video_files (
+    file_id TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS video_rejections (
+    content_hash TEXT PRIMARY KEY,
+    duration REAL NOT NULL,
+    rejected_at REAL NOT NULL
+);
+"""
+
+_schema_lock = threading.Lock()
+_schema_pid = None
+
+
+def _connect():
+    global _schema_pid
+    path = ANALYSIS_CONFIG['index_path']
+    conn = sqlite3.connect(path, timeout=30)
+    if _schema_pid != os.getpid():
+        with _schema_lock:
+            if _schema_pid != os.getpid():
+                # WAL lets the jobs of other processes read while one of them writes
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript(_SCHEMA)
+                _schema_pid = os.getpid()
+    return conn
+
+
+def detector_signature(confidence_threshold):
+    """Settings a detection result depends on, as the string it is stored under."""
+    return json.dumps({
+        'version': ANALYSIS_VERSION,
+        'people': DETECTION_CONFIG['people_detector'],
+        'people_input_size': DETECTION_CONFIG['people_input_size'],
+        'faces': DETECTION_CONFIG['face_detector'],
+        'face_confidence': DETECTION_CONFIG['face_confidence'],
+        'confidence_threshold': confidence_threshold,
+        'sampling': DETECTION_CONFIG['sampling_strategy'],
+        'sample_stride': DETECTION_CONFIG['sample_stride'],
+        'samples_per_second': DETECTION_CONFIG['samples_per_second'],
+        'refine': DETECTION_CONFIG['refine'],
+        'max_side': DETECTION_CONFIG['max_side'],
+    }, sort_keys=True)
+
+
+def lookup_analysis(content_hash, detector):
+    """
+    Return the stored result of a video, or None if it was not analyzed with these settings.
+
+    :return: Dict with fps, start_frame, start_time and reason
+    """
+    with closing(_connect()) as conn:
+        row = conn.execute("SELECT fps, start_frame, start_time, reason FROM video_analysis "
+                           "WHERE content_hash = ? AND detector = ?", (content_hash, detector)).fetchone()
+    incr('reel_cache_requests_total', cache='analysis', result='miss' if row is None else 'hit')
+    if row is None:
+        return None
+    return {'fps': row[0], 'start_frame': row[1], 'start_time': row[2], 'reason': row[3]}
+
+
+def record_analysis(content_hash, detector, fps, start_frame, reason):
+    """Store the result of a video, replacing an earlier one with the same settings."""
+    with closing(_connect()) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO video_analysis "
+                     "(content_hash, detector, fps, start_frame, start_time, reason, analyzed_at) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (content_hash, detector, fps, start_frame, start_frame / fps, reason, time.time()))
+
+
+def record_rejection(content_hash, duration):
+    """Remember a video too long to be used in a reel, so it is not downloaded again to find out."""
+    with closing(_connect()) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO video_rejections (content_hash, duration, rejected_at) VALUES (?, ?, ?)",
+                     (content_hash, duration, time.time()))
+
+
+def record_file(file_id, content_hash):
+    """Remember the content of a file record, so it is known to be analyzed without downloading it."""
+    with closing(_connect()) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO video_files (file_id, content_hash) VALUES (?, ?)",
+                     (str(file_id), content_hash))
+
+
+def analyzed_file_ids(file_ids, detector, max_video_duration=40):
+    """
+    Return the subset of ``file_ids`` whose content was already analyzed with these settings, or
+    rejected for being longer than ``max_video_duration`` seconds.
+    """
+    ids = [str(file_id) for file_id in file_ids]
+    found = set()
+    with closing(_connect()) as conn:
+        # SQLite limits the number of parameters of a statement
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = conn.execute(f"SELECT f.file_id FROM video_files f "
+                                f"LEFT JOIN video_analysis a ON a.content_hash = f.content_hash AND a.detector = ? "
+                                f"LEFT JOIN video_rejections r ON r.content_hash = f.content_hash AND r.duration > ? "
+                                f"WHERE f.file_id IN ({', '.join('?' * len(chunk))}) "
+                                f"AND (a.content_hash IS NOT NULL OR r.content_hash IS NOT NULL)",
+                                [detector, max_video_duration, *chunk])
+            found.update(row[0] for row in rows)
+    return {file_id for file_id in file_ids if str(file_id) in found}
+
+
+def preanalyze(since, limit=None, confidence_threshold=0.7):
+    """
+    Analyze the videos posted since ``since`` that are not in the index yet.
+
+    Videos are downloaded a batch at a time and their local copies removed once analyzed.
+
+    Videos rejected as too long are recorded as well, so later runs skip them.
+
+    :return: Number of videos analyzed
+    """
+    from media_collector import query_video_uploads, download_media_items
+    from video_processing import plan_subvideo
+
+    detector = detector_signature(confidence_threshold)
+    media_items = query_video_uploads(since, limit)
+    done = analyzed_file_ids([item['id'] for item in media_items], detector)
+    # A video posted more than once is analyzed once
+    pending = list({item['id']: item for item in media_items if item['id'] not in done}.values())
+    logger.info(f"{len(media_items)} videos posted since {since:%Y-%m-%d}, {len(pending)} not analyzed yet")
+
+    analyzed = 0
+    batch_size = ANALYSIS_CONFIG['preanalyze_batch_size']
+    for start in range(0, len(pending), batch_size):
+        for item in download_media_items(pending[start:start + batch_size]):
+            try:
+                if plan_subvideo(item['path'], confidence_threshold=confidence_threshold,
+                                 file_id=item['id']) is not None:
+                    analyzed += 1
+            finally:
+                if os.path.exists(item['path']):
+                    os.remove(item['path'])
+        logger.info(f"Analyzed {analyzed}/{len(pending)} videos")
+    return analyzed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--since', required=True, type=lambda value: datetime.strptime(value, '%Y-%m-%d'),
+                        help="Analyze videos posted on or after this date (YYYY-MM-DD)")
+    parser.add_argument('--limit', type=int, help="Analyze at most this many of the most recent videos")
+    args = parser.parse_args(argv)
+    preanalyze(args.since, args.limit)
+    return 0
+
+
+if __name__ == '__main__':
+    from config import APP_CONFIG
+
+    logging.basicConfig(level=APP_CONFIG['log_level'], format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    raise SystemExit(main())
@@ -0,0 +1,668 @@
+"""
+Offline benchmark of the rendering and extraction pipeline.
+
+Synthesizes images, videos (with and without faces) and an audio track, then runs each stage
+in a fresh subprocess so its peak RSS is measured on its own. S3 is served by the in-memory
+stand-in and the database calls are stubbed, so no credentials or network are needed.
+
+    python src/benchmark.py --output bench.json
+    python src/benchmark.py --output new.json --compare bench.json
+
+Without ``--yolo-dir`` a tiny synthetic Darknet network replaces YOLOv3: the people detector
+then never fires and every video falls through to face detection, which exercises the whole
+detection path but does not reflect YOLOv3's inference cost. Point ``--yolo-dir`` at a folder
+with yolov3.cfg and yolov3.weights for representative numbers; yolov3-tiny.cfg/.weights and the
+DNN face detector's files (deploy.prototxt, res10_300x300_ssd_iter_140000.caffemodel) placed
+there as well are compared by the detectors stage.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from datetime import datetime, timezone
+
+import cv2
+import numpy as np
+
+STAGES = ['images', 'extract', 'reel', 'renditions', 'encode', 'detectors', 'job']
+
+# Rendition ladder of the renditions stage: the reel's primary MP4 plus a larger MP4 and an HLS stream
+BENCHMARK_RENDITIONS = 'main:480x480:5000k,hd:720x720:8000k,stream:480x480:2500k:hls'
+
+# Backends of the detectors stage as (model, input size) for people and by name for faces; the
+# first of each is the reference the others are compared against
+BENCHMARK_PEOPLE_DETECTORS = [('yolov3', 416), ('yolov3', 320), ('yolov3-tiny', 416), ('yolov3-tiny', 320)]
+BENCHMARK_FACE_DETECTORS = ['haar', 'dnn']
+
+# Each scenario lists images as (width, height) and videos as dicts; 'face_at' is the fraction of
+# the video after which a face is visible, or None for a video without faces.
+SCENARIOS = {
+    'small': {
+        'images': [(640, 480), (800, 600), (480, 640), (640, 640)],
+        'videos': [{'size': (640, 360), 'duration': 6, 'fps': 30, 'face_at': 0.3}],
+    },
+    'mixed': {
+        'images': [(1600, 1200), (1200, 1600), (1920, 1080), (1024, 1024), (2048, 1536), (1280, 720)],
+        'videos': [{'size': (1280, 720), 'duration': 10, 'fps': 30, 'face_at': 0.5},
+                   {'size': (720, 1280), 'duration': 8, 'fps': 30, 'face_at': None}],
+    },
+    'large': {
+        'images': [(4000, 3000), (3000, 4000), (4032, 2268), (2268, 4032)] * 3,
+        'videos': [{'size': (1920, 1080), 'duration': 20, 'fps': 30, 'face_at': 0.6},
+                   {'size': (1920, 1080), 'duration': 15, 'fps': 60, 'face_at': None},
+                   {'size': (1080, 1920), 'duration': 12, 'fps': 30, 'face_at': 0.2}],
+    },
+}
+
+TARGET_SIZE = (480, 480)
+FRAME_RATE = 24
+BUCKET = 'benchmark'
+
+
+def draw_face(img, cx, cy, r):
+    """Draw a frontal face the Haar cascade picks up."""
+    cv2.ellipse(img, (cx, cy), (r, int(r * 1.3)), 0, 0, 360, (150, 180, 220), -1)
+    for dx in (-1, 1):
+        eye_x = cx + dx * r * 2 // 5
+        cv2.ellipse(img, (eye_x, cy - r // 4), (r // 5, r // 9), 0, 0, 360, (40, 40, 40), -1)
+        cv2.line(img, (eye_x - r // 4, cy - r // 2), (eye_x + r // 4, cy - r // 2), (30, 30, 30), max(2, r // 12))
+    cv2.line(img, (cx, cy - r // 6), (cx, cy + r // 4), (120, 140, 180), max(2, r // 15))
+    cv2.ellipse(img, (cx, cy + r // 2), (r // 3, r // 10), 0, 0, 360, (60, 60, 120), -1)
+
+
+def synthetic_frame(size, t, rng_seed, face=False):
+    """A textured frame with moving shapes, so the encoder has realistic work to do."""
+    width, height = size
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    base = np.empty((height, width, 3), dtype=np.uint8)
+    base[..., 0] = (127 + 100 * np.sin(6 * x + t + rng_seed)).astype(np.uint8)
+    base[..., 1] = (127 + 100 * np.cos(4 * y + 0.5 * t)).astype(np.uint8)
+    base[..., 2] = (127 + 60 * np.sin(3 * (x + y) - t)).astype(np.uint8)
+
+    rng = np.random.default_rng(rng_seed)
+    for _ in range(6):
+        cx, cy = rng.integers(0, width), rng.integers(0, height)
+        dx, dy = rng.uniform(-0.1, 0.1, 2) * (width, height)
+        radius = int(rng.integers(min(size) // 20, min(size) // 6))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv2.circle(base, (int(cx + dx * t) % width, int(cy + dy * t) % height), radius, color, -1)
+
+    if face:
+        draw_face(base, width // 2, height // 2, min(size) // 5)
+    return base
+
+
+def synthesize_image(path, size, seed, face=False):
+    cv2.imwrite(path, synthetic_frame(size, 0.0, seed, face), [cv2.IMWRITE_JPEG_QUALITY, 90])
+
+
+def synthesize_video(path, size, duration, fps, seed, face_at=None):
+    from ffmpeg_writer import FFmpegPipeWriter
+
+    frame_count = int(duration * fps)
+    with FFmpegPipeWriter(path, size, fps, preset='veryfast', bitrate='4000k') as writer:
+        for index in range(frame_count):
+            face = face_at is not None and index >= face_at * frame_count
+            frame = synthetic_frame(size, index / fps, seed, face)
+            writer.write_frames(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+
+def synthesize_audio(path, duration, sample_rate=44100):
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    samples = (0.3 * np.sin(2 * np.pi * 440 * t) * 32767).astype(np.int16)
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+
+
+def synthesize_scenario(name, folder):
+    """Write the media of a scenario and return its manifest."""
+    spec = SCENARIOS[name]
+    os.makedirs(folder, exist_ok=True)
+    items = []
+    for index, size in enumerate(spec['images']):
+        path = os.path.join(folder, f"image_{index}.jpg")
+        synthesize_image(path, size, seed=index, face=index % 2 == 0)
+        items.append({'type': 'image', 'path': path})
+    for index, video in enumerate(spec['videos']):
+        path = os.path.join(folder, f"video_{index}.mp4")
+        synthesize_video(path, video['size'], video['duration'], video['fps'], seed=100 + index,
+                         face_at=video['face_at'])
+        items.append({'type': 'video', 'path': path})
+
+    # Interleave videos among the images the way a year of posts would
+    images = [item for item in items if item['type'] == 'image']
+    videos = [item for item in items if item['type'] == 'video']
+    step = max(1, len(images) // (len(videos) + 1))
+    ordered = []
+    for index, image in enumerate(images):
+        ordered.append(image)
+        if videos and (index + 1) % step == 0:
+            ordered.append(videos.pop(0))
+    ordered.extend(videos)
+
+    audio_path = os.path.join(folder, 'audio.wav')
+    synthesize_audio(audio_path, 60)
+    manifest = {'scenario': name, 'media_items': ordered, 'audio_path': audio_path}
+    with open(os.path.join(folder, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def write_synthetic_yolo(cfg_path, weights_path):
+    """
+    Write a minimal Darknet network with YOLOv3's output layout and all-zero weights.
+
+    Every class score comes out as sigmoid(0) = 0.5, below the people detection threshold.
+    """
+    with open(cfg_path, 'w') as f:
+        f.write("[net]\nbatch=1\nwidth=416\nheight=416\nchannels=3\n\n"
+                "[convolutional]\nfilters=16\nsize=3\nstride=1\npad=1\nactivation=leaky\n\n"
+                "[maxpool]\nsize=32\nstride=32\n\n"
+                "[convolutional]\nsize=1\nstride=1\npad=1\nfilters=255\nactivation=linear\n\n"
+                "[yolo]\nmask=0,1,2\nanchors=10,14,23,27,37,58,81,82,135,169,344,319\nclasses=80\nnum=6\n")
+    with open(weights_path, 'wb') as f:
+        np.array([0, 2, 0], dtype=np.int32).tofile(f)
+        np.array([0], dtype=np.int64).tofile(f)
+        # Biases then weights of each convolution
+        np.zeros(16 + 16 * 3 * 3 * 3 + 255 + 255 * 16, dtype=np.float32).tofile(f)
+
+
+def count_frames(path):
+    cap = cv2.VideoCapture(path)
+    count = 0
+    while cap.grab():
+        count += 1
+    cap.release()
+    return count
+
+
+# --- Stages, each run in its own subprocess with the working directory as cwd ---
+
+def _install_stubs(manifest):
+    """Serve S3 from memory with the scenario's media uploaded, and stub the database calls."""
+    import s3_connector
+    import pipeline
+    from local_s3 import InMemoryS3
+
+    s3 = InMemoryS3()
+    s3_connector._client = s3
+    s3_connector._client_pid = os.getpid()
+
+    rows = []
+    for index, item in enumerate(manifest['media_items']):
+        s3_key = f"media/{index}/{os.path.basename(item['path'])}"
+        s3.upload_file(item['path'], BUCKET, s3_key)
+        rows.append({'id': index, 'type': item['type'], 's3Key': s3_key})
+
+    pipeline.query_account_media = lambda account_id, year: [dict(row) for row in rows]
+    pipeline.update_video_status = lambda account_id, year, video_path: None
+    return s3
+
+
+def run_images(manifest, output_folder):
+    from image_processing import generate_video_from_images
+
+    output_path = os.path.join(output_folder, 'images.mp4')
+    image_paths = [item['path'] for item in manifest['media_items'] if item['type'] == 'image']
+    start = time.perf_counter()
+    generate_video_from_images(image_paths, output_path, frame_rate=FRAME_RATE, target_size=TARGET_SIZE)
+    return {'wall_time_s': time.perf_counter() - start}, [output_path]
+
+
+def run_extract(manifest, output_folder):
+    from video_processing import extract_subvideo
+
+    outputs = []
+    start = time.perf_counter()
+    for index, item in enumerate(item for item in manifest['media_items'] if item['type'] == 'video'):
+        result = extract_subvideo(item['path'], os.path.join(output_folder, f"extract_{index}.mp4"),
+                                  target_size=TARGET_SIZE)
+        if result:
+            outputs.append(result)
+    return {'wall_time_s': time.perf_counter() - start}, outputs
+
+
+def run_reel(manifest, output_folder):
+    from video_generator import generate_video_video
+
+    output_path = os.path.join(output_folder, 'reel.mp4')
+    start = time.perf_counter()
+    generate_video_video(manifest['media_items'], output_path, manifest['audio_path'], TARGET_SIZE, FRAME_RATE)
+    return {'wall_time_s': time.perf_counter() - start}, [output_path]
+
+
+def run_renditions(manifest, output_folder):
+    from video_generator import generate_video_video, get_renditions, rendition_paths
+
+    renditions = get_renditions(BENCHMARK_RENDITIONS)
+    output_path = os.path.join(output_folder, 'renditions.mp4')
+    start = time.perf_counter()
+    generate_video_video(manifest['media_items'], output_path, manifest['audio_path'], frame_rate=FRAME_RATE,
+                         renditions=renditions)
+    paths = rendition_paths(output_path, renditions)
+    return {'wall_time_s': time.perf_counter() - start}, [paths[rendition['name']] for rendition in renditions]
+
+
+class _RawFrameFile:
+    """Writer stand-in that stores the rendered frames as raw RGB, to be encoded again and again."""
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.frame_count = 0
+
+    def write_frames(self, frames):
+        self.file.write(memoryview(np.ascontiguousarray(frames)))
+        self.frame_count += 1 if frames.ndim == 3 else len(frames)
+
+
+def run_encode(manifest, output_folder):
+    """Render the reel's frames once, then encode them with every encoder profile in turn."""
+    from video_generator import plan_segments, write_segments
+    from ffmpeg_writer import FFmpegPipeWriter
+    from encoding import ENCODER_PROFILES, get_profile
+
+    segments = plan_segments(manifest['media_items'], TARGET_SIZE, FRAME_RATE)
+    raw_path = os.path.join(output_folder, 'frames.rgb')
+    raw = _RawFrameFile(raw_path)
+    write_segments(segments, raw, TARGET_SIZE, FRAME_RATE)
+    raw.file.close()
+    frames = np.memmap(raw_path, dtype=np.uint8, mode='r', shape=(raw.frame_count, TARGET_SIZE[1], TARGET_SIZE[0], 3))
+
+    profiles = {}
+    outputs = []
+    for name in ENCODER_PROFILES:
+        output_path = os.path.join(output_folder, f"encode_{name}.mp4")
+        start = time.perf_counter()
+        with FFmpegPipeWriter(output_path, TARGET_SIZE, FRAME_RATE, **get_profile(name)) as writer:
+            for batch_start in range(0, len(frames), FRAME_RATE):
+                writer.write_frames(np.asarray(frames[batch_start:batch_start + FRAME_RATE]))
+        wall_time = time.perf_counter() - start
+        profiles[name] = {'wall_time_s': wall_time, 'encode_fps': len(frames) / wall_time,
+                          'output_bytes': os.path.getsize(output_path)}
+        outputs.append(output_path)
+    del frames
+    os.remove(raw_path)
+    return {'wall_time_s': sum(profile['wall_time_s'] for profile in profiles.values()), 'profiles': profiles}, outputs
+
+
+def _sampled_frames(video_path):
+    from frame_sampling import make_sampler
+
+    cap = cv2.VideoCapture(video_path)
+    fps = int(cap.get(cv2.CAP_PROP_FPS))
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    sampler = make_sampler(fps, total_frames, video_path)
+    frames = []
+    for index in range(total_frames):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if sampler.is_sampled(index):
+            frames.append((index, frame))
+    cap.release()
+    return frames
+
+
+def _time_detector(videos, detect, batch_size):
+    """Run ``detect(frames) -> hits`` over the sampled frames of every video, one batch at a time."""
+    hits = []
+    first_hits = []
+    elapsed = 0.0
+    for frames in videos:
+        video_hits = []
+        for start in range(0, len(frames), batch_size):
+            batch = [frame for _, frame in frames[start:start + batch_size]]
+            batch_start = time.perf_counter()
+            video_hits.extend(detect(batch))
+            elapsed += time.perf_counter() - batch_start
+        hits.extend(video_hits)
+        first_hits.append(next((index for (index, _), hit in zip(frames, video_hits) if hit), None))
+    return hits, first_hits, elapsed
+
+
+def run_detectors(manifest, output_folder):
+    """
+    Run every people and face detector backend over the sampled frames of the scenario's videos.
+
+    Reports per-frame latency and, against the first backend of each kind, the share of frames
+    with the same verdict and of videos whose first detection is on the same frame.
+    """
+    from config import APP_CONFIG, DETECTION_CONFIG
+    from detectors import make_face_detector, make_people_detector
+    from model_registry import FACE_DNN_MODEL, YOLO_MODELS
+    from video_processing import downscale_for_detection
+
+    videos = [_sampled_frames(item['path']) for item in manifest['media_items'] if item['type'] == 'video']
+    frame_count = sum(len(frames) for frames in videos)
+
+    def available(filenames):
+        return all(os.path.exists(os.path.join(APP_CONFIG['temp_folder'], filename)) for filename in filenames)
+
+    backends = []
+    for model, input_size in BENCHMARK_PEOPLE_DETECTORS:
+        def people_backend(model=model, input_size=input_size):
+            detector = make_people_detector(model, input_size)
+            return lambda batch: [bool(boxes) for boxes, _ in detector.detect(batch, confidence_threshold=0.7)]
+        backends.append((f"{model}@{input_size}", YOLO_MODELS[model], people_backend, DETECTION_CONFIG['batch_size']))
+    for name in BENCHMARK_FACE_DETECTORS:
+        def face_backend(name=name):
+            detector = make_face_detector(name)
+
+            def detect(batch):
+                hits = []
+                for frame in batch:
+                    small = downscale_for_detection(frame)
+                    scale = small.shape[0] / frame.shape[0]
+                    image = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if detector.channels == 1 else small
+                    min_size = (max(1, int(round(30 * scale))),) * 2
+                    hits.append(detector.detect(image, min_size) > 0)
+                return hits
+            return detect
+        backends.append((f"face:{name}", FACE_DNN_MODEL if name == 'dnn' else (), face_backend, 1))
+
+    results = {}
+    references = {}
+    for name, model_files, build, batch_size in backends:
+        if not available(model_files):
+            results[name] = {'error': f"model files missing: {', '.join(model_files)}"}
+            continue
+        detect = build()
+        if videos and videos[0]:
+            detect([videos[0][0][1]])  # Warm up outside the timing
+        hits, first_hits, elapsed = _time_detector(videos, detect, batch_size)
+        kind = 'face' if name.startswith('face:') else 'people'
+        reference = references.setdefault(kind, (hits, first_hits))
+        results[name] = {
+            'wall_time_s': elapsed,
+            'frame_ms': 1000 * elapsed / frame_count if frame_count else None,
+            'hit_frames': sum(hits),
+            'frame_agreement': sum(a == b for a, b in zip(hits, reference[0])) / len(hits) if hits else None,
+            'first_hit_agreement': sum(a == b for a, b in zip(first_hits, reference[1])) / len(first_hits)
+                                   if first_hits else None,
+        }
+    return {'wall_time_s': sum(result.get('wall_time_s', 0) for result in results.values()),
+            'sampled_frames': frame_count, 'detectors': results}, []
+
+
+def run_job(manifest, output_folder):
+    """Run one job through every pipeline stage in turn, timing each stage."""
+    import pipeline
+    from config import S3_CONFIG
+
+    s3 = _install_stubs(manifest)
+    S3_CONFIG['bucket_name'] = BUCKET
+
+    job = {'account_id': 'benchmark', 'year': 2024}
+    stage_times = {}
+    start = time.perf_counter()
+    for name, fn, _ in pipeline.REEL_STAGES:
+        stage_start = time.perf_counter()
+        job = fn(job)
+        stage_times[name] = time.perf_counter() - stage_start
+        if job.get('skip'):
+            raise RuntimeError(f"Job skipped in stage {name}")
+    wall_time = time.perf_counter() - start
+
+    # Pull the uploaded reel back out of the stand-in so it can be measured like the other stages
+    output_path = os.path.join(output_folder, 'job.mp4')
+    s3.download_file(BUCKET, job['s3_key'], output_path)
+    return {'wall_time_s': wall_time, 'stage_times_s': stage_times}, [output_path]
+
+
+STAGE_RUNNERS = {'images': run_images, 'extract': run_extract, 'reel': run_reel, 'renditions': run_renditions,
+                 'encode': run_encode, 'detectors': run_detectors, 'job': run_job}
+
+
+def run_stage(stage, manifest_path, result_path, yolo_dir=None):
+    """Entry point of the stage subprocess."""
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    import metrics
+    from config import APP_CONFIG
+    from cpu_budget import apply_cpu_budget
+    apply_cpu_budget()
+    os.makedirs(APP_CONFIG['temp_folder'], exist_ok=True)
+    from model_registry import FACE_DNN_MODEL, YOLO_MODELS
+    for name, (cfg_name, weights_name) in YOLO_MODELS.items():
+        cfg_path = os.path.join(APP_CONFIG['temp_folder'], cfg_name)
+        weights_path = os.path.join(APP_CONFIG['temp_folder'], weights_name)
+        if os.path.exists(weights_path):
+            continue
+        if yolo_dir:
+            # Only YOLOv3 is required; other networks are benchmarked when their files are there
+            if name == 'yolov3' or os.path.exists(os.path.join(yolo_dir, weights_name)):
+                shutil.copyfile(os.path.join(yolo_dir, cfg_name), cfg_path)
+                os.symlink(os.path.abspath(os.path.join(yolo_dir, weights_name)), weights_path)
+        else:
+            write_synthetic_yolo(cfg_path, weights_path)
+    for filename in FACE_DNN_MODEL:
+        path = os.path.join(APP_CONFIG['temp_folder'], filename)
+        if yolo_dir and os.path.exists(os.path.join(yolo_dir, filename)) and not os.path.exists(path):
+            os.symlink(os.path.abspath(os.path.join(yolo_dir, filename)), path)
+
+    # Sub-segment durations are drawn at random; fix them so runs are comparable
+    np.random.seed(0)
+    output_folder = os.path.abspath(os.path.join('output', stage))
+    os.makedirs(output_folder, exist_ok=True)
+
+    cpu_start = os.times()
+    result, outputs = STAGE_RUNNERS[stage](manifest, output_folder)
+    cpu_end = os.times()
+
+    frames = sum(count_frames(path) for path in outputs if os.path.exists(path))
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result.update({
+        'frames': frames,
+        'fps': frames / result['wall_time_s'] if result['wall_time_s'] else None,
+        'cpu_time_s': (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+                      + (cpu_end.children_user - cpu_start.children_user)
+                      + (cpu_end.children_system - cpu_start.children_system),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': self_usage.ru_maxrss / 1024,
+        'children_peak_rss_mb': children_usage.ru_maxrss / 1024,
+        'output_bytes': sum(os.path.getsize(path) for path in outputs if os.path.exists(path)),
+        'outputs': len(outputs),
+        'counters': metrics.registry.snapshot()['counters'],
+    })
+    with open(result_path, 'w') as f:
+        json.dump(result, f)
+
+
+# --- Driver ---
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _run_in_subprocess(stage, workdir, manifest_path, yolo_dir, verbose):
+    result_path = os.path.join(workdir, f"result_{stage}.json")
+    cmd = [sys.executable, os.path.abspath(__file__), '--run-stage', stage, '--manifest', manifest_path,
+           '--result', result_path]
+    if yolo_dir:
+        cmd.extend(['--yolo-dir', os.path.abspath(yolo_dir)])
+    output = None if verbose else subprocess.DEVNULL
+    completed = subprocess.run(cmd, cwd=workdir, stdout=output, stderr=None if verbose else subprocess.PIPE)
+    if completed.returncode != 0:
+        message = completed.stderr.decode(errors='replace')[-2000:] if completed.stderr else ''
+        raise RuntimeError(f"Stage {stage} failed with code {completed.returncode}: {message}")
+    with open(result_path) as f:
+        return json.load(f)
+
+
+def _summarize(runs):
+    """Median timings and the worst peak memory over repeated runs."""
+    summary = dict(runs[len(runs) // 2])
+    summary['wall_time_s'] = statistics.median(run['wall_time_s'] for run in runs)
+    summary['fps'] = summary['frames'] / summary['wall_time_s'] if summary['wall_time_s'] else None
+    summary['cpu_time_s'] = statistics.median(run['cpu_time_s'] for run in runs)
+    summary['peak_rss_mb'] = max(run['peak_rss_mb'] for run in runs)
+    summary['children_peak_rss_mb'] = max(run['children_peak_rss_mb'] for run in runs)
+    if 'stage_times_s' in summary:
+        summary['stage_times_s'] = {name: statistics.median(run['stage_times_s'][name] for run in runs)
+                                    for name in summary['stage_times_s']}
+    if 'profiles' in summary:
+        profiles = {}
+        for name, profile in summary['profiles'].items():
+            wall_time = statistics.median(run['profiles'][name]['wall_time_s'] for run in runs)
+            profiles[name] = dict(profile, wall_time_s=wall_time, encode_fps=profile['encode_fps']
+                                  * profile['wall_time_s'] / wall_time)
+        summary['profiles'] = profiles
+    if 'detectors' in summary:
+        detectors = {}
+        for name, detector in summary['detectors'].items():
+            if 'error' not in detector:
+                wall_time = statistics.median(run['detectors'][name]['wall_time_s'] for run in runs)
+                detector = dict(detector, wall_time_s=wall_time, frame_ms=detector['frame_ms'] * wall_time
+                                / detector['wall_time_s'] if detector['wall_time_s'] else detector['frame_ms'])
+            detectors[name] = detector
+        summary['detectors'] = detectors
+    summary['runs'] = [run['wall_time_s'] for run in runs]
+    return summary
+
+
+def compare(results, baseline, threshold):
+    """
+    Print wall time and peak RSS against a baseline report.
+
+    :return: List of (scenario, stage) whose wall time grew by more than ``threshold``
+    """
+    previous = {(r['scenario'], r['stage']): r for r in baseline['results']}
+    regressions = []
+    print(f"\n{'scenario':<10} {'stage':<8} {'wall s':>9} {'base s':>9} {'change':>8} {'rss MB':>8} {'base MB':>8}")
+    for result in results:
+        key = (result['scenario'], result['stage'])
+        if key not in previous or 'error' in result or 'error' in previous[key]:
+            continue
+        base = previous[key]
+        change = result['wall_time_s'] / base['wall_time_s'] - 1
+        print(f"{key[0]:<10} {key[1]:<8} {result['wall_time_s']:>9.2f} {base['wall_time_s']:>9.2f} "
+              f"{change:>+8.1%} {result['peak_rss_mb']:>8.0f} {base['peak_rss_mb']:>8.0f}")
+        if change > threshold:
+            regressions.append(key)
+    return regressions
+
+
+def main(argv=None):
+    from cpu_budget import available_cpus
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenarios', default='small,mixed',
+                        help=f"Comma-separated scenarios to run: {', '.join(SCENARIOS)}")
+    parser.add_argument('--stages', default=','.join(STAGES), help="Comma-separated stages to run")
+    parser.add_argument('--repeat', type=int, default=1, help="Runs per stage; the median wall time is reported")
+    parser.add_argument('--output', help="Write the JSON report to this file")
+    parser.add_argument('--compare', help="Baseline JSON report to compare against")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="Relative wall time increase reported as a regression")
+    parser.add_argument('--yolo-dir', help="Folder with yolov3.cfg and yolov3.weights; a synthetic network otherwise")
+    parser.add_argument('--workdir', help="Keep media and outputs in this folder instead of a temporary one")
+    parser.add_argument('--verbose', action='store_true', help="Show the output of the stage subprocesses")
+    parser.add_argument('--run-stage', help=argparse.SUPPRESS)
+    parser.add_argument('--manifest', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_stage:
+        run_stage(args.run_stage, args.manifest, args.result, args.yolo_dir)
+        return 0
+
+    scenarios = args.scenarios.split(',')
+    stages = args.stages.split(',')
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"Unknown scenario: {name}")
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f"Unknown stage: {stage}")
+
+    root = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='reel-benchmark-')
+    results = []
+    try:
+        for name in scenarios:
+            media_folder = os.path.join(root, name, 'media')
+            manifest_path = os.path.join(media_folder, 'manifest.json')
+            if not os.path.exists(manifest_path):
+                print(f"Synthesizing media for scenario {name}")
+                synthesize_scenario(name, media_folder)
+
+            for stage in stages:
+                runs = []
+                try:
+                    for repetition in range(args.repeat):
+                        # A fresh working directory per run, so caches start cold every time
+                        workdir = os.path.join(root, name, f"{stage}_{repetition}")
+                        shutil.rmtree(workdir, ignore_errors=True)
+                        os.makedirs(workdir)
+                        runs.append(_run_in_subprocess(stage, workdir, manifest_path, args.yolo_dir, args.verbose))
+                    result = _summarize(runs)
+                    print(f"{name:<10} {stage:<8} {result['wall_time_s']:8.2f}s {result['fps'] or 0:8.1f} fps "
+                          f"{result['peak_rss_mb']:8.0f} MB {result['output_bytes'] / 1024 ** 2:8.2f} MB out")
+                    for profile, encoded in result.get('profiles', {}).items():
+                        print(f"{'':<10} {profile:<8} {encoded['wall_time_s']:8.2f}s {encoded['encode_fps']:8.1f} fps "
+                              f"{'':>11} {encoded['output_bytes'] / 1024 ** 2:8.2f} MB out")
+                    for detector, measured in result.get('detectors', {}).items():
+                        if 'error' in measured:
+                            print(f"{'':<10} {detector:<16} {measured['error']}")
+                            continue
+                        print(f"{'':<10} {detector:<16} {measured['frame_ms']:8.2f} ms/frame "
+                              f"{measured['hit_frames']:5d} hits {measured['frame_agreement']:7.1%} frames "
+                              f"{measured['first_hit_agreement']:7.1%} first hits agree")
+                except RuntimeError as e:
+                    print(f"{name:<10} {stage:<8} failed: {str(e)}")
+                    result = {'error': str(e)}
+                results.append({'scenario': name, 'stage': stage, **result})
+    finally:
+        if not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'available_cpus': available_cpus(),
+            'detector': 'yolov3' if args.yolo_dir else 'synthetic',
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('detector') != report['meta']['detector']:
+            print("Warning: the baseline was run with a different detector")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"Regressions over {args.threshold:.0%}: {', '.join('/'.join(key) for key in regressions)}")
+            return 1
+    return 1 if any('error' in result for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
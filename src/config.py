@@ -1,5 +1,6 @@
 import os
 from dotenv import load_dotenv
+from cpu_budget import available_cpus
 
 # Load environment variables from .env file
 load_dotenv()
@@ -11,14 +12,148 @@ DB_CONFIG = {
     'password': os.getenv('DB_PASSWORD')
 }
 
+DB_POOL_CONFIG = {
+    # Connections kept open per process, and the most a process may open at once
+    'min_connections': int(os.getenv('DB_POOL_MIN_CONNECTIONS', '1')),
+    'max_connections': int(os.getenv('DB_POOL_MAX_CONNECTIONS', '5'))
+}
+
 S3_CONFIG = {
     'aws_access_key_id': os.getenv('AWS_ACCESS_KEY_ID'),
     'aws_secret_access_key': os.getenv('AWS_SECRET_ACCESS_KEY'),
     'region_name': os.getenv('AWS_REGION'),
-    'bucket_name': os.getenv('S3_BUCKET_NAME')
+    'bucket_name': os.getenv('S3_BUCKET_NAME'),
+    # Connections kept open by the shared client; should cover download_concurrency
+    'max_pool_connections': int(os.getenv('S3_MAX_POOL_CONNECTIONS', '32')),
+    'download_concurrency': int(os.getenv('S3_DOWNLOAD_CONCURRENCY', '8')),
+    'download_retries': int(os.getenv('S3_DOWNLOAD_RETRIES', '3')),
+    # Stream the reel to S3 as a multipart upload while it is encoded instead of uploading the finished file
+    'stream_upload': os.getenv('S3_STREAM_UPLOAD', 'false').lower() == 'true',
+    # S3 requires every part but the last to be at least 5MB
+    'multipart_part_size': max(5 * 1024 ** 2, int(os.getenv('S3_MULTIPART_PART_SIZE', str(8 * 1024 ** 2)))),
+    'multipart_concurrency': int(os.getenv('S3_MULTIPART_CONCURRENCY', '4'))
 }
 app_env = os.getenv('APP_ENV')
 APP_CONFIG = {
     'app_env': app_env,
-    'temp_folder': '/tmp' if app_env in ['production', 'staging'] else 'temp'
+    'temp_folder': '/tmp' if app_env in ['production', 'staging'] else 'temp',
+    # Load detector models when the worker starts instead of on its first job
+    'prewarm_models': os.getenv('PREWARM_MODELS', 'false').lower() == 'true',
+    'log_level': os.getenv('LOG_LEVEL', 'INFO').upper()
+}
+
+CPU_CONFIG = {
+    # CPUs the worker may use; defaults to the container's CPU quota rather than the host's cores
+    'cpus': int(os.getenv('CPU_LIMIT', str(available_cpus()))),
+    # CPUs of each job (OpenCV threads, ffmpeg threads, face detection processes); 0 splits
+    # 'cpus' evenly between the jobs running at once
+    'job_cpus': int(os.getenv('JOB_CPUS', '0'))
+}
+
+MEDIA_CACHE_CONFIG = {
+    'folder': os.getenv('MEDIA_CACHE_DIR', os.path.join(APP_CONFIG['temp_folder'], 'media_cache')),
+    # Byte budget of the on-disk media cache; 0 disables it
+    'max_bytes': int(os.getenv('MEDIA_CACHE_MAX_BYTES', str(5 * 1024 ** 3))),
+    # Check the object's ETag with a HEAD request before using a cached copy
+    'validate_etag': os.getenv('MEDIA_CACHE_VALIDATE_ETAG', 'true').lower() == 'true'
+}
+
+SEGMENT_CACHE_CONFIG = {
+    'folder': os.getenv('SEGMENT_CACHE_DIR', os.path.join(APP_CONFIG['temp_folder'], 'segment_cache')),
+    # Byte budget of encoded reels, and rendered segment frames if enabled, kept on disk; 0 disables the cache
+    'max_bytes': int(os.getenv('SEGMENT_CACHE_MAX_BYTES', str(4 * 1024 ** 3))),
+    # Also keep the raw frames of every rendered segment, so a reel sharing media with a cached one only
+    # renders its new segments; raw frames take hundreds of MB per reel, so this is off by default
+    'frames': os.getenv('SEGMENT_CACHE_FRAMES', 'false').lower() == 'true'
+}
+
+RENDER_CONFIG = {
+    # Outputs encoded from one render of the reel, as name:WIDTHxHEIGHT:bitrate[:hls], comma separated.
+    # The first is the primary MP4 the account's video status points to
+    'renditions': os.getenv('REEL_RENDITIONS', 'main:480x480:5000k'),
+    'hls_segment_seconds': int(os.getenv('REEL_HLS_SEGMENT_SECONDS', '4'))
+}
+
+ENCODER_CONFIG = {
+    # Encoder profile of every reel, unless the job asks for one (see encoding.ENCODER_PROFILES)
+    'profile': os.getenv('ENCODER_PROFILE', 'balanced'),
+    # Threads of each ffmpeg encoder; 0 uses the job's CPU budget
+    'threads': int(os.getenv('ENCODER_THREADS', '0')),
+    # Pick a faster profile as the SQS backlog grows, from backlog:profile steps
+    'adaptive': os.getenv('ENCODER_ADAPTIVE', 'false').lower() == 'true',
+    'adaptive_steps': os.getenv('ENCODER_ADAPTIVE_STEPS', '0:balanced,20:fast,100:fastest'),
+    # Seconds a queue backlog reading is reused before SQS is asked again
+    'backlog_ttl': int(os.getenv('ENCODER_BACKLOG_TTL', '30'))
+}
+
+IMAGE_CONFIG = {
+    # Photos decoded, cropped and resized at the same time when a reel is prepared; 0 uses the job's CPU budget
+    'preprocess_workers': int(os.getenv('IMAGE_PREPROCESS_WORKERS', '0'))
+}
+
+DETECTION_CONFIG = {
+    # Which frames the people/face detectors look at: every_frame, stride, time or keyframe
+    'sampling_strategy': os.getenv('DETECTION_SAMPLING', 'time'),
+    'sample_stride': int(os.getenv('DETECTION_SAMPLE_STRIDE', '15')),
+    'samples_per_second': float(os.getenv('DETECTION_SAMPLES_PER_SECOND', '2')),
+    # Search the frames between the last miss and a hit for the earliest detection
+    'refine': os.getenv('DETECTION_REFINE', 'true').lower() == 'true',
+    # Save each video's segment while detection decodes it, so the render does not decode and seek it again
+    'keep_segment': os.getenv('DETECTION_KEEP_SEGMENT', 'true').lower() == 'true',
+    # Sampled frames run through YOLO together in one forward pass
+    'batch_size': int(os.getenv('DETECTION_BATCH_SIZE', '4')),
+    # Frames kept for refinement and handed to the face detectors are downscaled so their longest side is at most this
+    'max_side': int(os.getenv('DETECTION_MAX_SIDE', '640')),
+    # People detector: a Darknet YOLO network run with cv2.dnn (yolov3 or yolov3-tiny), and its input
+    # resolution in pixels, a multiple of 32
+    'people_detector': os.getenv('DETECTION_PEOPLE_DETECTOR', 'yolov3'),
+    'people_input_size': int(os.getenv('DETECTION_PEOPLE_INPUT_SIZE', '416')),
+    # Face detector run when no people are found: haar (cascade) or dnn (OpenCV's ResNet-10 SSD)
+    'face_detector': os.getenv('DETECTION_FACE_DETECTOR', 'haar'),
+    'face_confidence': float(os.getenv('DETECTION_FACE_CONFIDENCE', '0.5')),
+    # Seconds a video waits on the face detection pool (for a free frame slot, or for its frames to be
+    # checked) before giving up on faces, e.g. when a pool process was killed
+    'face_timeout': float(os.getenv('DETECTION_FACE_TIMEOUT', '30'))
+}
+
+ANALYSIS_CONFIG = {
+    # SQLite database of people/face detection results, keyed by video content and detector settings;
+    # empty to detect every time
+    'index_path': os.getenv('ANALYSIS_INDEX_PATH', os.path.join(APP_CONFIG['temp_folder'], 'analysis_index.sqlite3')),
+    # Videos the pre-analysis command downloads and analyzes at a time
+    'preanalyze_batch_size': int(os.getenv('ANALYSIS_PREANALYZE_BATCH_SIZE', '20'))
+}
+
+WORKER_CONFIG = {
+    # Jobs rendered at the same time, each in its own process
+    'concurrency': int(os.getenv('WORKER_CONCURRENCY', str(CPU_CONFIG['cpus']))),
+    # Visibility timeout of received messages, extended by a heartbeat while the job runs
+    'visibility_timeout': int(os.getenv('WORKER_VISIBILITY_TIMEOUT', '300')),
+    'heartbeat_interval': int(os.getenv('WORKER_HEARTBEAT_INTERVAL', '60')),
+    'wait_time_seconds': int(os.getenv('WORKER_WAIT_TIME_SECONDS', '20')),
+    # 'process' runs each job end to end in one process; 'pipeline' overlaps the stages of several jobs
+    'mode': os.getenv('WORKER_MODE', 'process'),
+    'queue_url': os.getenv('SQS_QUEUE_URL')
+}
+
+PIPELINE_CONFIG = {
+    # Threads per I/O-bound stage (database query, S3 download, S3 upload, status update)
+    'io_workers': int(os.getenv('PIPELINE_IO_WORKERS', '2')),
+    # Processes shared by the CPU-bound stages (detection and rendering)
+    'cpu_workers': int(os.getenv('PIPELINE_CPU_WORKERS', str(CPU_CONFIG['cpus']))),
+    # Jobs waiting in front of each stage before the previous stage blocks
+    'queue_size': int(os.getenv('PIPELINE_QUEUE_SIZE', '2'))
+}
+
+JOB_CONFIG = {
+    # Record completed stages of every job in S3 so a redelivered job resumes where it stopped
+    'checkpoints': os.getenv('JOB_CHECKPOINTS', 'true').lower() == 'true',
+    'manifest_prefix': os.getenv('JOB_MANIFEST_PREFIX', 'jobs')
+}
+
+METRICS_CONFIG = {
+    # Append one JSON line per job with its trace spans; unset to disable
+    'trace_file': os.getenv('METRICS_TRACE_FILE'),
+    # Folder each process writes its Prometheus metrics to, for the node exporter textfile collector
+    'prometheus_dir': os.getenv('METRICS_PROMETHEUS_DIR')
 }
@@ -0,0 +1,80 @@
+import logging
+import os
+
+import cv2
+
+logger = logging.getLogger(__name__)
+
+# cgroup v2 exposes "<quota> <period>" (or "max <period>") in one file; v1 splits them
+_CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+_CGROUP_V1_FOLDERS = ['/sys/fs/cgroup/cpu,cpuacct', '/sys/fs/cgroup/cpu']
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def cgroup_cpu_limit():
+    """Return the CPU quota of this process's cgroup in CPUs (e.g. 1.5), or None if unlimited."""
+    try:
+        quota, period = _read(_CGROUP_V2_CPU_MAX).split()[:2]
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    for folder in _CGROUP_V1_FOLDERS:
+        try:
+            quota = int(_read(os.path.join(folder, 'cpu.cfs_quota_us')))
+            period = int(_read(os.path.join(folder, 'cpu.cfs_period_us')))
+        except (OSError, ValueError):
+            continue
+        return None if quota <= 0 or period <= 0 else quota / period
+    return None
+
+
+def available_cpus():
+    """
+    Return the number of CPUs this process can actually use.
+
+    That is the CPUs it may be scheduled on, capped by the container's CPU quota: a container
+    limited to 2 CPUs on a 64-core host gets 2, where ``os.cpu_count()`` says 64. A fractional
+    quota is rounded down, to at least one CPU.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, int(limit)))
+    return cpus
+
+
+def job_cpus():
+    """
+    Return the CPUs each job may use, so jobs running at the same time do not oversubscribe the host.
+
+    Defaults to CPU_CONFIG['cpus'] split evenly between the jobs the worker runs at once: its
+    concurrency in process mode, the CPU-bound stage processes in pipeline mode.
+    """
+    from config import CPU_CONFIG, WORKER_CONFIG, PIPELINE_CONFIG
+
+    if CPU_CONFIG['job_cpus']:
+        return CPU_CONFIG['job_cpus']
+    jobs = PIPELINE_CONFIG['cpu_workers'] if WORKER_CONFIG['mode'] == 'pipeline' else WORKER_CONFIG['concurrency']
+    return max(1, CPU_CONFIG['cpus'] // max(1, jobs))
+
+
+def apply_cpu_budget(cpus=None):
+    """
+    Limit the threads OpenCV uses in this process, including DNN inference, to a job's budget.
+
+    Used as the initializer of the processes jobs run in. The other consumers (ffmpeg's
+    ``-threads``, the face detection pool, image preprocessing) read ``job_cpus`` themselves.
+
+    :param cpus: Threads to allow, defaults to ``job_cpus()``
+    """
+    cpus = cpus or job_cpus()
+    cv2.setNumThreads(cpus)
+    logger.debug(f"Process {os.getpid()} limited to {cpus} CPU threads")
+    return cpus
@@ -1,5 +1,9 @@
+import os
+import threading
+from contextlib import contextmanager
 import psycopg2
-from config import DB_CONFIG
+from psycopg2.pool import ThreadedConnectionPool
+from config import DB_CONFIG, DB_POOL_CONFIG
 
 
 def get_db_connection():
@@ -22,17 +26,125 @@ def get_db_connection():
             conn.close()
 
 
-def execute_query(query, params=None):
-    """Execute a database query and return the results."""
-    conn = None
+_pool = None
+_pool_pid = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """Return the connection pool of this process, creating it on first use."""
+    global _pool, _pool_pid, _pool_slots
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                print(f"Creating connection pool for {DB_CONFIG['host']}...")
+                _pool = ThreadedConnectionPool(DB_POOL_CONFIG['min_connections'], DB_POOL_CONFIG['max_connections'],
+                                               **DB_CONFIG)
+                # ThreadedConnectionPool raises when exhausted; make callers wait for a free connection instead
+                _pool_slots = threading.BoundedSemaphore(DB_POOL_CONFIG['max_connections'])
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
     try:
-        conn = get_db_connection()
         with conn.cursor() as cur:
-            cur.execute(query, params)
-            return cur.fetchall()
-    except Exception as e:
-        print(f"Error executing query: {e}")
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _checkout(pool):
+    # Every idle connection may be stale (e.g. after a database restart), so try them all
+    for _ in range(DB_POOL_CONFIG['max_connections'] + 1):
+        conn = pool.getconn()
+        if _is_healthy(conn):
+            return conn
+        print("Discarding broken pooled database connection")
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError("Could not get a working database connection from the pool")
+
+
+@contextmanager
+def pooled_connection():
+    """
+    Check out a healthy connection from the pool for the duration of a block.
+
+    The transaction is committed when the block succeeds and rolled back when it raises.
+    Broken connections are closed instead of being returned to the pool.
+    """
+    pool = get_connection_pool()
+    slots = _pool_slots
+    slots.acquire()
+    conn = None
+    try:
+        conn = _checkout(pool)
+        yield conn
+        conn.commit()
+    except Exception:
+        if conn is not None and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                conn.close()
         raise
     finally:
-        if conn is not None and not conn.closed:
-            conn.close()
\ No newline at end of file
+        if conn is not None:
+            pool.putconn(conn, close=bool(conn.closed))
+        slots.release()
+
+
+def _fetch(cur):
+    return cur.fetchall() if cur.description is not None else None
+
+
+def execute_queries(statements):
+    """
+    Execute several statements on one pooled connection, in a single transaction.
+
+    :param statements: List of (query, params) tuples
+    :return: List with the rows returned by each statement (None for statements without results)
+    """
+    try:
+        with pooled_connection() as conn:
+            results = []
+            with conn.cursor() as cur:
+                for query, params in statements:
+                    cur.execute(query, params)
+                    results.append(_fetch(cur))
+            return results
+    except Exception as e:
+        print(f"Error executing queries: {e}")
+        raise
+
+
+def execute_query(query, params=None):
+    """
+    Execute a database query and return the results.
+
+    A connection that fails before the statement is sent is replaced once. Errors from the
+    statement itself, or from its commit, are raised as is: a write may already have been
+    applied, and cancellations and timeouts would only fail again.
+    """
+    for attempt in range(2):
+        sent = False
+        try:
+            with pooled_connection() as conn:
+                with conn.cursor() as cur:
+                    sent = True
+                    cur.execute(query, params)
+                    return _fetch(cur)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if attempt == 0 and not sent:
+                print(f"Database connection lost, retrying query: {e}")
+                continue
+            print(f"Error executing query: {e}")
+            raise
+        except Exception as e:
+            print(f"Error executing query: {e}")
+            raise
@@ -0,0 +1,153 @@
+import cv2
+import numpy as np
+from model_registry import get_yolo_model, get_face_cascade, get_face_net
+from metrics import incr
+from config import DETECTION_CONFIG
+
+
+class PeopleDetector:
+    """Find people in batches of frames."""
+
+    name = None
+
+    def detect(self, frames, confidence_threshold=0.5):
+        """
+        :param frames: List of BGR frames, which may differ in size
+        :return: List with one (boxes, confidences) tuple per frame
+        """
+        raise NotImplementedError
+
+
+class YoloPeopleDetector(PeopleDetector):
+    """
+    A Darknet YOLO network run with ``cv2.dnn``, all frames of a batch in one forward pass.
+
+    :param model: One of ``model_registry.YOLO_MODELS``
+    :param input_size: Side of the square network input, a multiple of 32; smaller is faster but
+                       misses smaller people
+    """
+
+    def __init__(self, model='yolov3', input_size=416, nms_threshold=0.4):
+        self.name = model
+        self.input_size = input_size
+        self.nms_threshold = nms_threshold
+        self.net, self.ln = get_yolo_model(model)
+
+    def detect(self, frames, confidence_threshold=0.5):
+        blob = cv2.dnn.blobFromImages(frames, 1 / 255.0, (self.input_size, self.input_size), swapRB=True, crop=False)
+        self.net.setInput(blob)
+        layerOutputs = self.net.forward(self.ln)
+        incr('reel_detector_forward_passes_total', detector='yolo')
+        incr('reel_detector_frames_total', len(frames), detector='yolo')
+
+        # Stack the outputs of every YOLO layer into one (frames, detections, 5 + classes) array
+        detections = np.concatenate([output.reshape(len(frames), -1, output.shape[-1]) for output in layerOutputs],
+                                    axis=1)
+        scores = detections[:, :, 5:]
+        class_ids = scores.argmax(axis=2)
+        confidences = np.take_along_axis(scores, class_ids[:, :, None], axis=2)[:, :, 0]
+        mask = (class_ids == 0) & (confidences > confidence_threshold)  # 0 is the class ID for person
+
+        results = []
+        for frame, frame_detections, frame_confidences, frame_mask in zip(frames, detections, confidences, mask):
+            if not frame_mask.any():
+                results.append(([], []))
+                continue
+
+            (H, W) = frame.shape[:2]
+            box = (frame_detections[frame_mask, 0:4] * np.array([W, H, W, H])).astype("int")
+            centerX, centerY, width, height = box.T
+            boxes = np.stack([(centerX - width / 2).astype("int"), (centerY - height / 2).astype("int"), width,
+                              height], axis=1).tolist()
+            frame_confidences = frame_confidences[frame_mask].astype(float).tolist()
+
+            keep = np.array(cv2.dnn.NMSBoxes(boxes, frame_confidences, confidence_threshold,
+                                             self.nms_threshold)).flatten()
+            results.append(([boxes[k] for k in keep], [frame_confidences[k] for k in keep]))
+
+        return results
+
+
+class FaceDetector:
+    """
+    Count the faces in a single frame.
+
+    ``channels`` is the number of channels of the frames the detector takes: 1 for grayscale,
+    3 for BGR.
+    """
+
+    name = None
+    channels = 1
+
+    def load(self):
+        """Load the model now rather than on the first frame."""
+
+    def detect(self, image, min_size=(30, 30)):
+        """
+        :param min_size: (width, height) of the smallest face counted
+        :return: Number of faces found
+        """
+        raise NotImplementedError
+
+
+class HaarFaceDetector(FaceDetector):
+    """OpenCV's frontal face Haar cascade, on grayscale frames."""
+
+    name = 'haar'
+    channels = 1
+
+    def load(self):
+        get_face_cascade()
+
+    def detect(self, image, min_size=(30, 30)):
+        return len(get_face_cascade().detectMultiScale(image, scaleFactor=1.1, minNeighbors=5, minSize=min_size))
+
+
+class DnnFaceDetector(FaceDetector):
+    """OpenCV's ResNet-10 SSD face detector, on BGR frames scaled to its 300x300 input."""
+
+    name = 'dnn'
+    channels = 3
+    input_size = 300
+
+    def __init__(self, confidence_threshold=0.5):
+        self.confidence_threshold = confidence_threshold
+
+    def load(self):
+        get_face_net()
+
+    def detect(self, image, min_size=(30, 30)):
+        net = get_face_net()
+        h, w = image.shape[:2]
+        net.setInput(cv2.dnn.blobFromImage(image, 1.0, (self.input_size, self.input_size), (104.0, 177.0, 123.0)))
+        detections = net.forward()[0, 0]
+        detections = detections[detections[:, 2] > self.confidence_threshold]
+        widths = (detections[:, 5] - detections[:, 3]) * w
+        heights = (detections[:, 6] - detections[:, 4]) * h
+        return int(np.count_nonzero((widths >= min_size[0]) & (heights >= min_size[1])))
+
+
+def make_people_detector(name=None, input_size=None):
+    """
+    Build the people detector configured for this deployment.
+
+    :param name: One of ``model_registry.YOLO_MODELS``; defaults to DETECTION_CONFIG['people_detector']
+    :param input_size: Network input side; defaults to DETECTION_CONFIG['people_input_size']
+    """
+    return YoloPeopleDetector(name or DETECTION_CONFIG['people_detector'],
+                              input_size or DETECTION_CONFIG['people_input_size'])
+
+
+def make_face_detector(name=None):
+    """
+    Build the face detector configured for this deployment.
+
+    :param name: 'haar' or 'dnn'; defaults to DETECTION_CONFIG['face_detector']
+    """
+    name = name or DETECTION_CONFIG['face_detector']
+    if name == 'haar':
+        return HaarFaceDetector()
+    if name == 'dnn':
+        return DnnFaceDetector(DETECTION_CONFIG['face_confidence'])
+
+    raise ValueError(f"Unknown face detector: {name}")
@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+from cpu_budget import job_cpus
+from metrics import incr
+from config import ENCODER_CONFIG, WORKER_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Named x264 settings for the reel encoders. With 'crf' the encoder targets a constant quality
+# and the rendition's bitrate only caps it; without, the bitrate is the average target. 'gop' is
+# the keyframe interval in frames, None for x264's default.
+ENCODER_PROFILES = {
+    # The settings reels were always encoded with
+    'balanced': {'codec': 'libx264', 'preset': 'medium', 'crf': None, 'tune': None, 'gop': None},
+    'quality': {'codec': 'libx264', 'preset': 'slow', 'crf': 20, 'tune': 'film', 'gop': 48},
+    'fast': {'codec': 'libx264', 'preset': 'veryfast', 'crf': 23, 'tune': None, 'gop': 48},
+    'fastest': {'codec': 'libx264', 'preset': 'ultrafast', 'crf': 25, 'tune': None, 'gop': 48},
+}
+
+_backlog = None
+_backlog_time = None
+_backlog_lock = threading.Lock()
+
+
+def get_profile(name=None):
+    """
+    Return the encoder settings of a profile, ready to pass to ``FFmpegPipeWriter``.
+
+    :param name: Profile name, defaults to ENCODER_CONFIG['profile']
+    :raises ValueError: If there is no such profile
+    """
+    name = name or ENCODER_CONFIG['profile']
+    if name not in ENCODER_PROFILES:
+        raise ValueError(f"Unknown encoder profile: {name}")
+    return dict(ENCODER_PROFILES[name], threads=ENCODER_CONFIG['threads'] or job_cpus())
+
+
+def queue_backlog():
+    """
+    Return the approximate number of messages waiting in the job queue, or None if unknown.
+
+    The reading is shared by the whole process and refreshed at most every
+    ENCODER_CONFIG['backlog_ttl'] seconds.
+    """
+    global _backlog, _backlog_time
+    if not WORKER_CONFIG['queue_url']:
+        return None
+    with _backlog_lock:
+        if _backlog_time is None or time.monotonic() - _backlog_time >= ENCODER_CONFIG['backlog_ttl']:
+            from worker import get_sqs_client
+            try:
+                response = get_sqs_client().get_queue_attributes(QueueUrl=WORKER_CONFIG['queue_url'],
+                                                                 AttributeNames=['ApproximateNumberOfMessages'])
+                _backlog = int(response['Attributes']['ApproximateNumberOfMessages'])
+            except Exception as e:
+                logger.warning(f"Could not read the queue backlog: {str(e)}")
+                _backlog = None
+            _backlog_time = time.monotonic()
+        return _backlog
+
+
+def _adaptive_steps(spec):
+    steps = []
+    for entry in spec.split(','):
+        threshold, name = entry.strip().split(':')
+        steps.append((int(threshold), name))
+    return sorted(steps)
+
+
+def select_profile(requested=None):
+    """
+    Pick the encoder profile of a job.
+
+    A profile requested by the job wins. Otherwise, in adaptive mode, the profile of the highest
+    ENCODER_CONFIG['adaptive_steps'] threshold the queue backlog has reached is used, so reels
+    are encoded faster while jobs pile up; without a backlog reading the configured profile is.
+
+    :return: Profile name
+    """
+    name = requested
+    if name is None and ENCODER_CONFIG['adaptive']:
+        backlog = queue_backlog()
+        if backlog is not None:
+            for threshold, step in _adaptive_steps(ENCODER_CONFIG['adaptive_steps']):
+                if backlog >= threshold:
+                    name = step
+            logger.debug(f"Queue backlog {backlog}: encoder profile {name}")
+    name = name or ENCODER_CONFIG['profile']
+    incr('reel_encoder_profile_total', profile=name)
+    return name
@@ -0,0 +1,257 @@
+import functools
+import logging
+import os
+import queue
+import threading
+import weakref
+from multiprocessing import Pool, shared_memory, util
+
+import cv2
+import numpy as np
+from cpu_budget import apply_cpu_budget, job_cpus
+from detectors import make_face_detector
+from metrics import incr
+from config import DETECTION_CONFIG
+
+# Frames are handed to the workers as downscaled images, grayscale or BGR as the face detector
+# takes them, in a ring of shared memory slots. A slot is only reused once the worker that read it has finished, so the number of
+# slots bounds both memory and the number of frames in flight.
+SLOTS_PER_PROCESS = 2
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+_shm = None
+_slot_bytes = None
+_free_slots = None
+_channels = None
+_cleanup_pid = None
+_streams = weakref.WeakSet()
+
+_worker_shm = None
+_worker_detector = None
+
+
+def _init_worker(shm_name, detector_name):
+    """Attach the shared frame buffer and load the face detector once per worker process."""
+    global _worker_shm, _worker_detector
+    # The pool's processes already share the job's CPUs, so each runs the detector on one thread
+    apply_cpu_budget(1)
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_detector = make_face_detector(detector_name)
+    _worker_detector.load()
+
+
+def _detect_faces_in_slot(offset, shape, frame_number, fps, min_size):
+    image = np.ndarray(shape, dtype=np.uint8, buffer=_worker_shm.buf, offset=offset)
+    faces = _worker_detector.detect(image, min_size)
+    if faces > 0:
+        return frame_number, frame_number / fps, f"Faces detected: {faces}"
+    return None
+
+
+def _shutdown():
+    """Stop the pool of this process and unlink its frame buffer."""
+    global _pool, _shm
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.terminate()
+        _pool.join()
+        _shm.close()
+        _shm.unlink()
+    _pool = None
+    _shm = None
+
+
+def _retire_pool(pool):
+    """
+    Stop using a pool that lost a task, e.g. to a worker killed by the OOM killer.
+
+    A lost task never releases its frame slot, so the pool and its frame buffer are replaced by
+    new ones on the next ``get_face_pool``. Streams still using the old pool give up right away
+    instead of each waiting out its own timeout.
+    """
+    global _pool, _shm
+    with _lock:
+        if _pool is not pool:
+            return
+        shm, _pool, _shm = _shm, None, None
+        streams = [stream for stream in _streams if stream.pool is pool]
+    logging.warning("Restarting the face detection pool")
+    for stream in streams:
+        stream._pool_retired()
+    pool.terminate()
+    # Other streams may still hold the buffer mapped; unlinking only removes its name
+    shm.unlink()
+
+
+def get_face_pool():
+    """
+    Return the process-wide face detection pool, creating it on first use.
+
+    The pool has one process per CPU of the job's budget (see ``cpu_budget.job_cpus``) and runs
+    the face detector named by DETECTION_CONFIG['face_detector'].
+
+    :return: Tuple of (pool, shared_memory, slot_bytes, free_slots, channels)
+    """
+    global _pool, _pool_pid, _shm, _slot_bytes, _free_slots, _channels, _cleanup_pid
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            processes = job_cpus()
+            detector_name = DETECTION_CONFIG['face_detector']
+            _channels = make_face_detector(detector_name).channels
+            max_side = DETECTION_CONFIG['max_side']
+            _slot_bytes = max_side * max_side * _channels
+            slots = processes * SLOTS_PER_PROCESS
+            _shm = shared_memory.SharedMemory(create=True, size=_slot_bytes * slots)
+            _free_slots = queue.Queue()
+            for slot in range(slots):
+                _free_slots.put(slot)
+            _pool = Pool(processes=processes, initializer=_init_worker, initargs=(_shm.name, detector_name))
+            _pool_pid = os.getpid()
+            if _cleanup_pid != _pool_pid:
+                # Unlike atexit handlers, multiprocessing finalizers also run when a job process of a
+                # Pool or ProcessPoolExecutor exits; run before the pool's own finalizer (priority 15)
+                util.Finalize(None, _shutdown, exitpriority=20)
+                _cleanup_pid = _pool_pid
+            logging.info(f"Face detection pool started with {processes} {detector_name} processes "
+                         f"and {slots} frame slots")
+    return _pool, _shm, _slot_bytes, _free_slots, _channels
+
+
+class FaceDetectionStream:
+    """
+    Stream frames of one video through the shared face detection pool.
+
+    Frames must be submitted in increasing frame order. Once a frame with faces is found no
+    further frames are accepted, since they cannot be earlier than that hit.
+
+    If no frame slot frees up, or the submitted frames are not all checked, within ``timeout``
+    seconds the stream gives up: ``abandoned`` is set, further frames are ignored and
+    ``result`` returns None.
+    """
+
+    def __init__(self, fps, min_size=(30, 30), timeout=None):
+        self.fps = fps
+        self.min_size = min_size
+        self.timeout = timeout or DETECTION_CONFIG['face_timeout']
+        self.abandoned = False
+        self.retired = False
+        self.pool, self.shm, self.slot_bytes, self.free_slots, self.channels = get_face_pool()
+        self.max_side = int(np.sqrt(self.slot_bytes // self.channels))
+        self.hits = []
+        self.pending = set()  # Frame numbers submitted and not checked yet
+        self.condition = threading.Condition()
+        with _lock:
+            _streams.add(self)
+
+    @property
+    def stopped(self):
+        return bool(self.hits) or self.abandoned or self.retired
+
+    def _give_up(self, reason):
+        if not self.abandoned:
+            logging.warning(f"Giving up on face detection: {reason}")
+            incr('reel_face_detection_abandoned_total')
+            self.abandoned = True
+        _retire_pool(self.pool)
+
+    def _pool_retired(self):
+        with self.condition:
+            self.retired = True
+            self.condition.notify_all()
+        # Wake a submit waiting for a slot of the old pool
+        self.free_slots.put(None)
+
+    def submit(self, frame, frame_number):
+        """Queue a BGR frame for face detection, blocking while all slots are in use."""
+        if self.stopped:
+            return
+
+        h, w = frame.shape[:2]
+        scale = min(1.0, self.max_side / max(h, w))
+        size = (max(1, int(w * scale)), max(1, int(h * scale)))
+        min_size = tuple(max(1, int(round(side * scale))) for side in self.min_size)
+
+        shape = (size[1], size[0]) if self.channels == 1 else (size[1], size[0], self.channels)
+        try:
+            slot = self.free_slots.get(timeout=self.timeout)
+        except queue.Empty:
+            self._give_up(f"no frame slot freed up in {self.timeout:g}s")
+            return
+        if slot is None or self.retired:
+            self._give_up("the pool was restarted")
+            return
+        offset = slot * self.slot_bytes
+        image = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+        small = frame if scale == 1.0 else cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if self.channels == 1:
+            cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=image)
+        else:
+            image[:] = small
+        del image
+
+        with self.condition:
+            self.pending.add(frame_number)
+        incr('reel_detector_forward_passes_total', detector='face')
+        incr('reel_detector_frames_total', detector='face')
+        try:
+            self.pool.apply_async(_detect_faces_in_slot, (offset, shape, frame_number, self.fps, min_size),
+                                  callback=functools.partial(self._on_done, slot, frame_number),
+                                  error_callback=functools.partial(self._on_error, slot, frame_number))
+        except ValueError:
+            # The pool was restarted by another stream
+            self._on_done(slot, frame_number, None)
+            self._give_up("the pool was restarted")
+
+    def _on_done(self, slot, frame_number, result):
+        self.free_slots.put(slot)
+        with self.condition:
+            if result is not None:
+                self.hits.append(result)
+            self.pending.discard(frame_number)
+            self.condition.notify_all()
+
+    def _on_error(self, slot, frame_number, error):
+        logging.error(f"Face detection failed: {str(error)}")
+        self._on_done(slot, frame_number, None)
+
+    def earliest_pending(self):
+        """Return the earliest frame number submitted and not checked yet, or None."""
+        with self.condition:
+            return min(self.pending) if self.pending else None
+
+    def settled_hit(self):
+        """
+        Return the earliest frame with faces if every earlier frame has been checked, without waiting.
+
+        :return: Tuple of (frame_number, time, reason), or None if there is no such hit yet
+        """
+        with self.condition:
+            if not self.hits or self.abandoned or self.retired:
+                return None
+            hit = min(self.hits)
+            if self.pending and min(self.pending) < hit[0]:
+                return None
+            return hit
+
+    def wait(self):
+        """Wait for every submitted frame to be processed, giving up after ``timeout`` seconds."""
+        with self.condition:
+            done = self.condition.wait_for(lambda: not self.pending or self.retired, self.timeout)
+        if self.retired:
+            self._give_up("the pool was restarted")
+        elif not done:
+            self._give_up(f"{len(self.pending)} frames still unchecked after {self.timeout:g}s")
+
+    def result(self):
+        """
+        Return the earliest frame with faces once every earlier frame has been checked.
+
+        :return: Tuple of (frame_number, time, reason), or None if no faces were found or the
+                 stream gave up
+        """
+        if not self.abandoned:
+            self.wait()
+        if self.abandoned:
+            return None
+        return min(self.hits) if self.hits else None
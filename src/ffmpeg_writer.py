@@ -0,0 +1,232 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from moviepy.config import get_setting
+from metrics import incr
+
+# Fragmented MP4 can be written front to back without seeking, so it can go to a pipe
+FRAGMENTED_MP4_PARAMS = ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+STREAM_READ_SIZE = 1024 * 1024
+
+
+def hls_params(folder, segment_seconds):
+    """Output options for a VOD HLS playlist with its segments in ``folder``, cut at forced keyframes."""
+    return ['-force_key_frames', f"expr:gte(t,n_forced*{segment_seconds})",
+            '-f', 'hls', '-hls_time', str(segment_seconds), '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(folder, 'segment_%03d.ts')]
+
+
+def _scale_rate(rate, factor):
+    # Rates are given the way ffmpeg takes them, e.g. '5000k'
+    number = rate.rstrip('kKmM')
+    return f"{int(float(number) * factor)}{rate[len(number):]}"
+
+
+def x264_params(bitrate, crf=None, tune=None, gop=None, threads=None):
+    """
+    Rate control and tuning options of a video output.
+
+    With ``crf`` the encoder targets a constant quality and ``bitrate`` only caps the rate of
+    the harder scenes; otherwise ``bitrate`` is the average rate.
+
+    :param gop: Maximum frames between keyframes
+    :param threads: Encoder threads, None to let ffmpeg decide
+    """
+    if crf is not None:
+        params = ['-crf', str(crf), '-maxrate', bitrate, '-bufsize', _scale_rate(bitrate, 2)]
+    else:
+        params = ['-b:v', bitrate]
+    if tune:
+        params.extend(['-tune', tune])
+    if gop:
+        params.extend(['-g', str(gop)])
+    if threads:
+        params.extend(['-threads', str(threads)])
+    return params
+
+
+class FFmpegPipeWriter:
+    """
+    Encode raw RGB frames with a single ffmpeg process fed over a pipe.
+
+    Frames are written as ``(height, width, 3)`` uint8 arrays (or ``(n, height, width, 3)``
+    batches) straight to ffmpeg's stdin, so the output is encoded exactly once with no
+    intermediate files. With ``output_stream`` the encoded video is written as fragmented MP4
+    to that file-like object while encoding runs, instead of to ``output_path``.
+
+    ``extra_outputs`` are further renditions encoded by the same ffmpeg process from the same
+    frames, each scaled to its own size, so an extra rendition costs only its encode.
+    """
+
+    def __init__(self, output_path, size, frame_rate, audio_path=None, audio_duration=None, codec='libx264',
+                 audio_codec='aac', preset='medium', bitrate='5000k', ffmpeg_params=None, output_stream=None,
+                 output_size=None, extra_outputs=None, crf=None, tune=None, gop=None, threads=None):
+        """
+        :param output_path: Path of the file to write
+        :param size: (width, height) of the frames
+        :param frame_rate: Frames per second of the output
+        :param audio_path: Optional audio file to mux into the output
+        :param audio_duration: Trim the audio input to this many seconds
+        :param ffmpeg_params: Extra output options appended before the output path
+        :param output_stream: Object with a ``write(bytes)`` method receiving the encoded output
+        :param output_size: (width, height) of the output if the frames are to be scaled
+        :param extra_outputs: List of dicts with the ``path``, ``size`` and ``bitrate`` of further
+                              outputs, and ``hls_time`` to write an HLS playlist at ``path`` with
+                              segments of that many seconds next to it
+        :param crf: Constant quality to encode at, capped by the bitrate (see ``x264_params``)
+        :param tune: x264 tuning, e.g. 'film'
+        :param gop: Maximum frames between keyframes
+        :param threads: Threads of each encoder, None to let ffmpeg decide
+        """
+        self.output_path = output_path if output_stream is None else 'pipe:1'
+        self.size = size
+        self.frame_count = 0
+        self.output_stream = output_stream
+        self.stream_error = None
+
+        cmd = [
+            get_setting("FFMPEG_BINARY"), '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-vcodec', 'rawvideo',
+            '-s', f"{size[0]}x{size[1]}", '-pix_fmt', 'rgb24', '-r', f"{frame_rate:.02f}",
+            '-i', '-',
+        ]
+        if audio_path:
+            if audio_duration is not None:
+                cmd.extend(['-t', f"{audio_duration:.3f}"])
+            cmd.extend(['-i', audio_path])
+
+        def output_args(output_size, output_bitrate):
+            args = ['-map', '0:v', '-map', '1:a', '-c:a', audio_codec] if audio_path else []
+            args.extend(['-c:v', codec, '-preset', preset])
+            args.extend(x264_params(output_bitrate, crf, tune, gop, threads))
+            args.extend(['-pix_fmt', 'yuv420p'])
+            if output_size is not None and tuple(output_size) != tuple(size):
+                args.extend(['-vf', f"scale={output_size[0]}:{output_size[1]}:flags=area"])
+            return args
+
+        cmd.extend(output_args(output_size, bitrate))
+        cmd.extend(ffmpeg_params or [])
+        if output_stream is not None:
+            cmd.extend(FRAGMENTED_MP4_PARAMS)
+        cmd.append(self.output_path)
+
+        for output in extra_outputs or []:
+            cmd.extend(output_args(output['size'], output['bitrate']))
+            if output.get('hls_time'):
+                folder = os.path.dirname(output['path'])
+                os.makedirs(folder, exist_ok=True)
+                cmd.extend(hls_params(folder, output['hls_time']))
+            cmd.append(output['path'])
+
+        self.log_file = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                     stdout=subprocess.DEVNULL if output_stream is None else subprocess.PIPE,
+                                     stderr=self.log_file)
+        self.reader = None
+        if output_stream is not None:
+            self.reader = threading.Thread(target=self._pump_output, daemon=True)
+            self.reader.start()
+
+    def _pump_output(self):
+        for chunk in iter(lambda: self.proc.stdout.read(STREAM_READ_SIZE), b''):
+            if self.stream_error is not None:
+                continue  # Keep draining so ffmpeg does not block on a full pipe
+            try:
+                self.output_stream.write(chunk)
+            except Exception as e:
+                self.stream_error = e
+
+    def _error_message(self):
+        self.log_file.seek(0)
+        return self.log_file.read().decode(errors='replace').strip()
+
+    def write_frames(self, frames):
+        """Write a single frame or a contiguous batch of frames."""
+        if self.stream_error is not None:
+            raise IOError(f"Writing the encoded output failed: {self.stream_error}")
+        if frames.dtype != 'uint8' or frames.shape[-3:] != (self.size[1], self.size[0], 3):
+            raise ValueError(f"Expected uint8 frames of size {self.size}, got {frames.dtype} {frames.shape}")
+        start = time.perf_counter()
+        try:
+            self.proc.stdin.write(memoryview(frames if frames.flags.c_contiguous else frames.copy()))
+        except (BrokenPipeError, OSError) as e:
+            self.proc.wait()
+            raise IOError(f"ffmpeg failed while writing {self.output_path}: {self._error_message() or e}")
+        # Writes block while ffmpeg's pipe is full, i.e. while rendering is ahead of the encoder
+        incr('reel_encoder_wait_seconds_total', time.perf_counter() - start)
+        self.frame_count += 1 if frames.ndim == 3 else len(frames)
+
+    def close(self):
+        """Flush the remaining frames and wait for ffmpeg to finish the file."""
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        return_code = self.proc.wait()
+        if self.reader is not None:
+            self.reader.join()
+        message = self._error_message()
+        self.log_file.close()
+        if return_code != 0:
+            raise IOError(f"ffmpeg exited with code {return_code} while writing {self.output_path}: {message}")
+        if self.stream_error is not None:
+            raise IOError(f"Writing the encoded output failed: {self.stream_error}")
+
+    def abort(self):
+        """Stop ffmpeg without finishing the file."""
+        self.proc.kill()
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc.wait()
+        if self.reader is not None:
+            self.reader.join()
+        self.log_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def mux_audio(video_path, output_path, audio_path=None, audio_duration=None, audio_codec='aac', output_stream=None):
+    """
+    Copy an encoded video into a new file, adding an audio track, without re-encoding the video.
+
+    :param audio_duration: Trim the audio input to this many seconds
+    :param output_stream: Object with a ``write(bytes)`` method receiving fragmented MP4 instead of ``output_path``
+    """
+    cmd = [get_setting("FFMPEG_BINARY"), '-y', '-loglevel', 'error', '-i', video_path]
+    if audio_path:
+        if audio_duration is not None:
+            cmd.extend(['-t', f"{audio_duration:.3f}"])
+        cmd.extend(['-i', audio_path, '-map', '0:v', '-map', '1:a', '-c:a', audio_codec])
+    cmd.extend(['-c:v', 'copy'])
+    if output_stream is not None:
+        cmd.extend(FRAGMENTED_MP4_PARAMS)
+    cmd.append(output_path if output_stream is None else 'pipe:1')
+
+    with tempfile.TemporaryFile() as log_file:
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL if output_stream is None else subprocess.PIPE,
+                                stderr=log_file)
+        try:
+            if output_stream is not None:
+                shutil.copyfileobj(proc.stdout, output_stream, STREAM_READ_SIZE)
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            return_code = proc.wait()
+        if return_code != 0:
+            log_file.seek(0)
+            message = log_file.read().decode(errors='replace').strip()
+            raise IOError(f"ffmpeg exited with code {return_code} while muxing {video_path}: {message}")
@@ -0,0 +1,138 @@
+import json
+import logging
+import shutil
+import subprocess
+from config import DETECTION_CONFIG
+
+
+class FrameSampler:
+    """Decide which decoded frames of a video are passed to the detectors."""
+
+    def __init__(self, fps, total_frames):
+        self.fps = fps
+        self.total_frames = total_frames
+
+    def is_sampled(self, frame_index):
+        return True
+
+
+class StrideSampler(FrameSampler):
+    """Sample every ``stride``-th frame."""
+
+    def __init__(self, fps, total_frames, stride):
+        super().__init__(fps, total_frames)
+        self.stride = max(1, int(stride))
+
+    def is_sampled(self, frame_index):
+        return frame_index % self.stride == 0
+
+
+class TimeSampler(FrameSampler):
+    """Sample a fixed number of frames per second of video, whatever its frame rate."""
+
+    def __init__(self, fps, total_frames, samples_per_second):
+        super().__init__(fps, total_frames)
+        self.samples_per_second = samples_per_second
+
+    def is_sampled(self, frame_index):
+        # A frame is sampled when it is the first one of a new sampling period
+        if frame_index == 0:
+            return True
+        period = self.samples_per_second / self.fps
+        return int(frame_index * period) != int((frame_index - 1) * period)
+
+
+class KeyframeSampler(FrameSampler):
+    """Sample only the keyframes of the video stream, as reported by ffprobe."""
+
+    def __init__(self, fps, total_frames, keyframes):
+        super().__init__(fps, total_frames)
+        self.keyframes = keyframes
+
+    def is_sampled(self, frame_index):
+        return frame_index in self.keyframes
+
+
+def probe_keyframes(video_path, fps):
+    """
+    List the frame indices of the keyframes of a video.
+
+    Keyframe timestamps are taken relative to the stream's start time, since decoded frames are
+    numbered from the first one whatever its timestamp.
+
+    :return: Set of frame indices, or None if ffprobe is not available or fails
+    """
+    ffprobe = shutil.which('ffprobe')
+    if ffprobe is None:
+        return None
+
+    cmd = [ffprobe, '-v', 'error', '-select_streams', 'v:0', '-skip_frame', 'nokey',
+           '-show_entries', 'stream=start_time:frame=pts_time', '-of', 'json', video_path]
+    try:
+        output = subprocess.run(cmd, capture_output=True, text=True, check=True, timeout=60).stdout
+        probe = json.loads(output)
+    except (subprocess.SubprocessError, OSError, ValueError) as e:
+        logging.warning(f"Could not probe keyframes of {video_path}: {str(e)}")
+        return None
+
+    streams = probe.get('streams') or [{}]
+    start_time = _seconds(streams[0].get('start_time')) or 0.0
+    keyframes = set()
+    for frame in probe.get('frames', []):
+        pts_time = _seconds(frame.get('pts_time'))
+        if pts_time is not None:
+            keyframes.add(int(round((pts_time - start_time) * fps)))
+    return keyframes or None
+
+
+def _seconds(value):
+    # ffprobe reports missing timestamps as N/A
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def make_sampler(fps, total_frames, video_path=None, strategy=None):
+    """
+    Build the frame sampler configured for this deployment.
+
+    :param strategy: One of 'every_frame', 'stride', 'time' or 'keyframe'; defaults to DETECTION_CONFIG
+    """
+    strategy = strategy or DETECTION_CONFIG['sampling_strategy']
+
+    if strategy == 'stride':
+        return StrideSampler(fps, total_frames, DETECTION_CONFIG['sample_stride'])
+    if strategy == 'time':
+        return TimeSampler(fps, total_frames, DETECTION_CONFIG['samples_per_second'])
+    if strategy == 'keyframe':
+        keyframes = probe_keyframes(video_path, fps) if video_path else None
+        if keyframes is not None:
+            return KeyframeSampler(fps, total_frames, keyframes)
+        logging.warning("Keyframes unavailable, falling back to time-based sampling")
+        return TimeSampler(fps, total_frames, DETECTION_CONFIG['samples_per_second'])
+    if strategy == 'every_frame':
+        return FrameSampler(fps, total_frames)
+
+    raise ValueError(f"Unknown frame sampling strategy: {strategy}")
+
+
+def refine_hit(candidates, detect):
+    """
+    Find the earliest detection among the frames decoded between a missed sample and a hit.
+
+    Binary search over the candidates, assuming that once the subject appears it stays in
+    view until the sampled hit. Costs about log2(len(candidates)) detector calls.
+
+    :param candidates: List of (frame_index, frame) in decode order, all after the last missed sample
+    :param detect: Callable returning True if the frame contains the subject
+    :return: Frame index of the earliest hit found, or None if none of the candidates has one
+    """
+    low, high = 0, len(candidates)
+    while low < high:
+        middle = (low + high) // 2
+        if detect(candidates[middle][1]):
+            high = middle
+        else:
+            low = middle + 1
+    return candidates[low][0] if low < len(candidates) else None
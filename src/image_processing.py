@@ -1,49 +1,179 @@
 import cv2
 import numpy as np
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from moviepy.editor import VideoClip, concatenate_videoclips
+from cpu_budget import job_cpus
+from encoding import get_profile
+from ffmpeg_writer import x264_params
+from config import IMAGE_CONFIG
+
+# Number of animation frames rendered per batch into the reusable frame buffer
+ANIMATION_BATCH_SIZE = 24
+
+# JPEGs are decoded at 1/8, 1/4 or 1/2 scale straight from the DCT coefficients
+REDUCED_DECODE_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                        (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+# Start-of-frame markers of baseline, progressive and other JPEG encodings
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _exif_orientation(tiff):
+    """Read the Orientation tag from the first IFD of an EXIF block, or return None."""
+    if tiff[:2] == b'II':
+        order = '<'
+    elif tiff[:2] == b'MM':
+        order = '>'
+    else:
+        return None
+    offset = struct.unpack(order + 'I', tiff[4:8])[0]
+    if offset + 2 > len(tiff):
+        return None
+    count = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+    for entry in range(offset + 2, min(offset + 2 + count * 12, len(tiff) - 11), 12):
+        tag, _, _ = struct.unpack(order + 'HHI', tiff[entry:entry + 8])
+        if tag == 0x0112:
+            return struct.unpack(order + 'H', tiff[entry + 8:entry + 10])[0]
+    return None
+
+
+def read_jpeg_header(image_path):
+    """
+    Read the dimensions and EXIF orientation of a JPEG from its header, without decoding it.
+
+    :return: Tuple of (width, height, orientation) with the dimensions as stored, before
+             orientation is applied, or None if the file is not a JPEG
+    """
+    orientation = 1
+    with open(image_path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            code = marker[1]
+            if code == 0xFF:
+                # Fill byte before the actual marker
+                f.seek(-1, 1)
+                continue
+            if code == 0x01 or 0xD0 <= code <= 0xD8:
+                continue
+            if code in (0xD9, 0xDA):
+                # End of image or start of scan before any frame header
+                return None
+            length = struct.unpack('>H', f.read(2))[0]
+            if code in _JPEG_SOF_MARKERS:
+                _, height, width = struct.unpack('>BHH', f.read(5))
+                return width, height, orientation
+            if code == 0xE1:
+                segment = f.read(length - 2)
+                if segment.startswith(b'Exif\x00\x00'):
+                    orientation = _exif_orientation(segment[6:]) or 1
+            else:
+                f.seek(length - 2, 1)
+
+
+def load_image_for_size(image_path, target_size):
+    """
+    Decode an image at the smallest scale that still covers ``target_size`` once cropped.
+
+    JPEGs larger than twice the target are decoded at a reduced scale, which skips most of the
+    decoding work and keeps a phone photo from being held in memory at full resolution. EXIF
+    orientation is applied either way.
+
+    :return: BGR image, or None if it could not be read
+    """
+    try:
+        header = read_jpeg_header(image_path)
+    except (OSError, struct.error):
+        header = None
+
+    flags = cv2.IMREAD_COLOR
+    if header is not None:
+        width, height, orientation = header
+        if orientation in (5, 6, 7, 8):
+            # Rotated by 90 degrees once the orientation is applied
+            width, height = height, width
+        for scale, reduced_flags in REDUCED_DECODE_FLAGS:
+            if width // scale >= target_size[0] and height // scale >= target_size[1]:
+                flags = reduced_flags
+                break
+    return cv2.imread(image_path, flags)
+
+
+def _crop_and_resize(image_path, target_size):
+    img = load_image_for_size(image_path, target_size)
+    if img is None:
+        raise IOError(f"Unable to read image: {image_path}")
+
+    height, width = img.shape[:2]
+    aspect_ratio = width / height
+    target_aspect = target_size[0] / target_size[1]
+
+    if aspect_ratio > target_aspect:
+        # Image is wider, crop the width
+        new_width = int(height * target_aspect)
+        start_x = (width - new_width) // 2
+        img = img[:, start_x:start_x + new_width]
+    else:
+        # Image is taller, crop the height
+        new_height = int(width / target_aspect)
+        start_y = (height - new_height) // 2
+        img = img[start_y:start_y + new_height, :]
+
+    resized_img = cv2.resize(img, target_size)
+    return cv2.cvtColor(resized_img, cv2.COLOR_BGR2RGB)  # Convert to RGB
 
 
 def resize_and_crop_image(image_path, target_size=(480, 480)):
-    """Resize and crop an image to fit the target size while maintaining aspect ratio."""
+    """
+    Resize and crop an image to fit the target size while maintaining aspect ratio.
+
+    The image is decoded at a reduced scale when it is much larger than the target, and
+    converted to RGB only once cropped and resized.
+    """
     try:
-        img = cv2.imread(image_path)
-        if img is None:
-            raise IOError(f"Unable to read image: {image_path}")
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # Convert to RGB
-        print(f"Image shape after reading: {img.shape}")
-
-        height, width = img.shape[:2]
-        aspect_ratio = width / height
-        target_aspect = target_size[0] / target_size[1]
-
-        if aspect_ratio > target_aspect:
-            # Image is wider, crop the width
-            new_width = int(height * target_aspect)
-            start_x = (width - new_width) // 2
-            img = img[:, start_x:start_x + new_width]
-        else:
-            # Image is taller, crop the height
-            new_height = int(width / target_aspect)
-            start_y = (height - new_height) // 2
-            img = img[start_y:start_y + new_height, :]
-
-        resized_img = cv2.resize(img, target_size)
-        print(f"Image shape after resize: {resized_img.shape}")
-        return resized_img
+        return _crop_and_resize(image_path, target_size)
     except Exception as e:
         print(f"Error processing image {image_path}: {str(e)}")
         return None
 
 
+def preprocess_images(image_paths, target_size=(480, 480), max_workers=None):
+    """
+    Decode, crop and resize several images at once on a thread pool.
+
+    OpenCV releases the GIL while decoding and resizing, so the images are prepared in
+    parallel and the whole batch takes about as long as its slowest image.
+
+    :param max_workers: Images prepared at the same time, defaults to IMAGE_CONFIG['preprocess_workers'],
+                        or the job's CPU budget
+    :return: List with one ``(image, error)`` tuple per path, in the order of ``image_paths``:
+             the RGB uint8 image at ``target_size`` and None, or None and the exception raised
+    """
+    if not image_paths:
+        return []
+    max_workers = max_workers or IMAGE_CONFIG['preprocess_workers'] or job_cpus()
+
+    def prepare(image_path):
+        try:
+            return np.ascontiguousarray(_crop_and_resize(image_path, target_size)), None
+        except Exception as e:
+            print(f"Error processing image {image_path}: {str(e)}")
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(image_paths)))) as executor:
+        return list(executor.map(prepare, image_paths))
+
+
 def apply_animation(img, effect_type, t):
     """Apply animation effect to an image."""
     if not isinstance(img, np.ndarray):
         print(f"Error: Expected numpy array, got {type(img)}")
         return np.zeros((480, 480, 3), dtype=np.uint8)  # Return a black image as fallback
 
-    print(f"Applying {effect_type} animation, t={t}")
-    print(f"Image shape in apply_animation: {img.shape}")
-
     if effect_type == 'fade':
         alpha = 1 - abs(1 - 2 * t)  # Fade in and out
         return (img * alpha).astype('uint8')
@@ -65,16 +195,105 @@ def apply_animation(img, effect_type, t):
     return img
 
 
-def create_animated_clip(image_path, duration=3, animation_type='fade', target_size=(480, 480)):
-    """Create an animated clip from an image with resizing and cropping."""
-    img = resize_and_crop_image(image_path, target_size)
+def _affine_matrices(width, height, angles, scales):
+    """Vectorized cv2.getRotationMatrix2D for a sequence of angles and scales."""
+    center_x, center_y = width // 2, height // 2
+    radians = np.deg2rad(angles)
+    alpha = scales * np.cos(radians)
+    beta = scales * np.sin(radians)
+    matrices = np.empty((len(angles), 2, 3), dtype=np.float64)
+    matrices[:, 0, 0] = alpha
+    matrices[:, 0, 1] = beta
+    matrices[:, 0, 2] = (1 - alpha) * center_x - beta * center_y
+    matrices[:, 1, 0] = -beta
+    matrices[:, 1, 1] = alpha
+    matrices[:, 1, 2] = beta * center_x + (1 - alpha) * center_y
+    return matrices
+
+
+class TransitionRenderer:
+    """
+    Render all frames of an animated image clip in batches.
+
+    Per-frame parameters (fade LUTs, slide offsets, affine matrices) are computed once
+    up front and frames are written into a preallocated batch buffer, so rendering does
+    no per-frame allocation. Frame ``i`` matches ``apply_animation(img, effect_type, i / n_frames)``.
+
+    Frames returned by ``render_batch`` and ``frame`` are views into the reusable buffer
+    and are only valid until the next batch is rendered.
+    """
+
+    def __init__(self, img, effect_type, n_frames, batch_size=ANIMATION_BATCH_SIZE):
+        self.img = np.ascontiguousarray(img)
+        self.effect_type = effect_type
+        self.n_frames = n_frames
+        self.batch_size = max(1, min(batch_size, n_frames))
+        self.height, self.width = img.shape[:2]
+        self.buffer = np.empty((self.batch_size,) + self.img.shape, dtype=np.uint8)
+        self.batch_start = None
+        self.batch_count = 0
+
+        progress = np.arange(n_frames) / n_frames
+        if effect_type == 'fade':
+            alphas = 1 - np.abs(1 - 2 * progress)
+            self.luts = (np.arange(256)[None, :] * alphas[:, None]).astype(np.uint8)
+        elif effect_type == 'slide':
+            self.offsets = (self.width * progress).astype(int)
+        elif effect_type == 'zoom':
+            self.matrices = _affine_matrices(self.width, self.height, np.zeros(n_frames), 1 + 0.5 * progress)
+        elif effect_type == 'rotate':
+            self.matrices = _affine_matrices(self.width, self.height, 360 * progress, np.ones(n_frames))
+
+    def _render_into(self, index, out):
+        if self.effect_type == 'fade':
+            cv2.LUT(self.img, self.luts[index], dst=out)
+        elif self.effect_type == 'slide':
+            offset = self.offsets[index]
+            out[:, :self.width - offset] = self.img[:, offset:]
+            out[:, self.width - offset:] = 0
+        elif self.effect_type in ('zoom', 'rotate'):
+            cv2.warpAffine(self.img, self.matrices[index], (self.width, self.height), dst=out)
+        else:
+            out[...] = self.img
+
+    def render_batch(self, start):
+        """Render frames ``start`` up to ``start + batch_size`` and return them as a buffer view."""
+        count = min(self.batch_size, self.n_frames - start)
+        for offset in range(count):
+            self._render_into(start + offset, self.buffer[offset])
+        self.batch_start = start
+        self.batch_count = count
+        return self.buffer[:count]
+
+    def iter_batches(self):
+        """Yield ``(start_index, frames)`` for every batch of the clip, in order."""
+        for start in range(0, self.n_frames, self.batch_size):
+            yield start, self.render_batch(start)
+
+    def frame(self, index):
+        """Return frame ``index``, rendering a new batch from it when it is not buffered."""
+        index = min(max(index, 0), self.n_frames - 1)
+        if self.batch_start is None or not self.batch_start <= index < self.batch_start + self.batch_count:
+            self.render_batch(index)
+        return self.buffer[index - self.batch_start]
+
+
+def create_animated_clip(image_path, duration=3, animation_type='fade', target_size=(480, 480), frame_rate=24,
+                         img=None):
+    """
+    Create an animated clip from an image with resizing and cropping.
+
+    :param img: The image already prepared by ``preprocess_images``, if any
+    """
+    if img is None:
+        img = resize_and_crop_image(image_path, target_size)
     if img is None:
         return None
 
-    print(f"Image shape in create_animated_clip: {img.shape}")
+    renderer = TransitionRenderer(img, animation_type, int(round(duration * frame_rate)))
 
     def make_frame(t):
-        return apply_animation(img.copy(), animation_type, t / duration)
+        return renderer.frame(int(round(t * frame_rate)))
 
     # Create a VideoClip with the make_frame function
     clip = VideoClip(make_frame, duration=duration)
@@ -82,17 +301,25 @@ def create_animated_clip(image_path, duration=3, animation_type='fade', target_s
     return clip
 
 
-def generate_video_from_images(image_paths, output_path, frame_rate=24, target_size=(480, 480)):
-    """Generate a video from a list of image paths with animations."""
+def generate_video_from_images(image_paths, output_path, frame_rate=24, target_size=(480, 480), encoder=None):
+    """
+    Generate a video from a list of image paths with animations.
+
+    :param encoder: Encoder profile name (see ``encoding.ENCODER_PROFILES``), defaults to ENCODER_PROFILE
+    """
     clips = []
     effects = ['fade', 'zoom', 'slide', 'rotate']
 
-    for idx, image_path in enumerate(image_paths):
+    # Decode and crop every image up front, in parallel
+    prepared = preprocess_images(image_paths, target_size)
+    for idx, (image_path, (img, error)) in enumerate(zip(image_paths, prepared)):
+        if error is not None:
+            continue
         effect_type = effects[idx % len(effects)]
         print(f"Processing image {idx + 1}/{len(image_paths)}: {image_path}")
-        clip = create_animated_clip(image_path, animation_type=effect_type, target_size=target_size)
+        clip = create_animated_clip(image_path, animation_type=effect_type, target_size=target_size,
+                                    frame_rate=frame_rate, img=img)
         if clip is not None:
-            clip = clip.resize(target_size)
             clips.append(clip)
 
     if not clips:
@@ -100,16 +327,18 @@ def generate_video_from_images(image_paths, output_path, frame_rate=24, target_s
         return None
 
     final_clip = concatenate_videoclips(clips)
+    profile = get_profile(encoder)
 
     try:
         final_clip.write_videofile(
             output_path,
             fps=frame_rate,
-            codec='libx264',
+            codec=profile['codec'],
             audio_codec='aac',
-            preset='medium',
-            bitrate='5000k',
-            ffmpeg_params=["-pix_fmt", "yuv420p"]  # This ensures better compatibility
+            preset=profile['preset'],
+            # Rate control, including the bitrate, is passed with the profile's other options
+            ffmpeg_params=x264_params('5000k', profile['crf'], profile['tune'], profile['gop'], profile['threads'])
+                          + ["-pix_fmt", "yuv420p"]  # This ensures better compatibility
         )
         return output_path
     except Exception as e:
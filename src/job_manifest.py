@@ -0,0 +1,145 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+from media_collector import local_media_path
+from s3_connector import get_object_metadata, read_json_from_s3, write_json_to_s3
+from config import S3_CONFIG, JOB_CONFIG, RENDER_CONFIG
+
+logger = logging.getLogger(__name__)
+
+STAGES = ['query', 'download', 'analyze', 'render', 'upload', 'finalize']
+
+# User metadata of the uploaded reel naming the media selection it was rendered from
+FINGERPRINT_METADATA = 'media-fingerprint'
+
+
+def manifest_key(account_id, year):
+    return f"{JOB_CONFIG['manifest_prefix']}/{account_id}/{year}.json"
+
+
+def output_key(account_id, year):
+    """S3 key of a job's reel; the same job always writes the same key, so a rerun overwrites it."""
+    return f"videos/{account_id}/{year}.mp4"
+
+
+def rendition_key(account_id, year, rendition):
+    """S3 key of an extra rendition of a job's reel; for HLS, the key of its playlist."""
+    if rendition['format'] == 'hls':
+        return f"videos/{account_id}/{year}/{rendition['name']}/index.m3u8"
+    return f"videos/{account_id}/{year}/{rendition['name']}.mp4"
+
+
+def media_fingerprint(media_items):
+    """Identify a media selection, so checkpoints of an older selection are not reused."""
+    selection = [[item['s3Key'], item['type']] for item in media_items]
+    return hashlib.sha256(json.dumps(selection).encode()).hexdigest()
+
+
+def load_manifest(account_id, year, fingerprint):
+    """
+    Load the manifest of a job from S3, or start a new one.
+
+    A manifest recorded for a different media selection (the account added or removed posts
+    since) is discarded, and the job starts over.
+    """
+    manifest = read_json_from_s3(S3_CONFIG['bucket_name'], manifest_key(account_id, year))
+    if manifest is None or manifest.get('media_fingerprint') != fingerprint:
+        manifest = {'account_id': account_id, 'year': year, 'media_fingerprint': fingerprint, 'stages': {}}
+    return manifest
+
+
+def record_stage(job, stage, **data):
+    """Checkpoint a completed stage of ``job`` with the data needed to skip it on a rerun."""
+    manifest = job.get('manifest')
+    if manifest is None:
+        return
+    manifest['stages'][stage] = {'completed_at': time.time(), 'host': socket.gethostname(), **data}
+    write_json_to_s3(S3_CONFIG['bucket_name'], manifest_key(job['account_id'], job['year']), manifest)
+
+
+def _local_checkpoint(manifest, stage):
+    # Files written by a stage only exist on the host that ran it
+    checkpoint = manifest['stages'].get(stage)
+    if checkpoint is None or checkpoint.get('host') != socket.gethostname():
+        return None
+    return checkpoint
+
+
+def resume_job(job, media_items):
+    """
+    Restore what earlier runs of a job completed and set ``job['run_stages']`` to the stages left.
+
+    A reel already in S3 for the same media selection only needs its status updated, even when
+    the upload finished after the last checkpoint was written. Otherwise the job resumes from
+    the rendered file or the downloaded media when they are still on this host, reusing the
+    recorded video plans so a rerun picks the same sub-segments.
+
+    :param job: Job dict with account_id and year
+    :param media_items: Media items selected by the query stage
+    :return: The job, updated
+    """
+    job['media_items'] = media_items
+    job['media_fingerprint'] = fingerprint = media_fingerprint(media_items)
+    if not JOB_CONFIG['checkpoints']:
+        job['run_stages'] = STAGES[1:]
+        return job
+
+    manifest = job['manifest'] = load_manifest(job['account_id'], job['year'], fingerprint)
+    stages = manifest['stages']
+    if 'query' not in stages:
+        record_stage(job, 'query', media_items=[{key: item.get(key) for key in ('id', 'type', 's3Key')}
+                                                for item in media_items])
+
+    if 'upload' not in stages:
+        s3_key = output_key(job['account_id'], job['year'])
+        metadata = get_object_metadata(S3_CONFIG['bucket_name'], s3_key)
+        if metadata is not None and metadata.get(FINGERPRINT_METADATA) == fingerprint:
+            # The upload completed but the worker stopped before recording it
+            record_stage(job, 'upload', s3_key=s3_key, recovered=True)
+
+    if 'upload' in stages:
+        job['s3_key'] = stages['upload']['s3_key']
+        job['run_stages'] = [] if 'finalize' in stages else ['finalize']
+    else:
+        job['run_stages'] = _resume_render(job, manifest) + ['upload', 'finalize']
+
+    if job['run_stages'] != STAGES[1:]:
+        logger.info(f"Resuming job {job['account_id']}/{job['year']}: "
+                    f"running {', '.join(job['run_stages']) or 'nothing'}")
+    return job
+
+
+def _resume_render(job, manifest):
+    render = _local_checkpoint(manifest, 'render')
+    if render is not None and render.get('output_path') and render.get('rendition_spec') == RENDER_CONFIG['renditions'] \
+            and all(
+            os.path.exists(path) for path in [render['output_path'], *render.get('renditions', {}).values()]):
+        job['output_path'] = render['output_path']
+        job['rendition_paths'] = render.get('renditions', {})
+        return []
+
+    run_stages = ['render']
+    download = _local_checkpoint(manifest, 'download')
+    downloaded = set(download['s3_keys']) if download is not None else set()
+    if download is not None and all(os.path.exists(local_media_path(key)) for key in downloaded):
+        job['media_items'] = [dict(item, path=local_media_path(item['s3Key']))
+                              for item in job['media_items'] if item['s3Key'] in downloaded]
+    else:
+        run_stages.insert(0, 'download')
+
+    analyze = manifest['stages'].get('analyze')
+    if analyze is not None:
+        # Plans are recorded by S3 key and point at the local media path, which is the same on every run
+        job['video_plans'] = {local_media_path(key): dict(plan, path=local_media_path(key)) if plan else None
+                              for key, plan in analyze['video_plans'].items()}
+    else:
+        run_stages.insert(-1, 'analyze')
+    return run_stages
+
+
+def video_plans_by_key(media_items, video_plans):
+    """Key the video plans of a job by S3 key instead of local path, for the manifest."""
+    return {item['s3Key']: video_plans.get(item['path']) for item in media_items if item['path'] in video_plans}
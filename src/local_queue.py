@@ -0,0 +1,104 @@
+import threading
+import time
+import uuid
+
+
+class InMemorySQS:
+    """
+    Minimal in-memory stand-in for the boto3 SQS client, for running the worker locally.
+
+    Implements the calls the worker uses with the same request and response shapes, including
+    visibility timeouts: a received message is hidden until it is deleted or its timeout expires.
+    """
+
+    def __init__(self, visibility_timeout=30):
+        self.visibility_timeout = visibility_timeout
+        self.messages = {}  # message id -> dict(body, visible_at, receipt_handle, receive_count)
+        self.deleted = []
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+    def send_message(self, QueueUrl, MessageBody):
+        message_id = uuid.uuid4().hex
+        with self._condition:
+            self.messages[message_id] = {'body': MessageBody, 'visible_at': 0, 'receipt_handle': None,
+                                         'receive_count': 0}
+            self._condition.notify_all()
+        return {'MessageId': message_id}
+
+    def _visible(self, now):
+        return [(message_id, message) for message_id, message in self.messages.items()
+                if message['visible_at'] <= now]
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=None, **kwargs):
+        deadline = time.monotonic() + WaitTimeSeconds
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                visible = self._visible(now)
+                if visible or now >= deadline:
+                    break
+                next_visible = min((m['visible_at'] for m in self.messages.values()), default=deadline)
+                self._condition.wait(timeout=max(0.01, min(deadline, next_visible) - now))
+
+            received = []
+            timeout = self.visibility_timeout if VisibilityTimeout is None else VisibilityTimeout
+            for message_id, message in visible[:MaxNumberOfMessages]:
+                message['receipt_handle'] = f"{message_id}:{uuid.uuid4().hex}"
+                message['visible_at'] = now + timeout
+                message['receive_count'] += 1
+                received.append({'MessageId': message_id, 'ReceiptHandle': message['receipt_handle'],
+                                 'Body': message['body']})
+        return {'Messages': received} if received else {}
+
+    def _find(self, receipt_handle):
+        message_id = receipt_handle.split(':', 1)[0]
+        message = self.messages.get(message_id)
+        if message is None or message['receipt_handle'] != receipt_handle:
+            return None, None
+        return message_id, message
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        with self._condition:
+            message_id, _ = self._find(ReceiptHandle)
+            if message_id is not None:
+                del self.messages[message_id]
+                self.deleted.append(message_id)
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        successful, failed = [], []
+        with self._condition:
+            for entry in Entries:
+                message_id, _ = self._find(entry['ReceiptHandle'])
+                if message_id is None:
+                    failed.append({'Id': entry['Id'], 'Code': 'ReceiptHandleIsInvalid', 'SenderFault': True})
+                    continue
+                del self.messages[message_id]
+                self.deleted.append(message_id)
+                successful.append({'Id': entry['Id']})
+        return {'Successful': successful, 'Failed': failed}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        successful, failed = [], []
+        with self._condition:
+            now = time.monotonic()
+            for entry in Entries:
+                _, message = self._find(entry['ReceiptHandle'])
+                if message is None:
+                    failed.append({'Id': entry['Id'], 'Code': 'ReceiptHandleIsInvalid', 'SenderFault': True})
+                    continue
+                message['visible_at'] = now + entry['VisibilityTimeout']
+                successful.append({'Id': entry['Id']})
+            self._condition.notify_all()
+        return {'Successful': successful, 'Failed': failed}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        with self._condition:
+            now = time.monotonic()
+            visible = len(self._visible(now))
+            attributes = {
+                'ApproximateNumberOfMessages': str(visible),
+                'ApproximateNumberOfMessagesNotVisible': str(len(self.messages) - visible),
+            }
+        return {'Attributes': attributes}
@@ -0,0 +1,126 @@
+import base64
+import hashlib
+import shutil
+import threading
+import uuid
+
+
+class InMemoryS3:
+    """
+    Minimal in-memory stand-in for the boto3 S3 client, for running the pipeline locally.
+
+    Implements the calls the connector uses with the same request and response shapes, including
+    multipart uploads: parts are checked against their ContentMD5 and the completed object gets
+    the same ``md5-of-digests-N`` ETag S3 computes.
+    """
+
+    def __init__(self):
+        self.objects = {}  # (bucket, key) -> dict(body, etag)
+        self.uploads = {}  # upload id -> dict(bucket, key, parts)
+        self._lock = threading.Lock()
+
+    def _error(self, code, message):
+        # Shaped like botocore's ClientError so callers can inspect e.response['Error']['Code']
+        from botocore.exceptions import ClientError
+        return ClientError({'Error': {'Code': code, 'Message': message}}, 'InMemoryS3')
+
+    def _get(self, Bucket, Key, IfMatch=None):
+        with self._lock:
+            stored = self.objects.get((Bucket, Key))
+        if stored is None:
+            raise self._error('404', f"Not Found: {Bucket}/{Key}")
+        if IfMatch is not None and IfMatch.strip('"') != stored['etag']:
+            raise self._error('PreconditionFailed', f"ETag mismatch for {Bucket}/{Key}")
+        return stored
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, **kwargs):
+        body = Body if isinstance(Body, bytes) else Body.read()
+        etag = hashlib.md5(body).hexdigest()
+        with self._lock:
+            self.objects[(Bucket, Key)] = {'body': body, 'etag': etag, 'metadata': dict(Metadata or {})}
+        return {'ETag': f'"{etag}"'}
+
+    def get_object(self, Bucket, Key, IfMatch=None, **kwargs):
+        stored = self._get(Bucket, Key, IfMatch)
+        return {'Body': _Body(stored['body']), 'ETag': f'"{stored["etag"]}"', 'ContentLength': len(stored['body']),
+                'Metadata': stored['metadata']}
+
+    def head_object(self, Bucket, Key, IfMatch=None, **kwargs):
+        stored = self._get(Bucket, Key, IfMatch)
+        return {'ETag': f'"{stored["etag"]}"', 'ContentLength': len(stored['body']), 'Metadata': stored['metadata']}
+
+    def _check_transfer_args(self, extra_args, allowed):
+        # s3transfer validates ExtraArgs the same way before any request is made
+        for key in extra_args or {}:
+            if key not in allowed:
+                raise ValueError(f"Invalid extra_args key '{key}', must be one of: {', '.join(allowed)}")
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, **kwargs):
+        from s3transfer.manager import TransferManager
+        self._check_transfer_args(ExtraArgs, TransferManager.ALLOWED_UPLOAD_ARGS)
+        with open(Filename, 'rb') as f:
+            self.put_object(Bucket, Key, f.read(), Metadata=(ExtraArgs or {}).get('Metadata'))
+
+    def download_file(self, Bucket, Key, Filename, ExtraArgs=None, **kwargs):
+        from s3transfer.manager import TransferManager
+        self._check_transfer_args(ExtraArgs, TransferManager.ALLOWED_DOWNLOAD_ARGS)
+        stored = self._get(Bucket, Key)
+        with open(Filename, 'wb') as f:
+            f.write(stored['body'])
+
+    def download_fileobj(self, Bucket, Key, Fileobj, ExtraArgs=None, **kwargs):
+        from s3transfer.manager import TransferManager
+        self._check_transfer_args(ExtraArgs, TransferManager.ALLOWED_DOWNLOAD_ARGS)
+        stored = self._get(Bucket, Key)
+        shutil.copyfileobj(_Body(stored['body']), Fileobj)
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None, **kwargs):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.uploads[upload_id] = {'bucket': Bucket, 'key': Key, 'parts': {}, 'metadata': dict(Metadata or {})}
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5=None, **kwargs):
+        digest = hashlib.md5(Body).digest()
+        if ContentMD5 is not None and base64.b64decode(ContentMD5) != digest:
+            raise self._error('BadDigest', f"Content-MD5 mismatch for part {PartNumber}")
+        with self._lock:
+            if UploadId not in self.uploads:
+                raise self._error('NoSuchUpload', UploadId)
+            self.uploads[UploadId]['parts'][PartNumber] = (Body, digest)
+        return {'ETag': f'"{digest.hex()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        with self._lock:
+            upload = self.uploads.pop(UploadId, None)
+            if upload is None:
+                raise self._error('NoSuchUpload', UploadId)
+            parts = []
+            for part in MultipartUpload['Parts']:
+                body, digest = upload['parts'][part['PartNumber']]
+                if part['ETag'].strip('"') != digest.hex():
+                    raise self._error('InvalidPart', f"ETag mismatch for part {part['PartNumber']}")
+                parts.append((body, digest))
+            etag = f"{hashlib.md5(b''.join(digest for _, digest in parts)).hexdigest()}-{len(parts)}"
+            self.objects[(Bucket, Key)] = {'body': b''.join(body for body, _ in parts), 'etag': etag,
+                                           'metadata': upload['metadata']}
+        return {'Bucket': Bucket, 'Key': Key, 'ETag': f'"{etag}"'}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        with self._lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+
+class _Body:
+    """Readable stand-in for botocore's StreamingBody."""
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, size=-1):
+        end = len(self.data) if size is None or size < 0 else self.position + size
+        chunk = self.data[self.position:end]
+        self.position += len(chunk)
+        return chunk
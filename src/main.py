@@ -1,27 +1,29 @@
 import logging
-import json
-import os
-import time
 
 from dotenv import load_dotenv
 from video_generator import process_and_upload_video
 from media_collector import get_account_media
-from config import S3_CONFIG, APP_CONFIG
+from config import S3_CONFIG, APP_CONFIG, WORKER_CONFIG
 from user_data import update_video_status
 from utils import create_temp_folder
+from model_registry import prewarm_models
+from metrics import trace
+from worker import SQSWorker, get_sqs_client
+from pipeline import build_reel_pipeline, parse_job_message, run_job
 
 # Load environment variables
 load_dotenv()
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=APP_CONFIG['log_level'], format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
 
 def test_run(account_id, year, audio_file=None):
-    media_items = get_account_media(account_id, year)
-    process_user_media(account_id, year, media_items, audio_file)
+    with trace('reel', account_id=account_id, year=year):
+        media_items = get_account_media(account_id, year)
+        process_user_media(account_id, year, media_items, audio_file)
 
 
 def process_user_media(account_id, year, media_items, audio_file=None):
@@ -57,58 +59,37 @@ def process_user_media(account_id, year, media_items, audio_file=None):
 
 
 def process_sqs_message(message):
-    data = json.loads(message)
-    account_id = data.get('accountId')
-    year = data.get('year')
-
-    if not account_id or not year:
-        logger.error(f"Invalid message format: {message}")
+    """
+    Run the job of an SQS message end to end.
+
+    Errors are raised so the message is not deleted; once it is redelivered the job resumes from
+    its last checkpoint.
+    """
+    job = parse_job_message(message)
+    if job is None:
         return
 
     try:
-        # media_items = get_account_media(account_id, year)
-        # process_user_media(account_id, year, media_items)
-        logger.info(f"Successfully processed video for account {account_id} and year {year}")
-        logger.info(f"----message", message)
+        with trace('reel', account_id=job['account_id'], year=job['year']):
+            run_job(job)
+        logger.info(f"Successfully processed video for account {job['account_id']} and year {job['year']}")
     except Exception as e:
-        logger.error(f"Error processing video for account {account_id} and year {year}: {str(e)}")
+        logger.error(f"Error processing video for account {job['account_id']} and year {job['year']}: {str(e)}")
+        raise
 
 
 if __name__ == "__main__":
-    import boto3
-
-    sqs = boto3.client('sqs')
-    queue_url = os.getenv('SQS_QUEUE_URL')
-
-    empty_receives = 0
-    max_empty_receives = 3  # Adjust this value as needed
-
-    while True:
-        response = sqs.receive_message(
-            QueueUrl=queue_url,
-            MaxNumberOfMessages=3,  # Process up to 10 messages at a time
-            WaitTimeSeconds=20
-        )
-
-        messages = response.get('Messages', [])
-
-        if not messages:
-            empty_receives += 1
-            print(f"No messages received. Empty receive count: {empty_receives}")
-            if empty_receives >= max_empty_receives:
-                print(f"Reached {max_empty_receives} empty receives. Exiting.")
-                break
-        else:
-            empty_receives = 0  # Reset the counter when messages are received
-
-            for message in messages:
-                try:
-                    process_sqs_message(message['Body'])
-                    sqs.delete_message(
-                        QueueUrl=queue_url,
-                        ReceiptHandle=message['ReceiptHandle']
-                    )
-                except Exception as e:
-                    print(f"Error processing message: {str(e)}")
-
-        time.sleep(1)  # Short pause between polling to avoid excessive API calls
+    sqs = get_sqs_client()
+    queue_url = WORKER_CONFIG['queue_url']
+
+    if APP_CONFIG['prewarm_models']:
+        logger.info("Prewarming detector models")
+        prewarm_models()
+
+    if WORKER_CONFIG['mode'] == 'pipeline':
+        pipeline = build_reel_pipeline()
+        worker = SQSWorker(sqs, queue_url, parse_job_message, executor=pipeline, concurrency=pipeline.capacity,
+                           max_empty_receives=3)
+    else:
+        worker = SQSWorker(sqs, queue_url, process_sqs_message, max_empty_receives=3)
+    worker.run()
@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import uuid
+from metrics import incr
+from config import MEDIA_CACHE_CONFIG, SEGMENT_CACHE_CONFIG
+
+
+class DiskLRUCache:
+    """
+    Size-bounded directory of cached files with least-recently-used eviction.
+
+    Entries are written to a temporary file and renamed into place, so readers never see a
+    partial entry. Recency is tracked through the file modification time, which is refreshed
+    on every hit, so the cache survives restarts and can be shared by several processes.
+
+    Entries hard-linked elsewhere by ``link_or_copy`` are pinned while a link exists: removing
+    them would not free their space, so they count towards the byte budget but are not evicted.
+    Once the job that linked an entry deletes its copy, the entry can be evicted again.
+    """
+
+    def __init__(self, folder, max_bytes, name='media'):
+        self.folder = folder
+        self.name = name
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+
+    def get(self, name):
+        """Return the path of a cached entry and mark it as recently used, or None on a miss."""
+        path = self._path(name) if name else None
+        if path is not None:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                path = None
+        with self._lock:
+            if path is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        incr('reel_cache_requests_total', cache=self.name, result='miss' if path is None else 'hit')
+        return path
+
+    def contains(self, name):
+        """Whether an entry exists, without counting a hit or refreshing its recency."""
+        return os.path.exists(self._path(name))
+
+    def find(self, prefix):
+        """Return the name of the most recently used entry starting with ``prefix``, or None."""
+        names = [name for name in os.listdir(self.folder) if name.startswith(prefix) and not name.startswith('.')]
+        if not names:
+            return None
+        return max(names, key=lambda name: os.path.getmtime(self._path(name)))
+
+    def put(self, name, write):
+        """
+        Create an entry by calling ``write(temp_path)`` and atomically moving the result into place.
+
+        :return: Path of the cached entry
+        """
+        temp_path = self._path(f".{name}.{uuid.uuid4().hex}.tmp")
+        try:
+            write(temp_path)
+            os.replace(temp_path, self._path(name))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.evict(keep=name)
+        return self._path(name)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries, except ``keep`` and pinned ones, until the cache fits
+        in its byte budget.
+        """
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.folder):
+                if entry.is_file() and not entry.name.startswith('.'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    total += stat.st_size
+                    # An entry with other links is still used by a job; deleting it frees nothing
+                    if entry.name != keep and stat.st_nlink == 1:
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def link_or_copy(source, destination):
+    """
+    Expose a cached file at ``destination`` without duplicating it on disk when possible.
+
+    A hard link pins the cache entry until ``destination`` is deleted (see ``DiskLRUCache``).
+    """
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """SHA-256 of a file's content, as a hex string."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def s3_entry_prefix(bucket_name, object_key):
+    return hashlib.sha256(f"{bucket_name}/{object_key}".encode()).hexdigest()[:32]
+
+
+def s3_entry_name(bucket_name, object_key, etag):
+    """Cache entry name for one version of an S3 object."""
+    return f"{s3_entry_prefix(bucket_name, object_key)}-{re.sub(r'[^0-9A-Za-z-]', '', etag)}"
+
+
+_media_cache = None
+_media_cache_lock = threading.Lock()
+
+
+def get_media_cache():
+    """Return the process-wide media cache, or None if it is disabled."""
+    global _media_cache
+    if not MEDIA_CACHE_CONFIG['max_bytes']:
+        return None
+    if _media_cache is None:
+        with _media_cache_lock:
+            if _media_cache is None:
+                _media_cache = DiskLRUCache(MEDIA_CACHE_CONFIG['folder'], MEDIA_CACHE_CONFIG['max_bytes'])
+                logging.info(f"Media cache at {MEDIA_CACHE_CONFIG['folder']} "
+                             f"limited to {MEDIA_CACHE_CONFIG['max_bytes']} bytes")
+    return _media_cache
+
+
+_segment_cache = None
+
+
+def get_segment_cache():
+    """Return the process-wide cache of rendered segments and encoded reels, or None if it is disabled."""
+    global _segment_cache
+    if not SEGMENT_CACHE_CONFIG['max_bytes']:
+        return None
+    if _segment_cache is None:
+        with _media_cache_lock:
+            if _segment_cache is None:
+                _segment_cache = DiskLRUCache(SEGMENT_CACHE_CONFIG['folder'], SEGMENT_CACHE_CONFIG['max_bytes'],
+                                              name='segments')
+                logging.info(f"Segment cache at {SEGMENT_CACHE_CONFIG['folder']} "
+                             f"limited to {SEGMENT_CACHE_CONFIG['max_bytes']} bytes")
+    return _segment_cache
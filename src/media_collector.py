@@ -1,30 +1,61 @@
 import os
+from datetime import datetime
 from db_connector import execute_query
-from s3_connector import download_file_from_s3
+from s3_connector import download_files_from_s3
+from media_cache import get_media_cache
+from metrics import span
 from config import S3_CONFIG, APP_CONFIG
 
 
 def get_account_media(account_id, year):
     """
-    Fetch media items for a given account and year.
+    Fetch media items for a given account and year and download them.
 
     :param account_id: ID of the account
     :param year: Year to fetch media for
-    :return: List of media items
+    :return: List of media items with local paths
+    """
+    return download_media_items(query_account_media(account_id, year))
+
+
+def query_account_media(account_id, year):
+    """
+    Select the media items of a given account and year, without downloading them.
+
+    The selection is done in the database: the first 12 posts of the year plus the first
+    post of every month not yet represented, at most 15 items, in chronological order.
+    The date-range predicate is served by the index on posts ("accountId", "createdAt")
+    described in the README.
+
+    :param account_id: ID of the account
+    :param year: Year to fetch media for
+    :return: List of media items with their S3 keys
     """
     query = """
-    SELECT f.id, f.path, f.name, p."createdAt", p."imageId", p."videoId"
-    FROM posts p
-    JOIN files f ON (p."imageId" = f.id OR p."videoId" = f.id)
-    WHERE p."accountId" = %s
-      AND EXTRACT(YEAR FROM p."createdAt") = %s
-    ORDER BY p."createdAt" ASC
-    LIMIT 1000
+    WITH ranked AS (
+        SELECT f.id, f.path, f.name, p."createdAt", p."imageId", p."videoId",
+               ROW_NUMBER() OVER (ORDER BY p."createdAt", f.id) AS overall_rank,
+               ROW_NUMBER() OVER (PARTITION BY EXTRACT(MONTH FROM p."createdAt")
+                                  ORDER BY p."createdAt", f.id) AS month_rank
+        FROM posts p
+        JOIN files f ON (p."imageId" = f.id OR p."videoId" = f.id)
+        WHERE p."accountId" = %s
+          AND p."createdAt" >= %s
+          AND p."createdAt" < %s
+    )
+    SELECT id, path, name, "createdAt", "imageId", "videoId"
+    FROM ranked
+    WHERE overall_rank <= 12 OR month_rank = 1
+    ORDER BY "createdAt", id
+    LIMIT 15
     """
 
-    results = execute_query(query, (account_id, year))
+    year = int(year)
+    with span('query', account_id=account_id, year=year) as attributes:
+        results = execute_query(query, (account_id, datetime(year, 1, 1), datetime(year + 1, 1, 1)))
+        attributes['rows'] = len(results)
 
-    all_media = [
+    return [
         {
             'id': row[0],
             'type': 'image' if row[4] is not None else 'video',
@@ -34,52 +65,89 @@ def get_account_media(account_id, year):
         for row in results
     ]
 
-    # Process to select media items
-    selected_media = []
-    month_counts = {month: 0 for month in range(1, 13)}
 
-    for item in all_media:
-        month = item['created_at'].month
-        if month_counts[month] == 0 or len(selected_media) < 12:
-            selected_media.append(item)
-            month_counts[month] += 1
+def query_video_uploads(since, limit=None):
+    """
+    Select the videos posted since a date, most recent first, e.g. to analyze them ahead of time.
+
+    :param since: datetime of the earliest post
+    :param limit: Optional maximum number of videos
+    :return: List of media items with their S3 keys
+    """
+    query = """
+    SELECT f.id, f.path, f.name, p."createdAt"
+    FROM posts p
+    JOIN files f ON p."videoId" = f.id
+    WHERE p."createdAt" >= %s
+    ORDER BY p."createdAt" DESC, f.id
+    """
+    params = [since]
+    if limit is not None:
+        query += "LIMIT %s"
+        params.append(limit)
+
+    with span('query', since=since.isoformat()) as attributes:
+        results = execute_query(query, tuple(params))
+        attributes['rows'] = len(results)
+
+    return [{'id': row[0], 'type': 'video', 's3Key': f"{row[1]}/{row[2]}", 'created_at': row[3]} for row in results]
 
-        if len(selected_media) == 15:
-            break
 
-    # If we have less than 12 items, add more from available months
-    while len(selected_media) < 12 and len(selected_media) < len(all_media):
-        for item in all_media:
-            if item not in selected_media:
-                selected_media.append(item)
-                if len(selected_media) == 12 or len(selected_media) == len(all_media):
-                    break
+def local_media_path(s3_key):
+    """Local path a media object is downloaded to; the same on every run."""
+    return os.path.join(APP_CONFIG['temp_folder'], s3_key)
 
-    # Sort the final selected media by created_at in ascending order
-    selected_media.sort(key=lambda x: x['created_at'])
 
-    return download_media_items(selected_media)
+def remove_local_media(media_items):
+    """
+    Delete the local copies of a job's media once the job no longer needs them.
+
+    Copies hard-linked from the media cache pin their cache entries until they are deleted.
+    """
+    for s3_key in {item['s3Key'] for item in media_items}:
+        try:
+            os.remove(local_media_path(s3_key))
+        except FileNotFoundError:
+            pass
 
 
 def download_media_items(media_items):
     """
-    Download media items from S3 to local storage.
+    Download media items from S3 to local storage, in parallel.
 
     :param media_items: List of media items to download
-    :return: List of media items with local paths
+    :return: List of media items with local paths, in the original order, without failed downloads
     """
-    downloaded_items = []
+    downloads = []
     for item in media_items:
-        local_path = os.path.join(APP_CONFIG['temp_folder'], item['s3Key'])
+        local_path = local_media_path(item['s3Key'])
         os.makedirs(os.path.dirname(local_path), exist_ok=True)
-
-        try:
-            download_file_from_s3(S3_CONFIG['bucket_name'], item['s3Key'], local_path)
-            downloaded_items.append({
-                'type': item['type'],
-                'path': local_path
-            })
-        except Exception as e:
-            print(f"Error downloading file {item['s3Key']}: {str(e)}")
-
-    return downloaded_items
\ No newline at end of file
+        downloads.append((item['s3Key'], local_path))
+
+    if not downloads:
+        return []
+
+    # The same object may back several items; fetch it once
+    with span('download', objects=len(downloads)) as attributes:
+        succeeded, failed = download_files_from_s3(S3_CONFIG['bucket_name'], list(dict.fromkeys(downloads)))
+        attributes['failed'] = len(failed)
+    for s3_key, error in failed.items():
+        print(f"Error downloading file {s3_key}: {str(error)}")
+    if failed:
+        print(f"Downloaded {len(succeeded)}/{len(downloads)} media items, {len(failed)} failed")
+
+    cache = get_media_cache()
+    if cache is not None:
+        stats = cache.stats()
+        print(f"Media cache: {stats['hits']} hits, {stats['misses']} misses")
+
+    return [
+        {
+            'id': item.get('id'),
+            'type': item['type'],
+            's3Key': s3_key,
+            'path': local_path
+        }
+        for item, (s3_key, local_path) in zip(media_items, downloads)
+        if s3_key not in failed
+    ]
@@ -0,0 +1,272 @@
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from config import METRICS_CONFIG
+
+# Upper bounds, in seconds, of the duration histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters and histograms, keyed by metric name and labels.
+
+    Updates are cheap enough for per-frame use. Each process has its own registry; worker
+    processes export their own Prometheus file, labelled with their pid.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def incr(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self):
+        """Return the current values as plain dicts, e.g. for a JSON report."""
+        with self._lock:
+            counters = {_series_name(name, labels): value for (name, labels), value in self.counters.items()}
+            histograms = {_series_name(name, labels): {'sum': total, 'count': count}
+                          for (name, labels), (_, total, count) in self.histograms.items()}
+        return {'counters': counters, 'histograms': histograms}
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def _after_fork(self):
+        # A forked child starts from zero and must not inherit a lock held by another thread
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def to_prometheus(self, extra_labels=None):
+        """Render every metric in the Prometheus text exposition format."""
+        extra = tuple(sorted((extra_labels or {}).items()))
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(buckets), total, count))
+                                for key, (buckets, total, count) in self.histograms.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_format_labels(labels + extra)} {_format_value(value)}")
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, buckets):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels + extra + (('le', _format_value(bound)),))} "
+                             f"{cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels + extra + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels + extra)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(labels + extra)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _series_name(name, labels):
+    return name + _format_labels(labels)
+
+
+class Trace:
+    """Spans recorded for one job, exported as a single JSON line when the job ends."""
+
+    def __init__(self, name, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, spans):
+        with self._lock:
+            self.spans.extend(spans)
+
+    def to_dict(self, duration, status):
+        return {'trace_id': self.trace_id, 'name': self.name, 'start': self.start, 'duration': duration,
+                'status': status, 'attributes': self.attributes, 'spans': sorted(self.spans, key=lambda s: s['start'])}
+
+
+registry = MetricsRegistry()
+os.register_at_fork(after_in_child=registry._after_fork)
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+def incr(name, value=1, **labels):
+    registry.incr(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def use_trace(trace_):
+    """Attach spans recorded in this thread to ``trace_``, e.g. in a pipeline stage worker."""
+    token = _current_trace.set(trace_)
+    try:
+        yield trace_
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def trace(name, **attributes):
+    """
+    Record a job: spans opened inside the block are collected and written to the trace file.
+
+    Also counts the job by status, records its duration and flushes the exporters.
+    """
+    trace_ = Trace(name, **attributes)
+    start = time.perf_counter()
+    status = 'ok'
+    try:
+        with use_trace(trace_):
+            yield trace_
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        finish_trace(trace_, time.perf_counter() - start, status)
+
+
+def finish_trace(trace_, duration, status):
+    registry.incr('reel_jobs_total', status=status, trace=trace_.name)
+    registry.observe('reel_job_duration_seconds', duration, trace=trace_.name)
+    if METRICS_CONFIG['trace_file']:
+        export_json_lines(METRICS_CONFIG['trace_file'], trace_.to_dict(duration, status))
+    flush()
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Time a block, record it in the ``reel_span_duration_seconds`` histogram and add it to the
+    current trace, if any. The yielded dict can be used to add attributes from inside the block.
+    """
+    start_time = time.time()
+    start = time.perf_counter()
+    status = 'ok'
+    try:
+        yield attributes
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        registry.observe('reel_span_duration_seconds', duration, span=name)
+        trace_ = _current_trace.get()
+        if trace_ is not None:
+            trace_.add([{'name': name, 'start': start_time, 'duration': duration, 'status': status,
+                         'pid': os.getpid(), 'attributes': attributes}])
+
+
+def call_with_spans(fn, *args):
+    """
+    Call ``fn(*args)`` under a throwaway trace and return ``(result, spans)``.
+
+    Used to run work in another process while still attaching its spans to the caller's trace.
+    """
+    trace_ = Trace(getattr(fn, '__name__', 'call'))
+    try:
+        with use_trace(trace_):
+            return fn(*args), trace_.spans
+    finally:
+        flush()
+
+
+_export_lock = threading.Lock()
+
+
+def _reset_export_lock():
+    global _export_lock
+    _export_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_export_lock)
+
+
+def export_json_lines(path, record):
+    """Append one JSON record to ``path``; each line is written with a single append."""
+    line = (json.dumps(record, default=str) + '\n').encode()
+    with _export_lock:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+def export_prometheus(folder):
+    """
+    Write this process's metrics to ``<folder>/reel_<pid>.prom`` for the node exporter's
+    textfile collector. The file is replaced atomically so it is never read half written.
+    """
+    pid = os.getpid()
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"reel_{pid}.prom")
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(registry.to_prometheus({'pid': pid}))
+    os.replace(temp_path, path)
+    return path
+
+
+def flush():
+    """Export the metrics of this process to the configured Prometheus folder, if any."""
+    if METRICS_CONFIG['prometheus_dir']:
+        export_prometheus(METRICS_CONFIG['prometheus_dir'])
@@ -0,0 +1,109 @@
+import cv2
+import numpy as np
+import os
+import threading
+import logging
+from s3_connector import download_file_from_s3
+from config import S3_CONFIG, APP_CONFIG, DETECTION_CONFIG
+
+# Models are loaded at most once per process and shared by every job the process handles.
+# A cv2.dnn network must not run forward passes from several threads at once, so callers that
+# analyze videos concurrently should do it in separate processes.
+_lock = threading.Lock()
+_yolo_models = {}
+_face_cascade = None
+_face_net = None
+
+# Darknet networks usable as the people detector: name -> (cfg, weights), stored under yolo/ in S3
+YOLO_MODELS = {
+    'yolov3': ('yolov3.cfg', 'yolov3.weights'),
+    'yolov3-tiny': ('yolov3-tiny.cfg', 'yolov3-tiny.weights'),
+}
+# OpenCV's ResNet-10 SSD face detector (prototxt, Caffe weights), stored under models/ in S3
+FACE_DNN_MODEL = ('deploy.prototxt', 'res10_300x300_ssd_iter_140000.caffemodel')
+
+
+def get_yolo_path(filename):
+    """Get the path for YOLO files, downloading from S3 if necessary"""
+    return get_model_path(filename, 'yolo')
+
+
+def get_model_path(filename, s3_prefix='models'):
+    """Get the path of a model file, downloading it from ``<s3_prefix>/<filename>`` in S3 if necessary"""
+    local_path = f"{APP_CONFIG['temp_folder']}/{filename}"
+    if not os.path.exists(local_path):
+        s3_bucket = S3_CONFIG['bucket_name']
+        s3_key = f"{s3_prefix}/{filename}"
+        try:
+            download_file_from_s3(s3_bucket, s3_key, local_path)
+        except Exception as e:
+            logging.error(f"Failed to download {filename} from S3: {str(e)}")
+            raise
+    return local_path
+
+
+def _output_layer_names(net):
+    ln = net.getLayerNames()
+    try:
+        unconnected_layers = net.getUnconnectedOutLayers()
+        if isinstance(unconnected_layers, np.ndarray):
+            return [ln[i - 1] for i in unconnected_layers.flatten()]
+        return [ln[i[0] - 1] for i in unconnected_layers]
+    except IndexError:
+        return [ln[i - 1] for i in net.getUnconnectedOutLayers()]
+
+
+def get_yolo_model(name='yolov3'):
+    """
+    Return the process-wide YOLO network and its output layer names, loading them on first use.
+
+    :param name: Network to load, one of ``YOLO_MODELS``
+    :return: Tuple of (net, output_layer_names)
+    """
+    if name not in YOLO_MODELS:
+        raise ValueError(f"Unknown YOLO model: {name}")
+    if name not in _yolo_models:
+        with _lock:
+            if name not in _yolo_models:
+                cfg_name, weights_name = YOLO_MODELS[name]
+                yolo_cfg = get_yolo_path(cfg_name)
+                yolo_weights = get_yolo_path(weights_name)
+
+                logging.info("Loading YOLO model from:")
+                logging.info(f"Config: {yolo_cfg}")
+                logging.info(f"Weights: {yolo_weights}")
+
+                net = cv2.dnn.readNetFromDarknet(yolo_cfg, yolo_weights)
+                _yolo_models[name] = (net, _output_layer_names(net))
+                logging.info("YOLO network loaded successfully")
+    return _yolo_models[name]
+
+
+def get_face_cascade():
+    """Return the process-wide Haar cascade used for face detection, loading it on first use."""
+    global _face_cascade
+    if _face_cascade is None:
+        with _lock:
+            if _face_cascade is None:
+                _face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    return _face_cascade
+
+
+def get_face_net():
+    """Return the process-wide DNN face detector, loading it on first use."""
+    global _face_net
+    if _face_net is None:
+        with _lock:
+            if _face_net is None:
+                _face_net = cv2.dnn.readNetFromCaffe(get_model_path(FACE_DNN_MODEL[0]),
+                                                     get_model_path(FACE_DNN_MODEL[1]))
+    return _face_net
+
+
+def prewarm_models():
+    """Load the configured detector models now instead of on the first job."""
+    get_yolo_model(DETECTION_CONFIG['people_detector'])
+    if DETECTION_CONFIG['face_detector'] == 'dnn':
+        get_face_net()
+    else:
+        get_face_cascade()
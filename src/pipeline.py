@@ -0,0 +1,323 @@
+import json
+import logging
+import os
+import shutil
+import queue
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from media_collector import query_account_media, download_media_items, remove_local_media
+from video_generator import (NothingToRenderError, plan_videos, generate_video_video, stream_video_to_s3, get_renditions,
+                             render_size, rendition_paths)
+from video_processing import remove_segment_frames
+from s3_connector import upload_hls_to_s3, upload_video_and_cleanup
+from user_data import update_video_status
+from utils import create_temp_folder
+from cpu_budget import apply_cpu_budget
+from encoding import ENCODER_PROFILES, select_profile
+from job_manifest import (FINGERPRINT_METADATA, output_key, record_stage, rendition_key, resume_job,
+                          video_plans_by_key)
+from metrics import Trace, call_with_spans, finish_trace, span, use_trace
+from config import S3_CONFIG, APP_CONFIG, PIPELINE_CONFIG, RENDER_CONFIG
+
+logger = logging.getLogger(__name__)
+
+_SHUTDOWN = object()
+
+
+class PipelineStage:
+    """
+    One step of the job pipeline.
+
+    :param fn: Callable taking the job dict and returning it, updated
+    :param workers: Jobs this stage works on at the same time
+    :param executor: Optional executor ``fn`` is run on (e.g. a process pool for CPU-bound
+                     stages); ``fn`` and the job must then be picklable
+    """
+
+    def __init__(self, name, fn, workers=1, executor=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.executor = executor
+
+
+class JobPipeline(Executor):
+    """
+    Run jobs through a sequence of stages connected by bounded queues.
+
+    Each stage has its own workers, so different jobs occupy different stages at the same
+    time: one job downloads while another renders and a third uploads. When a stage falls
+    behind, the queue in front of it fills up and the stages before it block, which keeps
+    the number of jobs in the pipeline bounded.
+
+    ``submit(fn, *args)`` calls ``fn(*args)`` to build the job dict, feeds it to the first
+    stage and returns a future resolved with the job once the last stage is done. ``fn``
+    may return None to skip the job.
+
+    Every job is recorded as a ``reel`` trace with one span per stage, including the spans
+    recorded by stages that run on an executor in another process.
+    """
+
+    def __init__(self, stages, queue_size=None):
+        self.stages = stages
+        self.queue_size = queue_size or PIPELINE_CONFIG['queue_size']
+        self.queues = [queue.Queue(maxsize=self.queue_size) for _ in stages]
+        self.threads = []
+        for index, stage in enumerate(stages):
+            stage_threads = [threading.Thread(target=self._run_stage, args=(index,), daemon=True,
+                                              name=f"pipeline-{stage.name}-{n}") for n in range(stage.workers)]
+            for thread in stage_threads:
+                thread.start()
+            self.threads.append(stage_threads)
+
+    @property
+    def capacity(self):
+        """Number of jobs the pipeline holds when every stage and queue is full."""
+        return sum(stage.workers for stage in self.stages) + self.queue_size * len(self.stages)
+
+    def _run_stage(self, index):
+        stage = self.stages[index]
+        while True:
+            item = self.queues[index].get()
+            if item is _SHUTDOWN:
+                return
+            job, future, trace, start = item
+
+            if not job.get('skip'):
+                stage_start = time.perf_counter()
+                try:
+                    with use_trace(trace), span(f"stage:{stage.name}"):
+                        if stage.executor is not None:
+                            # Spans recorded in the worker process come back with the job
+                            job, spans = stage.executor.submit(call_with_spans, stage.fn, job).result()
+                            trace.add(spans)
+                        else:
+                            job = stage.fn(job)
+                except Exception as e:
+                    logger.error(f"Stage {stage.name} failed for job {job.get('account_id')}/{job.get('year')}: "
+                                 f"{str(e)}")
+                    finish_trace(trace, time.perf_counter() - start, 'error')
+                    future.set_exception(e)
+                    continue
+                logger.debug(f"Stage {stage.name} done for job {job.get('account_id')}/{job.get('year')} "
+                             f"in {time.perf_counter() - stage_start:.2f}s")
+
+            if index + 1 < len(self.stages):
+                self.queues[index + 1].put((job, future, trace, start))
+            else:
+                finish_trace(trace, time.perf_counter() - start, 'skipped' if job.get('skip') else 'ok')
+                future.set_result(job)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        try:
+            job = fn(*args, **kwargs)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        if job is None:
+            future.set_result(None)
+            return future
+
+        trace = Trace('reel', account_id=job.get('account_id'), year=job.get('year'))
+        self.queues[0].put((job, future, trace, time.perf_counter()))
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        """Let queued jobs drain through every stage, then stop the stage workers and executors."""
+        for index, stage_threads in enumerate(self.threads):
+            for _ in stage_threads:
+                self.queues[index].put(_SHUTDOWN)
+            for thread in stage_threads:
+                thread.join()
+        for executor in {id(stage.executor): stage.executor for stage in self.stages if stage.executor}.values():
+            executor.shutdown(wait=wait)
+
+
+def parse_job_message(body):
+    """
+    Turn an SQS message body into a job dict, or None if the message is invalid.
+
+    Besides accountId and year, a message may name the encoder ``profile`` of its reel.
+    """
+    try:
+        data = json.loads(body)
+    except ValueError:
+        logger.error(f"Invalid message format, not JSON: {body}")
+        return None
+    if not isinstance(data, dict):
+        logger.error(f"Invalid message format: {body}")
+        return None
+    account_id = data.get('accountId')
+    year = data.get('year')
+    profile = data.get('profile')
+
+    if not account_id or not year or (profile is not None and profile not in ENCODER_PROFILES):
+        logger.error(f"Invalid message format: {body}")
+        return None
+    return {'account_id': account_id, 'year': year, 'profile': profile}
+
+
+def query_stage(job):
+    """Select the job's media and work out, from its manifest, which stages are left to run."""
+    media_items = query_account_media(job['account_id'], job['year'])
+    if not media_items:
+        logger.warning(f"No media items found for user {job['account_id']} in year {job['year']}. "
+                       f"Skipping video generation.")
+        job['skip'] = True
+        return job
+
+    job = resume_job(job, media_items)
+    if not job['run_stages']:
+        # Rendered, uploaded and recorded by an earlier delivery of the same message
+        job['skip'] = True
+    return job
+
+
+def download_stage(job):
+    if 'download' not in job['run_stages']:
+        return job
+    job['media_items'] = download_media_items(job['media_items'])
+    if not job['media_items']:
+        logger.error(f"No media could be downloaded for user {job['account_id']}")
+        job['skip'] = True
+        return job
+    record_stage(job, 'download', s3_keys=[item['s3Key'] for item in job['media_items']])
+    return job
+
+
+def analyze_stage(job):
+    if 'analyze' not in job['run_stages']:
+        return job
+    job['video_plans'] = plan_videos(job['media_items'], render_size(get_renditions()), frame_rate=24)
+    record_stage(job, 'analyze', video_plans=video_plans_by_key(job['media_items'], job['video_plans']))
+    return job
+
+
+def render_stage(job):
+    if 'render' not in job['run_stages']:
+        return job
+    try:
+        return _render(job)
+    finally:
+        # Segments saved by the analysis are only read here; a retry decodes them again
+        remove_segment_frames(job['video_plans'].values())
+
+
+def _render(job):
+    metadata = {FINGERPRINT_METADATA: job['media_fingerprint']}
+    renditions = get_renditions()
+    encoder = select_profile(job.get('profile'))
+
+    if S3_CONFIG['stream_upload'] and len(renditions) == 1:
+        # Encode straight into a multipart upload; the upload stage has nothing left to do
+        try:
+            job['s3_key'] = stream_video_to_s3(job['media_items'], S3_CONFIG['bucket_name'],
+                                               output_key(job['account_id'], job['year']), frame_rate=24,
+                                               video_plans=job['video_plans'], metadata=metadata,
+                                               rendition=renditions[0], encoder=encoder)
+        except NothingToRenderError:
+            logger.error(f"Failed to generate video for user {job['account_id']}")
+            remove_local_media(job['media_items'])
+            job['skip'] = True
+            return job
+        record_stage(job, 'render', streamed=True, encoder=encoder)
+        record_stage(job, 'upload', s3_key=job['s3_key'])
+        return job
+
+    create_temp_folder(f"videos/{job['account_id']}")
+    output_path = f"{APP_CONFIG['temp_folder']}/videos/{job['account_id']}/{job['year']}.mp4"
+    job['output_path'] = generate_video_video(job['media_items'], output_path, frame_rate=24,
+                                              video_plans=job['video_plans'], renditions=renditions,
+                                              encoder=encoder)
+    if job['output_path'] is None:
+        logger.error(f"Failed to generate video for user {job['account_id']}")
+        remove_local_media(job['media_items'])
+        job['skip'] = True
+        return job
+    # Extra renditions are written next to the primary output by the same encode
+    job['rendition_paths'] = {name: path for name, path in rendition_paths(output_path, renditions).items()
+                              if path != output_path}
+    record_stage(job, 'render', output_path=job['output_path'], renditions=job['rendition_paths'],
+                 rendition_spec=RENDER_CONFIG['renditions'], encoder=encoder)
+    return job
+
+
+def upload_stage(job):
+    if 'upload' not in job['run_stages'] or 's3_key' in job:
+        return job
+    bucket = S3_CONFIG['bucket_name']
+    renditions = {rendition['name']: rendition for rendition in get_renditions()}
+
+    # The primary output goes last: with its metadata it marks the whole upload as done
+    rendition_keys = {}
+    for name, path in job.get('rendition_paths', {}).items():
+        rendition = renditions[name]
+        key = rendition_key(job['account_id'], job['year'], rendition)
+        if rendition['format'] == 'hls':
+            upload_hls_to_s3(path, bucket, key)
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+        else:
+            upload_video_and_cleanup(path, bucket, key, [])
+        rendition_keys[name] = key
+
+    s3_key = output_key(job['account_id'], job['year'])
+    upload_video_and_cleanup(job['output_path'], bucket, s3_key, [],
+                             metadata={FINGERPRINT_METADATA: job['media_fingerprint']})
+    job['s3_key'] = s3_key
+    job['rendition_keys'] = rendition_keys
+    record_stage(job, 'upload', s3_key=s3_key, renditions=rendition_keys)
+    return job
+
+
+def finalize_stage(job):
+    if 'finalize' not in job['run_stages']:
+        return job
+    update_video_status(job['account_id'], job['year'], job['s3_key'])
+    record_stage(job, 'finalize')
+    remove_local_media(job['media_items'])
+    logger.info(f"Highlight reel for user {job['account_id']} uploaded to S3: {job['s3_key']}")
+    return job
+
+
+# Stages of a reel job in order, and whether they are CPU-bound
+REEL_STAGES = [
+    ('query', query_stage, False),
+    ('download', download_stage, False),
+    ('analyze', analyze_stage, True),
+    ('render', render_stage, True),
+    ('upload', upload_stage, False),
+    ('finalize', finalize_stage, False),
+]
+
+
+def run_job(job):
+    """
+    Run a job through every stage in this process, e.g. in the worker's process mode.
+
+    Stages completed by an earlier delivery of the same job are skipped.
+    """
+    for name, fn, _ in REEL_STAGES:
+        if job.get('skip'):
+            break
+        with span(f"stage:{name}"):
+            job = fn(job)
+    return job
+
+
+def build_reel_pipeline(cpu_executor=None):
+    """
+    Build the highlight reel pipeline.
+
+    Database and S3 stages run on threads; detection and rendering run on a process pool
+    shared by both CPU-bound stages, each process limited to its share of the CPUs.
+    """
+    io_workers = PIPELINE_CONFIG['io_workers']
+    cpu_workers = PIPELINE_CONFIG['cpu_workers']
+    cpu_executor = cpu_executor or ProcessPoolExecutor(max_workers=cpu_workers, initializer=apply_cpu_budget)
+
+    return JobPipeline([PipelineStage(name, fn, cpu_workers, cpu_executor) if cpu_bound
+                        else PipelineStage(name, fn, io_workers)
+                        for name, fn, cpu_bound in REEL_STAGES])
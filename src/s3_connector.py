@@ -1,29 +1,297 @@
+import base64
 import boto3
+import hashlib
+import json
 import os
-from config import S3_CONFIG
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from config import S3_CONFIG, MEDIA_CACHE_CONFIG
+from media_cache import get_media_cache, link_or_copy, s3_entry_name, s3_entry_prefix
+from metrics import incr, span
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
 
 
 def get_s3_client():
-    """Create and return an S3 client."""
-    return boto3.client('s3',
-                        aws_access_key_id=S3_CONFIG['aws_access_key_id'],
-                        aws_secret_access_key=S3_CONFIG['aws_secret_access_key'],
-                        region_name=S3_CONFIG['region_name'])
+    """
+    Return the S3 client shared by the whole process, creating it on first use.
+
+    boto3 clients are thread-safe, so every download and upload reuses the same session,
+    resolved credentials and connection pool. A forked process gets its own client.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = boto3.client('s3',
+                                       aws_access_key_id=S3_CONFIG['aws_access_key_id'],
+                                       aws_secret_access_key=S3_CONFIG['aws_secret_access_key'],
+                                       region_name=S3_CONFIG['region_name'],
+                                       config=Config(max_pool_connections=S3_CONFIG['max_pool_connections'],
+                                                     retries={'mode': 'standard'}))
+                _client_pid = os.getpid()
+    return _client
 
 
 def download_file_from_s3(bucket_name, object_key, local_path):
-    """Download a file from S3 to a local path."""
+    """
+    Download a file from S3 to a local path, going through the local media cache.
+
+    Cache entries are keyed by bucket, key and ETag. With ETag validation disabled a cached
+    copy is used without any request to S3.
+    """
     s3 = get_s3_client()
-    s3.download_file(bucket_name, object_key, local_path)
+    cache = get_media_cache()
+    if cache is None:
+        s3.download_file(bucket_name, object_key, local_path)
+        incr('reel_s3_bytes_total', os.path.getsize(local_path), direction='download')
+        return
+
+    etag = None
+    if MEDIA_CACHE_CONFIG['validate_etag']:
+        etag = s3.head_object(Bucket=bucket_name, Key=object_key)['ETag']
+        cached_path = cache.get(s3_entry_name(bucket_name, object_key, etag))
+    else:
+        cached_path = cache.get(cache.find(s3_entry_prefix(bucket_name, object_key)))
+
+    if cached_path is None:
+        if etag is None:
+            etag = s3.head_object(Bucket=bucket_name, Key=object_key)['ETag']
+        def fetch(temp_path):
+            # download_file does not take IfMatch; a conditional GET pins the cached copy to the ETag
+            body = s3.get_object(Bucket=bucket_name, Key=object_key, IfMatch=etag)['Body']
+            with open(temp_path, 'wb') as f:
+                shutil.copyfileobj(body, f, 1024 * 1024)
+            incr('reel_s3_bytes_total', os.path.getsize(temp_path), direction='download')
+
+        cached_path = cache.put(s3_entry_name(bucket_name, object_key, etag), fetch)
+
+    try:
+        link_or_copy(cached_path, local_path)
+    except FileNotFoundError:
+        # Evicted by another process in the meantime
+        s3.download_file(bucket_name, object_key, local_path)
+        incr('reel_s3_bytes_total', os.path.getsize(local_path), direction='download')
+
+
+def download_files_from_s3(bucket_name, downloads, max_workers=None, retries=None):
+    """
+    Download several objects from S3 in parallel.
+
+    Each object is retried with exponential backoff before it is reported as failed; a
+    failure does not stop the other downloads.
+
+    :param bucket_name: S3 bucket name
+    :param downloads: List of (object_key, local_path) tuples
+    :param max_workers: Number of concurrent downloads, defaults to S3_CONFIG['download_concurrency']
+    :param retries: Attempts per object after the first, defaults to S3_CONFIG['download_retries']
+    :return: Tuple of (downloaded object keys, dict of failed object key to error)
+    """
+    max_workers = max_workers or S3_CONFIG['download_concurrency']
+    retries = S3_CONFIG['download_retries'] if retries is None else retries
+
+    def download(object_key, local_path):
+        for attempt in range(retries + 1):
+            try:
+                download_file_from_s3(bucket_name, object_key, local_path)
+                return
+            except Exception:
+                if attempt == retries:
+                    raise
+                time.sleep(0.5 * 2 ** attempt)
+
+    succeeded = []
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(downloads)))) as executor:
+        futures = [(object_key, executor.submit(download, object_key, local_path))
+                   for object_key, local_path in downloads]
+        for object_key, future in futures:
+            try:
+                future.result()
+                succeeded.append(object_key)
+            except Exception as e:
+                failed[object_key] = e
 
+    return succeeded, failed
 
-def upload_file_to_s3(local_path, bucket_name, object_key):
-    """Upload a local file to S3."""
+
+# Content types of the files of an HLS rendition
+HLS_CONTENT_TYPES = {'.m3u8': 'application/vnd.apple.mpegurl', '.ts': 'video/mp2t', '.m4s': 'video/iso.segment'}
+
+
+def upload_file_to_s3(local_path, bucket_name, object_key, metadata=None, content_type=None):
+    """Upload a local file to S3, optionally with user metadata and a content type."""
     s3 = get_s3_client()
-    s3.upload_file(local_path, bucket_name, object_key)
+    extra_args = {}
+    if metadata:
+        extra_args['Metadata'] = metadata
+    if content_type:
+        extra_args['ContentType'] = content_type
+    s3.upload_file(local_path, bucket_name, object_key, ExtraArgs=extra_args or None)
+    incr('reel_s3_bytes_total', os.path.getsize(local_path), direction='upload')
+
+
+def upload_hls_to_s3(playlist_path, bucket_name, playlist_key, max_workers=None):
+    """
+    Upload an HLS playlist and the segments in its folder, in parallel.
+
+    Segments go next to the playlist's key, so the relative URIs in the playlist resolve.
+    The playlist is uploaded last, once every segment it lists is in place.
+
+    :return: The playlist's key
+    """
+    folder = os.path.dirname(playlist_path)
+    prefix = playlist_key.rsplit('/', 1)[0]
+    names = sorted(name for name in os.listdir(folder) if name != os.path.basename(playlist_path))
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers or S3_CONFIG['multipart_concurrency'],
+                                                   len(names) or 1))) as executor:
+        futures = [executor.submit(upload_file_to_s3, os.path.join(folder, name), bucket_name, f"{prefix}/{name}",
+                                   content_type=HLS_CONTENT_TYPES.get(os.path.splitext(name)[1]))
+                   for name in names]
+        for future in futures:
+            future.result()
+    upload_file_to_s3(playlist_path, bucket_name, playlist_key, content_type=HLS_CONTENT_TYPES['.m3u8'])
+    return playlist_key
+
+
+def _is_missing(error):
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+def get_object_metadata(bucket_name, object_key):
+    """Return the user metadata of an object, or None if it does not exist."""
+    try:
+        return get_s3_client().head_object(Bucket=bucket_name, Key=object_key).get('Metadata', {})
+    except ClientError as e:
+        if _is_missing(e):
+            return None
+        raise
+
+
+def read_json_from_s3(bucket_name, object_key):
+    """Return the decoded JSON document stored at a key, or None if it does not exist."""
+    try:
+        body = get_s3_client().get_object(Bucket=bucket_name, Key=object_key)['Body'].read()
+    except ClientError as e:
+        if _is_missing(e):
+            return None
+        raise
+    return json.loads(body)
+
+
+def write_json_to_s3(bucket_name, object_key, data):
+    """Store ``data`` as a JSON document; a single PUT replaces the previous version atomically."""
+    get_s3_client().put_object(Bucket=bucket_name, Key=object_key, Body=json.dumps(data, default=str).encode(),
+                               ContentType='application/json')
+
+
+class S3MultipartWriter:
+    """
+    File-like sink that uploads everything written to it as an S3 multipart upload.
+
+    Data is cut into parts of ``part_size`` bytes which are uploaded on background threads
+    while the caller keeps writing, with at most ``max_concurrency`` parts in flight. Each part
+    is sent with its MD5 so S3 rejects corrupted parts, and the ETag of the completed object is
+    checked against the one expected from the part digests. Used as a context manager, the
+    upload is completed on success and aborted if the block raises.
+    """
+
+    def __init__(self, bucket_name, object_key, part_size=None, max_concurrency=None, content_type='video/mp4',
+                 metadata=None):
+        self.bucket_name = bucket_name
+        self.object_key = object_key
+        self.part_size = part_size or S3_CONFIG['multipart_part_size']
+        self.s3 = get_s3_client()
+        self.buffer = bytearray()
+        self.parts = {}  # part number -> (md5 digest, future)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency or S3_CONFIG['multipart_concurrency'])
+        self.slots = threading.BoundedSemaphore(max_concurrency or S3_CONFIG['multipart_concurrency'])
+        self.bytes_written = 0
+        self.upload_id = self.s3.create_multipart_upload(Bucket=bucket_name, Key=object_key, ContentType=content_type,
+                                                         Metadata=metadata or {})['UploadId']
+
+    def _upload_part(self, part_number, data, digest):
+        try:
+            response = self.s3.upload_part(Bucket=self.bucket_name, Key=self.object_key, UploadId=self.upload_id,
+                                           PartNumber=part_number, Body=data,
+                                           ContentMD5=base64.b64encode(digest).decode())
+            etag = response['ETag'].strip('"')
+            # ETags are the part MD5 unless the bucket uses SSE-KMS, where ContentMD5 still guards the part
+            if re.fullmatch(r'[0-9a-f]{32}', etag) and etag != digest.hex():
+                raise IOError(f"Checksum mismatch for part {part_number} of {self.object_key}")
+            incr('reel_s3_bytes_total', len(data), direction='upload')
+            return response['ETag']
+        finally:
+            self.slots.release()
+
+    def _submit_part(self, data):
+        for _, future in self.parts.values():
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        part_number = len(self.parts) + 1
+        digest = hashlib.md5(data).digest()
+        self.slots.acquire()
+        self.parts[part_number] = (digest, self.executor.submit(self._upload_part, part_number, data, digest))
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._submit_part(part)
+        return len(data)
+
+    def close(self):
+        """Upload the last part, complete the upload and verify the object's checksum."""
+        if self.buffer or not self.parts:
+            self._submit_part(bytes(self.buffer))
+            self.buffer.clear()
+
+        # Most parts went up while encoding; this is the time the caller waits after the last write
+        with span('upload', key=self.object_key, streamed=True, bytes=self.bytes_written):
+            parts = [{'PartNumber': number, 'ETag': future.result()}
+                     for number, (_, future) in sorted(self.parts.items())]
+            self.executor.shutdown()
+            response = self.s3.complete_multipart_upload(Bucket=self.bucket_name, Key=self.object_key,
+                                                         UploadId=self.upload_id, MultipartUpload={'Parts': parts})
+
+        combined = hashlib.md5(b''.join(digest for digest, _ in self.parts.values())).hexdigest()
+        expected_etag = f"{combined}-{len(self.parts)}"
+        etag = response.get('ETag', '').strip('"')
+        if re.fullmatch(r'[0-9a-f]{32}-\d+', etag) and etag != expected_etag:
+            raise IOError(f"Checksum mismatch for {self.object_key}: expected {expected_etag}, got {etag}")
+
+    def abort(self):
+        """Abandon the upload and let S3 discard the parts uploaded so far."""
+        self.executor.shutdown(cancel_futures=True)
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.object_key, UploadId=self.upload_id)
+        except Exception as e:
+            print(f"Error aborting multipart upload of {self.object_key}: {str(e)}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+        try:
+            self.close()
+        except Exception:
+            self.abort()
+            raise
 
 
-def upload_video_and_cleanup(local_path, bucket_name, object_key, temp_files):
+def upload_video_and_cleanup(local_path, bucket_name, object_key, temp_files, metadata=None):
     """
     Upload the video to S3 and delete local files.
 
@@ -31,11 +299,12 @@ def upload_video_and_cleanup(local_path, bucket_name, object_key, temp_files):
     :param bucket_name: S3 bucket name
     :param object_key: S3 object key for the uploaded file
     :param temp_files: List of temporary files to be deleted
+    :param metadata: Optional user metadata stored with the object
     :return: S3 URL of the uploaded video
     """
     try:
         # Upload the video to S3
-        upload_file_to_s3(local_path, bucket_name, object_key)
+        upload_file_to_s3(local_path, bucket_name, object_key, metadata)
 
         # Generate the S3 URL for the uploaded file
         s3_url = f"https://{bucket_name}.s3.amazonaws.com/{object_key}"
@@ -1,85 +1,363 @@
-from moviepy.editor import VideoFileClip, concatenate_videoclips, CompositeAudioClip, AudioFileClip
-from image_processing import generate_video_from_images
-from video_processing import extract_subvideo
-from s3_connector import upload_video_and_cleanup
+from image_processing import resize_and_crop_image, preprocess_images, TransitionRenderer, ANIMATION_BATCH_SIZE
+from video_processing import plan_subvideo, subvideo_output_frame_count, iter_subvideo_frames
+from ffmpeg_writer import FFmpegPipeWriter, mux_audio
+from s3_connector import upload_video_and_cleanup, S3MultipartWriter
+from media_cache import get_segment_cache, file_digest
+from encoding import get_profile
+from metrics import incr, span
+from config import S3_CONFIG, RENDER_CONFIG, SEGMENT_CACHE_CONFIG
+import hashlib
+import json
+import numpy as np
 import os
 
+IMAGE_CLIP_DURATION = 3
+ANIMATION_EFFECTS = ['fade', 'zoom', 'slide', 'rotate']
+# Bitrate of reels rendered without a rendition
+DEFAULT_BITRATE = '5000k'
+# Part of every segment cache key; bump it whenever rendering changes so stale frames are not reused
+SEGMENT_CACHE_VERSION = 2
 
-def generate_video_video(media_items, output_path, audio_path=None, target_size=(480, 480), frame_rate=24):
-    """Generate a video from a list of media items."""
-    video_clips = []
-    image_paths = []
-    temp_files = []
+
+class NothingToRenderError(Exception):
+    """Raised when none of the media of a reel could be rendered."""
+
+
+def get_renditions(spec=None):
+    """
+    Parse a list of renditions such as ``main:480x480:5000k,hd:720x720:8000k:hls``.
+
+    Each rendition is ``name:WIDTHxHEIGHT:bitrate``, with ``:hls`` to write an HLS playlist
+    instead of an MP4. The reel is rendered once at the largest size and scaled for the others,
+    so every rendition must have the same aspect ratio. The first one is the primary output
+    and must be an MP4.
+
+    :param spec: Rendition list, defaults to RENDER_CONFIG['renditions']
+    :return: List of dicts with name, size, bitrate and format
+    :raises ValueError: If the list is malformed
+    """
+    renditions = []
+    for entry in (spec or RENDER_CONFIG['renditions']).split(','):
+        parts = entry.strip().split(':')
+        if len(parts) not in (3, 4) or (len(parts) == 4 and parts[3] != 'hls'):
+            raise ValueError(f"Invalid rendition: {entry}")
+        width, height = (int(side) for side in parts[1].lower().split('x'))
+        renditions.append({'name': parts[0], 'size': (width, height), 'bitrate': parts[2],
+                           'format': 'hls' if len(parts) == 4 else 'mp4'})
+
+    if renditions[0]['format'] != 'mp4':
+        raise ValueError("The first rendition must be an MP4")
+    if len({rendition['name'] for rendition in renditions}) != len(renditions):
+        raise ValueError("Rendition names must be unique")
+    width, height = render_size(renditions)
+    for rendition in renditions:
+        if abs(rendition['size'][0] / rendition['size'][1] - width / height) > 0.01:
+            raise ValueError(f"Rendition {rendition['name']} does not have the aspect ratio of {width}x{height}")
+    return renditions
+
+
+def render_size(renditions):
+    """Size the reel is rendered at: that of its largest rendition."""
+    return max((tuple(rendition['size']) for rendition in renditions), key=lambda size: size[0] * size[1])
+
+
+def rendition_paths(output_path, renditions):
+    """
+    Local path of every rendition: the primary at ``output_path`` and the others next to it, an
+    HLS rendition as ``index.m3u8`` in a folder of its own.
+    """
+    base = os.path.splitext(output_path)[0]
+    paths = {}
+    for index, rendition in enumerate(renditions):
+        if index == 0:
+            paths[rendition['name']] = output_path
+        elif rendition['format'] == 'hls':
+            paths[rendition['name']] = os.path.join(f"{base}_{rendition['name']}", 'index.m3u8')
+        else:
+            paths[rendition['name']] = f"{base}_{rendition['name']}.mp4"
+    return paths
+
+
+def plan_videos(media_items, target_size=None, frame_rate=24):
+    """
+    Pick the sub-segment of every video item; this is where people/face detection runs.
+
+    :param target_size: Size the reel is rendered at; when given, segments are saved for the render
+                        while they are decoded (see ``plan_subvideo``)
+    :return: Dict of video path to its plan, or None where extraction failed
+    """
+    return {item['path']: plan_subvideo(item['path'], file_id=item.get('id'), target_size=target_size,
+                                        frame_rate=frame_rate)
+            for item in media_items if item['type'] == 'video'}
+
+
+def _cache_key(*parts):
+    return hashlib.sha256(json.dumps([SEGMENT_CACHE_VERSION, *parts]).encode()).hexdigest()
+
+
+def plan_segments(media_items, target_size=(480, 480), frame_rate=24, video_plans=None, cache=None):
+    """
+    Prepare every media item as a segment of the reel, in order.
+
+    Images are decoded and cropped up front, all at once on a thread pool, and get an animation
+    effect by their position in their group of consecutive images; videos get the sub-segment picked by ``plan_subvideo``,
+    unless it was already computed by ``plan_videos``. Items that cannot be processed are skipped.
+
+    With a ``cache``, every segment gets a ``cache_key`` derived from the source file's content
+    and the render parameters. If the cache keeps segment frames (SEGMENT_CACHE_FRAMES), images
+    whose frames are cached are not decoded.
+    """
+    segments = []
+    to_prepare = []  # Image segments whose frames have to be rendered from the decoded image
+    group_index = 0
+    digests = {}
+
+    def digest(path):
+        if path not in digests:
+            digests[path] = file_digest(path)
+        return digests[path]
 
     for item in media_items:
         if item['type'] == 'image':
-            image_paths.append(item['path'])
+            effect_type = ANIMATION_EFFECTS[group_index % len(ANIMATION_EFFECTS)]
+            group_index += 1
+            frame_count = int(round(IMAGE_CLIP_DURATION * frame_rate))
+            segment = {'type': 'image', 'path': item['path'], 'effect': effect_type, 'frame_count': frame_count}
+            if cache is not None:
+                try:
+                    segment['cache_key'] = _cache_key('image', digest(item['path']), effect_type, list(target_size),
+                                                      frame_rate, frame_count)
+                except OSError as e:
+                    print(f"Error processing image {item['path']}: {str(e)}")
+                    continue
+                if SEGMENT_CACHE_CONFIG['frames'] and cache.contains(f"{segment['cache_key']}.npy"):
+                    segments.append(segment)
+                    continue
+            to_prepare.append(segment)
+            segments.append(segment)
         elif item['type'] == 'video':
-            if image_paths:
-                temp_output = f"temp_image_group_{len(video_clips)}.mp4"
-                generate_video_from_images(image_paths, temp_output, frame_rate=frame_rate, target_size=target_size)
-                video_clips.append(VideoFileClip(temp_output))
-                temp_files.append(temp_output)
-                image_paths = []
-
-            # Handle different video extensions
-            file_name, file_extension = os.path.splitext(item['path'])
-            temp_sub_video_path = f"{file_name}_sub{file_extension}"
-
-            sub_video_path = extract_subvideo(item['path'], temp_sub_video_path)
-            if sub_video_path is None:
+            group_index = 0
+            plan = video_plans[item['path']] if video_plans is not None else plan_subvideo(item['path'],
+                                                                                           file_id=item.get('id'))
+            if plan is None:
                 print(f"Error when extracting subvideo from: {item['path']}")
                 continue
-            video_clips.append(VideoFileClip(sub_video_path))
-            temp_files.append(sub_video_path)
-
-    # Handle any remaining images
-    if image_paths:
-        temp_output = f"temp_image_group_{len(video_clips)}.mp4"
-        generate_video_from_images(image_paths, temp_output, frame_rate=frame_rate, target_size=target_size)
-        video_clips.append(VideoFileClip(temp_output))
-        temp_files.append(temp_output)
-
-    # Concatenate all video clips
-    final_video = concatenate_videoclips(video_clips)
-
-    # Resize the final video to ensure it matches the target size
-    final_video = final_video.resize(target_size)
-
-    if audio_path:
-        audio = AudioFileClip(audio_path)
-        # Ensure the audio is not longer than the video
-        audio = audio.subclip(0, min(final_video.duration, audio.duration))
-        final_video = final_video.set_audio(audio)
-
-    # Write the final video file
-    final_video.write_videofile(
-        output_path,
-        fps=frame_rate,
-        codec='libx264',
-        audio_codec='aac',
-        preset='medium',
-        bitrate='5000k'
-    )
-
-    # Clean up temporary files
-    for clip in video_clips:
-        clip.close()
-    for file in temp_files:
-        if os.path.exists(file):
-            os.remove(file)
-
-    return output_path
+            segment = {'type': 'video', 'plan': plan, 'frame_count': subvideo_output_frame_count(plan, frame_rate)}
+            if cache is not None:
+                segment['cache_key'] = _cache_key('video', plan.get('content_hash') or digest(plan['path']),
+                                                  plan['start_frame'], plan['frame_count'], plan['fps'],
+                                                  list(target_size), frame_rate)
+            segments.append(segment)
+
+    failed = set()
+    prepared = preprocess_images([segment['path'] for segment in to_prepare], target_size)
+    for segment, (img, error) in zip(to_prepare, prepared):
+        if error is not None:
+            failed.add(id(segment))
+        segment['image'] = img
+    return [segment for segment in segments if id(segment) not in failed]
+
+
+def _iter_segment_batches(segment, target_size, frame_rate):
+    """Yield ``(start_index, frames)`` for every batch of frames of a segment."""
+    if segment['type'] == 'image':
+        img = segment.get('image')
+        if img is None:
+            # Planned from the cache but evicted since
+            img = resize_and_crop_image(segment['path'], target_size)
+            if img is None:
+                raise IOError(f"Unable to read image: {segment['path']}")
+        renderer = TransitionRenderer(img, segment['effect'], segment['frame_count'])
+        yield from renderer.iter_batches()
+    else:
+        for index, frame in enumerate(iter_subvideo_frames(segment['plan'], target_size, frame_rate)):
+            yield index, frame[None]
+
+
+def _render_segment(segment, writer, target_size, frame_rate, frames_path=None):
+    """Render a segment into ``writer``, also saving its frames as a .npy file at ``frames_path``."""
+    saved = None
+    if frames_path is not None:
+        shape = (segment['frame_count'], target_size[1], target_size[0], 3)
+        saved = np.lib.format.open_memmap(frames_path, mode='w+', dtype=np.uint8, shape=shape)
+    try:
+        for start, frames in _iter_segment_batches(segment, target_size, frame_rate):
+            writer.write_frames(frames)
+            if saved is not None:
+                saved[start:start + len(frames)] = frames
+        if saved is not None:
+            saved.flush()
+    finally:
+        del saved
+
+
+def _write_cached_frames(path, writer):
+    frames = np.load(path, mmap_mode='r')
+    for start in range(0, len(frames), ANIMATION_BATCH_SIZE):
+        writer.write_frames(frames[start:start + ANIMATION_BATCH_SIZE])
+
+
+def write_segments(segments, writer, target_size=(480, 480), frame_rate=24, cache=None):
+    """
+    Render each planned segment and stream its frames into ``writer``.
+
+    With a ``cache`` and SEGMENT_CACHE_FRAMES enabled, segments with cached frames are read back
+    instead of rendered, and the frames of the other segments are saved to the cache while they
+    are rendered.
+    """
+    if not SEGMENT_CACHE_CONFIG['frames']:
+        cache = None
+    for segment in segments:
+        with span('segment_render', type=segment['type'], frames=segment['frame_count']) as attributes:
+            name = f"{segment['cache_key']}.npy" if cache is not None and 'cache_key' in segment else None
+            cached_path = cache.get(name) if name else None
+            attributes['cached'] = cached_path is not None
+            if cached_path is not None:
+                try:
+                    _write_cached_frames(cached_path, writer)
+                    continue
+                except FileNotFoundError:
+                    pass  # Evicted by another process in the meantime; nothing was written yet
+
+            if name:
+                cache.put(name, lambda temp_path: _render_segment(segment, writer, target_size, frame_rate,
+                                                                  temp_path))
+            else:
+                _render_segment(segment, writer, target_size, frame_rate)
+            incr('reel_frames_rendered_total', segment['frame_count'], type=segment['type'])
+
+
+def encode_segments(segments, output_path, target_size=(480, 480), frame_rate=24, audio_path=None,
+                    audio_duration=None, output_stream=None, cache=None, ffmpeg_params=None, rendition=None,
+                    extra_outputs=None, encoder=None):
+    """
+    Render the segments into a single ffmpeg process, encoding the reel exactly once.
+
+    :param rendition: Size and bitrate of the output, if not ``target_size`` and the default bitrate
+    :param extra_outputs: Further outputs the same ffmpeg process encodes from the frames, see
+                          ``FFmpegPipeWriter``
+    :param encoder: Encoder profile name (see ``encoding.ENCODER_PROFILES``), defaults to ENCODER_PROFILE
+    """
+    settings = dict(get_profile(encoder), bitrate=rendition['bitrate'] if rendition else DEFAULT_BITRATE)
+    writer = FFmpegPipeWriter(output_path, target_size, frame_rate, audio_path=audio_path,
+                              audio_duration=audio_duration, ffmpeg_params=ffmpeg_params,
+                              output_stream=output_stream, output_size=rendition['size'] if rendition else None,
+                              extra_outputs=extra_outputs, **settings)
+    try:
+        write_segments(segments, writer, target_size, frame_rate, cache)
+    except BaseException:
+        writer.abort()
+        raise
+    # Time spent waiting for ffmpeg to encode the frames still in its pipe and finish the file
+    with span('encode', frames=sum(segment['frame_count'] for segment in segments)):
+        writer.close()
+
+
+def generate_video_video(media_items, output_path, audio_path=None, target_size=(480, 480), frame_rate=24,
+                         video_plans=None, output_stream=None, renditions=None, encoder=None):
+    """
+    Generate a video from a list of media items.
+
+    All segments are streamed as raw frames into a single ffmpeg process, so the reel is
+    encoded exactly once and no intermediate files are written. With ``output_stream`` the
+    reel is written to it as fragmented MP4 while it is encoded, and nothing is written to
+    ``output_path``.
+
+    With ``renditions`` (see ``get_renditions``) the reel is rendered once at the largest
+    rendition's size, and the same ffmpeg process encodes every rendition from those frames
+    to the paths given by ``rendition_paths``; ``target_size`` is then ignored.
+
+    When the segment cache is enabled the encoded video, without audio, is cached as well and
+    the audio is muxed in afterwards, so a retry or a new audio track only redoes the mux.
+    Reels with extra renditions are encoded in one pass with their audio instead.
+
+    :param encoder: Encoder profile name, defaults to ENCODER_PROFILE
+    :return: ``output_path`` (``output_stream`` when streaming), or None if there was nothing to render
+    """
+    profile = get_profile(encoder)
+    primary = extra_outputs = None
+    if renditions is not None:
+        target_size = render_size(renditions)
+        primary = renditions[0]
+        paths = rendition_paths(output_path, renditions) if len(renditions) > 1 else {}
+        if paths and output_stream is not None:
+            raise ValueError("Extra renditions are written to files and cannot be streamed")
+        extra_outputs = [{'path': paths[rendition['name']], 'size': rendition['size'],
+                          'bitrate': rendition['bitrate'],
+                          'hls_time': RENDER_CONFIG['hls_segment_seconds'] if rendition['format'] == 'hls' else None}
+                         for rendition in renditions[1:]]
+
+    cache = get_segment_cache()
+    segments = plan_segments(media_items, target_size, frame_rate, video_plans, cache)
+    if not segments:
+        print("No valid media to process.")
+        return None
+
+    total_frames = sum(segment['frame_count'] for segment in segments)
+
+    if cache is None or extra_outputs:
+        # The audio is trimmed so it is not longer than the video
+        encode_segments(segments, output_path, target_size, frame_rate, audio_path, total_frames / frame_rate,
+                        output_stream, cache, rendition=primary, extra_outputs=extra_outputs, encoder=encoder)
+        return output_path if output_stream is None else output_stream
+
+    # Threads change how fast the reel is encoded, not what is encoded
+    encoding = {key: value for key, value in profile.items() if key != 'threads'}
+    encoding['bitrate'] = primary['bitrate'] if primary else DEFAULT_BITRATE
+    if primary is not None:
+        encoding['size'] = list(primary['size'])
+    name = _cache_key('reel', [segment['cache_key'] for segment in segments], list(target_size), frame_rate,
+                      encoding) + '.mp4'
+    video_path = cache.get(name)
+    if video_path is None:
+        # Cache entries are written under a temporary name, so the container format is given explicitly
+        video_path = cache.put(name, lambda temp_path: encode_segments(
+            segments, temp_path, target_size, frame_rate, cache=cache, ffmpeg_params=['-f', 'mp4'],
+            rendition=primary, encoder=encoder))
+    with span('mux', audio=bool(audio_path)):
+        mux_audio(video_path, output_path, audio_path, total_frames / frame_rate, output_stream=output_stream)
+
+    return output_path if output_stream is None else output_stream
+
+
+def stream_video_to_s3(media_items, s3_bucket, s3_key, audio_path=None, target_size=(480, 480), frame_rate=24,
+                       video_plans=None, metadata=None, rendition=None, encoder=None):
+    """
+    Generate a video and upload it to S3 while it is being encoded, without a local file.
+
+    :param metadata: Optional user metadata stored with the object
+    :param rendition: Optional rendition to encode instead of ``target_size`` at the default bitrate
+    :param encoder: Encoder profile name, defaults to ENCODER_PROFILE
+    :return: The S3 key
+    :raises NothingToRenderError: If there was nothing to render; the upload is aborted
+    """
+    with S3MultipartWriter(s3_bucket, s3_key, metadata=metadata) as upload:
+        if generate_video_video(media_items, None, audio_path, target_size, frame_rate, video_plans,
+                                output_stream=upload, renditions=[rendition] if rendition else None,
+                                encoder=encoder) is None:
+            raise NothingToRenderError("No valid media to process.")
+    return s3_key
 
 
 def process_and_upload_video(media_items, output_path, audio_path=None, target_size=(480, 480), frame_rate=24,
                                  s3_bucket=None):
     """Generate video, optionally upload to S3, and clean up."""
+    if s3_bucket and S3_CONFIG['stream_upload']:
+        s3_key = f"videos/{os.path.basename(output_path)}"
+        try:
+            return stream_video_to_s3(media_items, s3_bucket, s3_key, audio_path, target_size, frame_rate)
+        except NothingToRenderError as e:
+            print(str(e))
+            return None
+
     local_path = generate_video_video(media_items, output_path, audio_path, target_size, frame_rate)
+    if local_path is None:
+        return None
 
     if s3_bucket:
         s3_key = f"videos/{os.path.basename(output_path)}"
-        upload_video_and_cleanup(local_path, s3_bucket, s3_key, [])
+        with span('upload', key=s3_key):
+            upload_video_and_cleanup(local_path, s3_bucket, s3_key, [])
         return s3_key
     else:
         return local_path
@@ -1,70 +1,28 @@
 import cv2
 import numpy as np
 import os
-from multiprocessing import Pool, cpu_count
 import math
 import time
 import logging
-from datetime import datetime
-from s3_connector import download_file_from_s3
-from config import S3_CONFIG, APP_CONFIG
-
-# Set up logging
-log_file = f"video_processing_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s',
-                    handlers=[
-                        logging.FileHandler(log_file),
-                        logging.StreamHandler()
-                    ])
-
-
-def get_yolo_path(filename):
-    """Get the path for YOLO files, downloading from S3 if necessary"""
-    local_path = f"{APP_CONFIG['temp_folder']}/{filename}"
-    if not os.path.exists(local_path):
-        s3_bucket = S3_CONFIG['bucket_name']
-        s3_key = f"yolo/{filename}"
-        try:
-            download_file_from_s3(s3_bucket, s3_key, local_path)
-        except Exception as e:
-            logging.error(f"Failed to download {filename} from S3: {str(e)}")
-            raise
-    return local_path
-
-
-def detect_people_yolo(frame, net, ln, confidence_threshold=0.5):
-    (H, W) = frame.shape[:2]
-    blob = cv2.dnn.blobFromImage(frame, 1 / 255.0, (416, 416), swapRB=True, crop=False)
-    net.setInput(blob)
-    layerOutputs = net.forward(ln)
-
-    boxes = []
-    confidences = []
-    for output in layerOutputs:
-        for detection in output:
-            scores = detection[5:]
-            classID = np.argmax(scores)
-            confidence = scores[classID]
-            if classID == 0 and confidence > confidence_threshold:  # 0 is the class ID for person
-                box = detection[0:4] * np.array([W, H, W, H])
-                (centerX, centerY, width, height) = box.astype("int")
-                x = int(centerX - (width / 2))
-                y = int(centerY - (height / 2))
-                boxes.append([x, y, int(width), int(height)])
-                confidences.append(float(confidence))
-
-    return boxes, confidences
-
-
-def detect_faces(args):
-    frame, frame_number, fps = args
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
-    if len(faces) > 0:
-        return frame_number, frame_number / fps, f"Faces detected: {len(faces)}"
-    return None
+from detectors import make_people_detector
+from frame_sampling import make_sampler, refine_hit
+from face_pool import FaceDetectionStream
+from media_cache import file_digest
+from analysis_index import detector_signature, lookup_analysis, record_analysis, record_file, record_rejection
+from metrics import span
+from config import ANALYSIS_CONFIG, DETECTION_CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+def downscale_for_detection(frame, max_side=None):
+    """Shrink a frame so its longest side is at most ``max_side`` pixels."""
+    max_side = max_side or DETECTION_CONFIG['max_side']
+    h, w = frame.shape[:2]
+    scale = max_side / max(h, w)
+    if scale >= 1:
+        return frame
+    return cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
 
 
 def resize_frame_with_padding(frame, target_size):
@@ -89,7 +47,7 @@ def extract_subvideo_segment(cap, start_frame, fps, video_duration, duration, ta
     start_time = start_frame / fps
     end_time = min(start_time + np.random.uniform(duration[0], duration[1]), video_duration)
 
-    logging.info(f"Extracting subvideo from {start_time:.2f}s to {end_time:.2f}s")
+    logger.info(f"Extracting subvideo from {start_time:.2f}s to {end_time:.2f}s")
 
     # Ensure output file has .mp4 extension
     output_path = os.path.splitext(output_path)[0] + '.mp4'
@@ -112,107 +70,471 @@ def extract_subvideo_segment(cap, start_frame, fps, video_duration, duration, ta
         frame_count += 1
 
         if frame_count % 30 == 0:  # Log progress every 30 frames
-            logging.info(f"Processed {frame_count}/{total_frames_to_extract} frames")
+            logger.debug(f"Processed {frame_count}/{total_frames_to_extract} frames")
 
     cap.release()
     out.release()
 
-    logging.info(f"Subvideo saved to {output_path}")
+    logger.info(f"Subvideo saved to {output_path}")
     return output_path
 
 
-def extract_subvideo(video_path, output_path, target_size=(480, 480), duration=(5, 8), confidence_threshold=0.7,
-                     max_video_duration=40):
+def _segment_frame_count(start_frame, fps, seconds, video_duration):
+    start_time = start_frame / fps
+    end_time = min(start_time + seconds, video_duration)
+    return int((end_time - start_time) * fps)
+
+
+def _source_frame(fps, frame_count, output_index, frame_rate):
+    # Frame of the segment shown at an output frame, picked the way a clip reader samples a file at a given time
+    return min(int(fps * output_index / frame_rate + 0.00001), frame_count - 1)
+
+
+class SegmentRecorder:
+    """
+    Save the segment of a video picked by detection while detection decodes the video, so the render
+    reads it back (see ``iter_subvideo_frames``) instead of opening the video again and seeking to it.
+
+    Detection feeds the frames from the segment's start on, in decode order, and may start the
+    segment again at another frame, e.g. when a people hit comes after a face hit. The segment is
+    saved as ``iter_subvideo_frames`` renders it: resampled to ``frame_rate``, padded to
+    ``target_size`` and converted to RGB, in a .npy file at ``path``.
+    """
+
+    def __init__(self, path, fps, seconds, video_duration, target_size, frame_rate):
+        self.path = path
+        self.fps = fps
+        self.seconds = seconds
+        self.video_duration = video_duration
+        self.target_size = target_size
+        self.frame_rate = frame_rate
+        self.start_frame = None
+        self.frame_count = 0
+        self.frames = None
+        self.next_index = None
+        self.written = 0
+        self.broken = False
+
+    @property
+    def temp_path(self):
+        return f"{self.path}.tmp"
+
+    @property
+    def recording(self):
+        return self.frames is not None and not self.broken and self.written < len(self.frames)
+
+    def start(self, start_frame, kept=()):
+        """
+        Start the segment at ``start_frame``.
+
+        :param kept: (frame_index, frame) pairs decoded so far, in decode order; those from ``start_frame`` on are added
+        """
+        self.discard()
+        self.start_frame = start_frame
+        self.frame_count = _segment_frame_count(start_frame, self.fps, self.seconds, self.video_duration)
+        outputs = subvideo_output_frame_count({'fps': self.fps, 'frame_count': self.frame_count}, self.frame_rate)
+        if outputs == 0:
+            self.broken = True
+            return
+        self.frames = np.lib.format.open_memmap(self.temp_path, mode='w+', dtype=np.uint8,
+                                                shape=(outputs, self.target_size[1], self.target_size[0], 3))
+        self.next_index = start_frame
+        for index, frame in kept:
+            self.add(index, frame)
+
+    def add(self, index, frame):
+        """Add the next decoded BGR frame of the video; frames before the segment are ignored."""
+        if not self.recording or index < self.next_index:
+            return
+        if index != self.next_index:
+            # A frame of the segment was not kept
+            self.broken = True
+            return
+        image = None
+        relative = index - self.start_frame
+        while self.written < len(self.frames) and _source_frame(self.fps, self.frame_count, self.written,
+                                                                self.frame_rate) == relative:
+            if image is None:
+                image = cv2.cvtColor(resize_frame_with_padding(frame, self.target_size), cv2.COLOR_BGR2RGB)
+            self.frames[self.written] = image
+            self.written += 1
+        self.next_index += 1
+
+    def finish(self, cap, start_frame):
+        """
+        Read the rest of the segment from ``cap`` and save it, if the segment starts at ``start_frame``.
+
+        :return: Path of the saved frames, or None if the segment was not recorded
+        """
+        if self.start_frame != start_frame:
+            self.discard()
+            return None
+        while self.recording:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            self.add(self.next_index, frame)
+        if self.broken or self.written == 0:
+            self.discard()
+            return None
+        # Like iter_subvideo_frames, repeat the last frame if the stream ended early
+        self.frames[self.written:] = self.frames[self.written - 1]
+        self.frames.flush()
+        self.frames = None
+        os.replace(self.temp_path, self.path)
+        return self.path
+
+    def discard(self):
+        """Drop the frames recorded so far."""
+        self.frames = None
+        self.start_frame = None
+        self.written = 0
+        self.broken = False
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_segment_frames(plans):
+    """Delete the segments saved by ``plan_subvideo`` once the reel no longer needs them."""
+    for plan in plans:
+        if plan and plan.get('frames_path'):
+            try:
+                os.remove(plan['frames_path'])
+            except FileNotFoundError:
+                pass
+
+
+def detect_subvideo_start(cap, fps, total_frames, confidence_threshold=0.7, video_path=None, segment=None):
+    """
+    Find the first frame showing people or, failing that, faces, with the configured detectors
+    (YOLOv3 and the Haar cascade by default, see ``detectors``).
+
+    Reads the capture forward from its current position. Only the frames chosen by the
+    configured sampler are converted and run through the detectors, the others are just
+    grabbed. With DETECTION_REFINE the frames between samples are also kept, downscaled, until a
+    sample misses, so a people hit is refined back towards the last missed sample from frames
+    already decoded, without seeking. Frames without people are streamed to the face detection pool while
+    YOLO keeps going, so no decoded frames are retained for a later face pass.
+
+    With a ``segment``, frames are kept until neither YOLO nor the face pool can still start the
+    reel's segment at them, and every frame from the start found is fed to the segment, so it
+    does not have to be decoded again.
+
+    :param segment: Optional ``SegmentRecorder``
+    :return: Tuple of (start_frame, reason, complete); start_frame is 0 when nothing was detected,
+             and complete is False when face detection gave up, so the result is not final
+    """
+    people = make_people_detector()
+    # The sampler maps timestamps to frames, so it gets the exact rate (29.97, not 29)
+    sampler = make_sampler(cap.get(cv2.CAP_PROP_FPS) or fps, total_frames, video_path)
+    refine = DETECTION_CONFIG['refine']
+    keep = refine or segment is not None
+
+    def has_people(frame):
+        boxes, _ = people.detect([frame], confidence_threshold=confidence_threshold)[0]
+        return bool(boxes)
+
+    # Process sampled frames with YOLO, batch_size frames per forward pass
+    batch_size = DETECTION_CONFIG['batch_size']
+    faces = FaceDetectionStream(fps)
+    batch = []  # Sampled (frame_index, frame) waiting for the next forward pass
+    window = []  # Downscaled (frame_index, frame) kept for refinement and the segment
+    last_miss = -1
+
+    def keep_frame(index, frame):
+        window.append((index, downscale_for_detection(frame)))
+        if segment is not None:
+            segment.add(index, frame)
+
+    def refine_start(index):
+        if not refine:
+            return index
+        candidates = [(candidate, frame) for candidate, frame in window if last_miss < candidate < index]
+        refined = refine_hit(candidates, has_people) if candidates else None
+        return index if refined is None else refined
+
+    def process_batch():
+        nonlocal last_miss
+        results = people.detect([frame for _, frame in batch], confidence_threshold=confidence_threshold)
+        for (index, frame), (boxes, _) in zip(batch, results):
+            if boxes:
+                start_frame = refine_start(index)
+                if segment is not None:
+                    segment.start(start_frame, window)
+                logger.info(f"People detected at frame {start_frame} at {start_frame / fps:.2f}s: {len(boxes)}")
+                return start_frame, f"People detected: {len(boxes)}", True
+
+            last_miss = index
+            # Slots are released by the pool callbacks, so abandoning the stream on a YOLO hit is safe
+            faces.submit(frame, index)
+
+        logger.debug(f"Processed {batch[-1][0]}/{total_frames} frames with YOLO")
+        batch.clear()
+        # Every frame kept so far is before the last miss now, but a face hit may still start the segment
+        horizon = last_miss + 1
+        if segment is not None and segment.start_frame is None:
+            # Read the pending frames first: one of them may settle a hit in between
+            pending = faces.earliest_pending()
+            face_hit = faces.settled_hit()
+            if face_hit is not None:
+                segment.start(face_hit[0], window)
+            elif pending is not None:
+                horizon = min(horizon, pending)
+        window[:] = [kept for kept in window if kept[0] >= horizon]
+        return None
+
+    for i in range(total_frames):
+        if not sampler.is_sampled(i):
+            if not cap.grab():
+                break
+            if keep:
+                ret, frame = cap.retrieve()
+                if ret:
+                    keep_frame(i, frame)
+            continue
+
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if keep:
+            keep_frame(i, frame)
+
+        batch.append((i, frame))
+        if len(batch) >= batch_size:
+            hit = process_batch()
+            if hit:
+                return hit
+
+    if batch:
+        hit = process_batch()
+        if hit:
+            return hit
+
+    logger.info("No people detected with YOLO. Waiting for face detection.")
+    face_hit = faces.result()
+
+    if face_hit:
+        start_frame, start_time, reason = face_hit
+        if segment is not None and segment.start_frame != start_frame:
+            segment.start(start_frame, window)
+        logger.info(f"Faces detected at frame {start_frame} at {start_time:.2f}s: {reason}")
+        return start_frame, reason, True
+
+    logger.info("No people or faces detected in the video.")
+
+    # If no interesting content found, use the beginning of the video
+    return 0, None, not faces.abandoned
+
+
+def find_subvideo_start(cap, fps, total_frames, confidence_threshold=0.7, video_path=None, file_id=None,
+                        content_hash=None, segment=None):
+    """
+    ``detect_subvideo_start`` through the analysis index: a video analyzed before with the same
+    detector settings gets its stored result without being decoded, and a new result is stored.
+
+    :param file_id: Optional id of the video's file record, indexed with the video's content
+    :param content_hash: ``file_digest`` of the video, if the caller already has it
+    :param segment: Optional ``SegmentRecorder``, fed by the detection if the video is decoded
+    :return: Tuple of (start_frame, reason)
+    """
+    if not ANALYSIS_CONFIG['index_path'] or video_path is None:
+        return detect_subvideo_start(cap, fps, total_frames, confidence_threshold, video_path, segment)[:2]
+
+    content_hash = content_hash or file_digest(video_path)
+    detector = detector_signature(confidence_threshold)
+    stored = lookup_analysis(content_hash, detector)
+    if stored is not None:
+        logger.info(f"Using stored analysis of {video_path}: frame {stored['start_frame']}, {stored['reason']}")
+        start_frame, reason = stored['start_frame'], stored['reason']
+    else:
+        start_frame, reason, complete = detect_subvideo_start(cap, fps, total_frames, confidence_threshold,
+                                                              video_path, segment)
+        if complete:
+            record_analysis(content_hash, detector, fps, start_frame, reason)
+    if file_id is not None:
+        record_file(file_id, content_hash)
+    return start_frame, reason
+
+
+def _keeps_detail_for(cap, target_size):
+    # Frames kept by detection are downscaled, so they are only used if the segment is scaled down further
+    width, height = cap.get(cv2.CAP_PROP_FRAME_WIDTH), cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    if not width or not height:
+        return False
+    detection_scale = min(1.0, DETECTION_CONFIG['max_side'] / max(width, height))
+    return min(target_size[0] / width, target_size[1] / height) <= detection_scale
+
+
+def plan_subvideo(video_path, duration=(5, 8), confidence_threshold=0.7, max_video_duration=40, file_id=None,
+                  target_size=None, frame_rate=24):
+    """
+    Pick the segment of a video to use in the highlight reel without writing it out.
+
+    With ``target_size`` and DETECTION_KEEP_SEGMENT, the segment is also saved as it will be rendered
+    at ``target_size`` and ``frame_rate`` while detection decodes the video (see ``SegmentRecorder``),
+    in a ``.segment.npy`` file next to the video; ``remove_segment_frames`` deletes it.
+
+    :param file_id: Optional id of the video's file record, stored in the analysis index
+
+    :return: Dict with path, fps, start_frame and frame_count of the segment, or None on failure;
+             with the analysis index enabled it also has the video's content_hash, so it is not
+             hashed again for the segment cache, and with a saved segment its frames_path and frames_rate
+    """
+    segment = None
     try:
-        start_time = time.time()
-        logging.info(f"Opening video file: {video_path}")
+        content_hash = file_digest(video_path) if ANALYSIS_CONFIG['index_path'] else None
+        logger.info(f"Opening video file: {video_path}")
         cap = cv2.VideoCapture(video_path)
 
         if not cap.isOpened():
-            logging.error(f"Error opening video file: {video_path}")
+            logger.error(f"Error opening video file: {video_path}")
             return None
 
         fps = int(cap.get(cv2.CAP_PROP_FPS))
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         video_duration = total_frames / fps
-        logging.info(f"Video loaded. FPS: {fps}, Total frames: {total_frames}, Duration: {video_duration:.2f}s")
+        logger.info(f"Video loaded. FPS: {fps}, Total frames: {total_frames}, Duration: {video_duration:.2f}s")
 
         if video_duration > max_video_duration:
-            logging.warning(
+            logger.warning(
                 f"Video duration ({video_duration:.2f}s) exceeds maximum allowed duration ({max_video_duration}s)")
+            if content_hash is not None:
+                # Pre-analysis would otherwise download it again on every run
+                record_rejection(content_hash, video_duration)
+                if file_id is not None:
+                    record_file(file_id, content_hash)
             return None
 
-        # Load YOLO
-        yolo_cfg = get_yolo_path("yolov3.cfg")
-        yolo_weights = get_yolo_path("yolov3.weights")
+        # Drawn up front so the segment's length is known while detection records it
+        seconds = np.random.uniform(duration[0], duration[1])
+        if target_size is not None and DETECTION_CONFIG['keep_segment'] and _keeps_detail_for(cap, target_size):
+            segment = SegmentRecorder(f"{video_path}.segment.npy", fps, seconds, video_duration, target_size,
+                                      frame_rate)
+
+        with span('detection', video=os.path.basename(video_path)) as attributes:
+            start_frame, attributes['reason'] = find_subvideo_start(cap, fps, total_frames, confidence_threshold,
+                                                                    video_path, file_id=file_id,
+                                                                    content_hash=content_hash, segment=segment)
+
+        plan = {
+            'path': video_path,
+            'fps': fps,
+            'start_frame': start_frame,
+            'frame_count': _segment_frame_count(start_frame, fps, seconds, video_duration),
+        }
+        if content_hash is not None:
+            plan['content_hash'] = content_hash
+        if segment is not None:
+            frames_path = segment.finish(cap, start_frame)
+            if frames_path is not None:
+                plan['frames_path'] = frames_path
+                plan['frames_rate'] = frame_rate
+        return plan
 
-        logging.info(f"Loading YOLO model from:")
-        logging.info(f"Config: {yolo_cfg}")
-        logging.info(f"Weights: {yolo_weights}")
+    except Exception as e:
+        if segment is not None:
+            segment.discard()
+        logger.error(f"An error occurred during subvideo planning: {str(e)}")
+        import traceback
+        logger.error(traceback.format_exc())
+        return None
+    finally:
+        if 'cap' in locals() and cap.isOpened():
+            cap.release()
 
-        logging.info("YOLO files found.")
-        net = cv2.dnn.readNetFromDarknet(yolo_cfg, yolo_weights)
-        ln = net.getLayerNames()
-        try:
-            unconnected_layers = net.getUnconnectedOutLayers()
-            if isinstance(unconnected_layers, np.ndarray):
-                ln = [ln[i - 1] for i in unconnected_layers.flatten()]
-            else:
-                ln = [ln[i[0] - 1] for i in unconnected_layers]
-        except IndexError:
-            ln = [ln[i - 1] for i in net.getUnconnectedOutLayers()]
-        logging.info("YOLO network loaded successfully")
-
-        # Process frames with YOLO
-        frames = []
-        for i in range(total_frames):
-            ret, frame = cap.read()
-            if not ret:
-                break
 
-            if net is not None and ln is not None:
-                boxes, confidences = detect_people_yolo(frame, net, ln, confidence_threshold=confidence_threshold)
-                if boxes:
-                    logging.info(f"People detected at frame {i} at {i / fps:.2f}s: {len(boxes)}")
-                    return extract_subvideo_segment(cap, i, fps, video_duration, duration, target_size, output_path)
+def subvideo_output_frame_count(plan, frame_rate):
+    """Number of frames the planned segment spans once resampled to ``frame_rate``."""
+    return int(math.ceil(plan['frame_count'] * frame_rate / plan['fps'] - 1e-9))
 
-            frames.append((frame, i, fps))
 
-            if i % 30 == 0:  # Log progress every 30 frames
-                logging.info(f"Processed {i}/{total_frames} frames with YOLO")
+def _saved_segment_frames(plan, target_size, frame_rate):
+    path = plan.get('frames_path')
+    if path is None or plan.get('frames_rate') != frame_rate:
+        return None
+    try:
+        frames = np.load(path, mmap_mode='r')
+    except (OSError, ValueError) as e:
+        logger.info(f"Saved segment of {plan['path']} unavailable, decoding it again: {str(e)}")
+        return None
+    if frames.shape != (subvideo_output_frame_count(plan, frame_rate), target_size[1], target_size[0], 3):
+        return None
+    return frames
+
+
+def iter_subvideo_frames(plan, target_size=(480, 480), frame_rate=24):
+    """
+    Yield the planned segment as RGB frames at ``target_size``, resampled to ``frame_rate``.
 
-        logging.info("No people detected with YOLO. Proceeding with parallel face detection.")
+    Source frames are picked the same way a clip reader samples a file at a given time, and the
+    last decoded frame is repeated if the stream ends early, so exactly
+    ``subvideo_output_frame_count(plan, frame_rate)`` frames are produced.
+
+    A segment saved by ``plan_subvideo`` is read back as is; the video is only opened, and sought
+    to the segment, when there is none, e.g. for a job resumed on another host.
+    """
+    saved = _saved_segment_frames(plan, target_size, frame_rate)
+    if saved is not None:
+        yield from saved
+        return
+
+    cap = cv2.VideoCapture(plan['path'])
+    try:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, plan['start_frame'])
+        source_index = -1
+        frame = None
+        for output_index in range(subvideo_output_frame_count(plan, frame_rate)):
+            wanted = _source_frame(plan['fps'], plan['frame_count'], output_index, frame_rate)
+            while source_index < wanted:
+                ret, next_frame = cap.read()
+                if not ret:
+                    break
+                frame = next_frame
+                source_index += 1
+            if frame is None:
+                return
+            yield cv2.cvtColor(resize_frame_with_padding(frame, target_size), cv2.COLOR_BGR2RGB)
+    finally:
+        cap.release()
 
-        # Use multiprocessing for face detection
-        num_processes = cpu_count()
-        chunk_size = math.ceil(len(frames) / num_processes)
 
-        with Pool(processes=num_processes) as pool:
-            results = pool.map(detect_faces, frames, chunksize=chunk_size)
+def extract_subvideo(video_path, output_path, target_size=(480, 480), duration=(5, 8), confidence_threshold=0.7,
+                     max_video_duration=40, file_id=None):
+    try:
+        start_time = time.time()
+        logger.info(f"Opening video file: {video_path}")
+        cap = cv2.VideoCapture(video_path)
 
-        # Filter out None results and sort by frame number
-        valid_results = [r for r in results if r is not None]
-        valid_results.sort(key=lambda x: x[0])
+        if not cap.isOpened():
+            logger.error(f"Error opening video file: {video_path}")
+            return None
 
-        if valid_results:
-            start_frame, start_time, reason = valid_results[0]
-            logging.info(f"Faces detected at frame {start_frame} at {start_time:.2f}s: {reason}")
-            return extract_subvideo_segment(cap, start_frame, fps, video_duration, duration, target_size, output_path)
+        fps = int(cap.get(cv2.CAP_PROP_FPS))
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        video_duration = total_frames / fps
+        logger.info(f"Video loaded. FPS: {fps}, Total frames: {total_frames}, Duration: {video_duration:.2f}s")
 
-        logging.info("No people or faces detected in the video.")
+        if video_duration > max_video_duration:
+            logger.warning(
+                f"Video duration ({video_duration:.2f}s) exceeds maximum allowed duration ({max_video_duration}s)")
+            return None
 
-        # If no interesting content found, use the beginning of the video
-        result = extract_subvideo_segment(cap, 0, fps, video_duration, duration, target_size, output_path)
+        with span('detection', video=os.path.basename(video_path)) as attributes:
+            start_frame, attributes['reason'] = find_subvideo_start(cap, fps, total_frames, confidence_threshold,
+                                                                    video_path, file_id=file_id)
+        result = extract_subvideo_segment(cap, start_frame, fps, video_duration, duration, target_size, output_path)
 
         end_time = time.time()
-        logging.info(f"Total processing time: {end_time - start_time:.2f} seconds")
+        logger.info(f"Total processing time: {end_time - start_time:.2f} seconds")
 
         return result
 
     except Exception as e:
-        logging.error(f"An error occurred during subvideo extraction: {str(e)}")
+        logger.error(f"An error occurred during subvideo extraction: {str(e)}")
         import traceback
-        logging.error(traceback.format_exc())
+        logger.error(traceback.format_exc())
         return None
     finally:
         if 'cap' in locals() and cap.isOpened():
@@ -222,4 +544,4 @@ def extract_subvideo(video_path, output_path, target_size=(480, 480), duration=(
 # # Usage example:
 # if __name__ == '__main__':
 #     result = extract_subvideo('tests/media/videos/peo2.mov', 'tests/media/videos/peo2_sub.mp4')
-#     logging.info(f"Script execution completed. Result: {result}")
\ No newline at end of file
+#     logger.info(f"Script execution completed. Result: {result}")
\ No newline at end of file
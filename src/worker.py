@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from cpu_budget import apply_cpu_budget
+from config import WORKER_CONFIG
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+# SQS accepts at most 10 entries per batch call and 10 messages per receive
+SQS_BATCH_SIZE = 10
+
+
+def get_sqs_client():
+    """Return the SQS client shared by the whole process, creating it on first use."""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                import boto3
+                _client = boto3.client('sqs')
+                _client_pid = os.getpid()
+    return _client
+
+
+def _batches(entries):
+    for start in range(0, len(entries), SQS_BATCH_SIZE):
+        yield entries[start:start + SQS_BATCH_SIZE]
+
+
+class SQSWorker:
+    """
+    Poll an SQS queue and run each message through ``handler`` in a pool of job slots.
+
+    Only as many messages are received as there are free slots. While a job runs a heartbeat
+    keeps its message invisible so it is not redelivered to another worker mid-job, and
+    messages of finished jobs are deleted in batches. A message whose handler raises is not
+    deleted and becomes visible again once its visibility timeout expires.
+    """
+
+    def __init__(self, sqs, queue_url, handler, executor=None, concurrency=None, visibility_timeout=None,
+                 heartbeat_interval=None, wait_time_seconds=None, max_empty_receives=None):
+        """
+        :param sqs: boto3 SQS client, or a stand-in with the same interface
+        :param handler: Picklable callable taking the message body
+        :param executor: Executor running the handler; defaults to a process pool with ``concurrency`` workers,
+                         each limited to its share of the CPUs
+        :param max_empty_receives: Stop after this many consecutive empty receives while idle; None to run forever
+        """
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.handler = handler
+        self.concurrency = concurrency or WORKER_CONFIG['concurrency']
+        self.executor = executor or ProcessPoolExecutor(max_workers=self.concurrency, initializer=apply_cpu_budget)
+        self.visibility_timeout = visibility_timeout or WORKER_CONFIG['visibility_timeout']
+        self.heartbeat_interval = heartbeat_interval or WORKER_CONFIG['heartbeat_interval']
+        self.wait_time_seconds = WORKER_CONFIG['wait_time_seconds'] if wait_time_seconds is None else wait_time_seconds
+        self.max_empty_receives = max_empty_receives
+
+        self.in_flight = {}  # future -> message
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._finished = threading.Event()
+        self._heartbeat_thread = None
+
+    def _receive(self, max_messages, wait_time_seconds):
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(SQS_BATCH_SIZE, max_messages),
+            WaitTimeSeconds=wait_time_seconds,
+            VisibilityTimeout=self.visibility_timeout
+        )
+        return response.get('Messages', [])
+
+    def _delete(self, messages):
+        for batch in _batches(messages):
+            response = self.sqs.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']} for i, message in enumerate(batch)]
+            )
+            for failure in response.get('Failed', []):
+                logger.error(f"Failed to delete message: {failure}")
+
+    def _heartbeat(self):
+        while not self._finished.wait(self.heartbeat_interval):
+            with self._lock:
+                messages = list(self.in_flight.values())
+            for batch in _batches(messages):
+                try:
+                    response = self.sqs.change_message_visibility_batch(
+                        QueueUrl=self.queue_url,
+                        Entries=[{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle'],
+                                  'VisibilityTimeout': self.visibility_timeout}
+                                 for i, message in enumerate(batch)]
+                    )
+                    for failure in response.get('Failed', []):
+                        logger.warning(f"Failed to extend message visibility: {failure}")
+                except Exception as e:
+                    logger.error(f"Error extending message visibility: {str(e)}")
+
+    def _collect_finished(self, timeout):
+        """Wait up to ``timeout`` for running jobs and delete the messages of the successful ones."""
+        with self._lock:
+            futures = list(self.in_flight)
+        if not futures:
+            return
+        done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        succeeded = []
+        with self._lock:
+            for future in done:
+                message = self.in_flight.pop(future)
+                try:
+                    future.result()
+                    succeeded.append(message)
+                except Exception as e:
+                    logger.error(f"Error processing message {message.get('MessageId')}: {str(e)}")
+        if succeeded:
+            self._delete(succeeded)
+
+    def run(self):
+        """Process messages until stopped or, when max_empty_receives is set, the queue stays empty."""
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._heartbeat_thread.start()
+        empty_receives = 0
+
+        try:
+            while not self._stop.is_set():
+                self._collect_finished(timeout=0)
+                free_slots = self.concurrency - len(self.in_flight)
+                if free_slots == 0:
+                    self._collect_finished(timeout=self.heartbeat_interval)
+                    continue
+
+                # Long-poll only when idle so finished jobs are collected promptly
+                wait_time = self.wait_time_seconds if not self.in_flight else min(1, self.wait_time_seconds)
+                messages = self._receive(free_slots, wait_time)
+
+                if messages:
+                    empty_receives = 0
+                    with self._lock:
+                        for message in messages:
+                            self.in_flight[self.executor.submit(self.handler, message['Body'])] = message
+                elif not self.in_flight:
+                    empty_receives += 1
+                    logger.info(f"No messages received. Empty receive count: {empty_receives}")
+                    if self.max_empty_receives is not None and empty_receives >= self.max_empty_receives:
+                        logger.info(f"Reached {self.max_empty_receives} empty receives. Exiting.")
+                        break
+        finally:
+            while self.in_flight:
+                self._collect_finished(timeout=None)
+            self._finished.set()
+            self.executor.shutdown()
+
+    def stop(self):
+        """Stop receiving new messages; running jobs are finished before ``run`` returns."""
+        self._stop.set()
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# The modules in src import each other by their plain names, as when run from src
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+BUCKET = 'test-bucket'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """Serve S3 from an in-memory stand-in for the duration of a test."""
+    import s3_connector
+    from local_s3 import InMemoryS3
+    from config import S3_CONFIG
+
+    client = InMemoryS3()
+    monkeypatch.setattr(s3_connector, '_client', client)
+    monkeypatch.setattr(s3_connector, '_client_pid', os.getpid())
+    monkeypatch.setitem(S3_CONFIG, 'bucket_name', BUCKET)
+    return client
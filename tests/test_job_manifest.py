@@ -0,0 +1,50 @@
+from conftest import BUCKET
+from job_manifest import FINGERPRINT_METADATA, STAGES, media_fingerprint, output_key, record_stage, resume_job
+
+MEDIA_ITEMS = [{'id': 1, 'type': 'image', 's3Key': 'media/1/a.jpg'},
+               {'id': 2, 'type': 'video', 's3Key': 'media/2/b.mp4'}]
+
+
+def new_job():
+    return {'account_id': 'account', 'year': 2024}
+
+
+def test_first_run_runs_every_stage(s3):
+    job = resume_job(new_job(), MEDIA_ITEMS)
+
+    assert job['run_stages'] == STAGES[1:]
+
+
+def test_finished_job_is_skipped_on_rerun(s3, monkeypatch):
+    import pipeline
+
+    job = resume_job(new_job(), MEDIA_ITEMS)
+    record_stage(job, 'upload', s3_key=output_key('account', 2024))
+    record_stage(job, 'finalize')
+
+    monkeypatch.setattr(pipeline, 'query_account_media', lambda account_id, year: [dict(item) for item in MEDIA_ITEMS])
+    rerun = pipeline.query_stage(new_job())
+
+    assert rerun['run_stages'] == []
+    assert rerun['skip']
+
+
+def test_upload_without_checkpoint_is_recovered(s3):
+    # The reel reached S3 but the worker stopped before recording the upload
+    s3.put_object(Bucket=BUCKET, Key=output_key('account', 2024), Body=b'reel',
+                  Metadata={FINGERPRINT_METADATA: media_fingerprint(MEDIA_ITEMS)})
+
+    job = resume_job(new_job(), MEDIA_ITEMS)
+
+    assert job['run_stages'] == ['finalize']
+    assert job['s3_key'] == output_key('account', 2024)
+
+
+def test_changed_media_selection_starts_over(s3):
+    job = resume_job(new_job(), MEDIA_ITEMS)
+    record_stage(job, 'upload', s3_key=output_key('account', 2024))
+    record_stage(job, 'finalize')
+
+    job = resume_job(new_job(), MEDIA_ITEMS[:1])
+
+    assert job['run_stages'] == STAGES[1:]
@@ -0,0 +1,65 @@
+import hashlib
+
+import pytest
+from botocore.exceptions import ClientError
+
+from conftest import BUCKET
+from local_s3 import InMemoryS3
+from s3_connector import S3MultipartWriter
+
+PART_SIZE = 1024
+DATA = bytes(range(256)) * 10  # Two full parts and a partial one
+
+
+def expected_etag(data, part_size):
+    digests = [hashlib.md5(data[start:start + part_size]).digest() for start in range(0, len(data), part_size)]
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def upload(data, part_size=PART_SIZE):
+    with S3MultipartWriter(BUCKET, 'videos/reel.mp4', part_size=part_size, max_concurrency=2) as writer:
+        writer.write(data)
+
+
+def test_multipart_upload_gets_s3_etag(s3):
+    upload(DATA)
+
+    stored = s3.objects[(BUCKET, 'videos/reel.mp4')]
+    assert stored['body'] == DATA
+    assert stored['etag'] == expected_etag(DATA, PART_SIZE)
+    assert s3.uploads == {}
+
+
+def test_corrupted_part_is_rejected_and_upload_aborted(s3, monkeypatch):
+    def corrupt(Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        # A byte flipped on the wire no longer matches the part's ContentMD5
+        return InMemoryS3.upload_part(s3, Bucket, Key, UploadId, PartNumber, bytes([Body[0] ^ 0xff]) + Body[1:],
+                                      **kwargs)
+
+    monkeypatch.setattr(s3, 'upload_part', corrupt)
+    with pytest.raises(ClientError) as error:
+        upload(DATA)
+
+    assert error.value.response['Error']['Code'] == 'BadDigest'
+    assert (BUCKET, 'videos/reel.mp4') not in s3.objects
+    assert s3.uploads == {}
+
+
+def test_part_etag_mismatch_is_detected(s3, monkeypatch):
+    def wrong_etag(*args, **kwargs):
+        InMemoryS3.upload_part(s3, *args, **kwargs)
+        return {'ETag': f'"{hashlib.md5(b"other").hexdigest()}"'}
+
+    monkeypatch.setattr(s3, 'upload_part', wrong_etag)
+    with pytest.raises(IOError, match="Checksum mismatch for part"):
+        upload(DATA)
+
+
+def test_object_etag_mismatch_is_detected(s3, monkeypatch):
+    def wrong_etag(*args, **kwargs):
+        response = InMemoryS3.complete_multipart_upload(s3, *args, **kwargs)
+        return dict(response, ETag=f'"{expected_etag(DATA[::-1], PART_SIZE)}"')
+
+    monkeypatch.setattr(s3, 'complete_multipart_upload', wrong_etag)
+    with pytest.raises(IOError, match="Checksum mismatch for videos/reel.mp4"):
+        upload(DATA)
@@ -0,0 +1,79 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from local_queue import InMemorySQS
+from worker import SQS_BATCH_SIZE, SQSWorker
+
+QUEUE_URL = 'https://sqs.local/queue'
+
+
+class RecordingSQS(InMemorySQS):
+    """InMemorySQS that records the entries of every batch call."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.delete_batches = []
+        self.visibility_batches = []
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.delete_batches.append(Entries)
+        return super().delete_message_batch(QueueUrl, Entries)
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.visibility_batches.append(Entries)
+        return super().change_message_visibility_batch(QueueUrl, Entries)
+
+
+def run_worker(sqs, handler, concurrency, **kwargs):
+    worker = SQSWorker(sqs, QUEUE_URL, handler, executor=ThreadPoolExecutor(concurrency), concurrency=concurrency,
+                       wait_time_seconds=0, max_empty_receives=1, **kwargs)
+    worker.run()
+    return worker
+
+
+def test_heartbeat_keeps_running_job_invisible():
+    sqs = RecordingSQS()
+    sqs.send_message(QueueUrl=QUEUE_URL, MessageBody='slow')
+
+    calls = []
+
+    def handler(body):
+        calls.append(body)
+        if len(calls) == 1:
+            time.sleep(2.5)
+
+    # The job outlives the visibility timeout several times over; a free slot would pick it up again if it showed up
+    run_worker(sqs, handler, concurrency=2, visibility_timeout=1, heartbeat_interval=0.2)
+
+    assert calls == ['slow']
+    assert sqs.visibility_batches
+    assert all(entry['VisibilityTimeout'] == 1 for batch in sqs.visibility_batches for entry in batch)
+    assert len(sqs.deleted) == 1
+    assert sqs.messages == {}
+
+
+def test_messages_are_deleted_in_batches():
+    sqs = RecordingSQS()
+    for index in range(25):
+        sqs.send_message(QueueUrl=QUEUE_URL, MessageBody=str(index))
+
+    run_worker(sqs, lambda body: None, concurrency=25)
+
+    assert len(sqs.deleted) == 25
+    assert all(len(batch) <= SQS_BATCH_SIZE for batch in sqs.delete_batches)
+    assert len(sqs.delete_batches) < 25
+
+
+def test_failed_job_keeps_its_message():
+    sqs = RecordingSQS()
+    sqs.send_message(QueueUrl=QUEUE_URL, MessageBody='ok')
+    sqs.send_message(QueueUrl=QUEUE_URL, MessageBody='fail')
+
+    def handler(body):
+        if body == 'fail':
+            raise RuntimeError("job failed")
+
+    run_worker(sqs, handler, concurrency=2)
+
+    assert len(sqs.deleted) == 1
+    assert [message['body'] for message in sqs.messages.values()] == ['fail']